@@ -0,0 +1,146 @@
+# Standard
+import socket
+import threading
+from ipaddress import ip_address, ip_network
+from logging import getLogger
+from time import monotonic
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Third Party
+from django.conf import settings
+from django.http import HttpRequest
+
+# Local
+from abutils.utils import get_ip_address
+
+logger = getLogger("abutils")
+
+
+def resolve_host(hostname: str) -> List[str]:
+    """All of the IPv4 and IPv6 addresses that the DNS name resolves to."""
+    return sorted({info[4][0] for info in socket.getaddrinfo(hostname, None)})
+
+
+class AddressResolver(object):
+    """
+    Resolves a spec like "facility.example.org, 203.0.113.7, 198.51.100.0/28" to a set of networks, which is
+    resolved again in a background thread once it's older than ttl_secs. Literal addresses and CIDR ranges are used
+    as they are. Names are resolved via DNS, and all of their addresses are included. If resolving fails, the last
+    good set is kept.
+    Checks never wait on DNS, not even the first ones, which only match the literals until the names are resolved.
+    Nor do they take locks: the set of networks is an immutable tuple that's replaced all at once.
+    """
+
+    def __init__(self, spec: str, ttl_secs: float = 300.0,
+                 resolve: Callable[[str], List[str]] = resolve_host, clock: Callable[[], float] = monotonic):
+        self.spec = spec
+        self.ttl_secs = ttl_secs
+        self.resolve = resolve
+        self.clock = clock
+        self.literals = []  # type: List
+        self.hostnames = []  # type: List[str]
+        for item in spec.replace(",", " ").split():
+            try:
+                self.literals.append(ip_network(item, strict=False))
+            except ValueError:
+                self.hostnames.append(item)
+        self.networks = tuple(self.literals)
+        # When the networks should be resolved again. Literals never need to be, but names are resolved right away.
+        self.expires = float("-inf") if len(self.hostnames) > 0 else float("inf")
+        self.resolutions = 0
+        self.failures = 0
+        self.last_error = None  # type: Optional[str]
+        self.latencies = []  # type: List[float]  # Of the most recent resolutions, in seconds.
+        self._refreshing = threading.Lock()
+        self._refresh_if_stale()
+
+    def refresh(self) -> None:
+        """Resolves the hostnames in the spec. Normally called in the background, by is_from()."""
+        begin = self.clock()
+        networks = list(self.literals)
+        error = None
+        for hostname in self.hostnames:
+            try:
+                networks.extend(ip_network(addr) for addr in self.resolve(hostname))
+            except (OSError, ValueError) as e:
+                error = "{}: {}".format(hostname, e)
+        latency = self.clock() - begin
+        self.resolutions += 1
+        self.latencies = (self.latencies + [latency])[-100:]
+        if error is None:
+            self.networks = tuple(networks)
+            self.expires = self.clock() + self.ttl_secs
+        else:
+            # Keep the last good set and try again soon, but not so soon that a DNS outage adds to the load.
+            self.failures += 1
+            self.last_error = error
+            self.expires = self.clock() + min(self.ttl_secs, 30.0)
+            logger.warning("Couldn't resolve facility address %s", error)
+
+    def _refresh_in_background(self) -> None:
+        try:
+            self.refresh()
+        finally:
+            self._refreshing.release()
+
+    def _refresh_if_stale(self) -> None:
+        if self.clock() >= self.expires and self._refreshing.acquire(blocking=False):
+            threading.Thread(target=self._refresh_in_background, daemon=True).start()
+
+    def contains(self, addr: str) -> bool:
+        self._refresh_if_stale()
+        try:
+            ip = ip_address(addr.strip())
+        except ValueError:
+            return False
+        return any(ip in network for network in self.networks)
+
+    def is_from(self, request: HttpRequest) -> bool:
+        return self.contains(get_ip_address(request) or "")
+
+    def metrics(self) -> dict:
+        """For monitoring: the current addresses, and how resolving them has gone."""
+        latencies = sorted(self.latencies)
+        return {
+            'spec': self.spec,
+            'networks': [str(network) for network in self.networks],
+            'resolutions': self.resolutions,
+            'failures': self.failures,
+            'last_error': self.last_error,
+            'latency_last_secs': self.latencies[-1] if len(latencies) > 0 else None,
+            'latency_max_secs': latencies[-1] if len(latencies) > 0 else None,
+            'latency_median_secs': latencies[len(latencies) // 2] if len(latencies) > 0 else None,
+        }
+
+
+_resolvers = dict()  # type: Dict[Tuple[str, float], AddressResolver]
+_resolvers_lock = threading.Lock()
+
+
+def facility_resolver(spec: Optional[str] = None) -> Optional[AddressResolver]:
+    """
+    The shared resolver for the given spec, which defaults to the BZWOPS_FACILITY_PUBLIC_IP setting.
+    :return: None if there's no spec.
+    """
+    if spec is None:
+        spec = settings.BZWOPS_FACILITY_PUBLIC_IP
+    if spec is None:
+        return None
+    key = (spec, getattr(settings, 'BZWOPS_FACILITY_IP_TTL_SECS', 300.0))
+    resolver = _resolvers.get(key)
+    if resolver is None:
+        with _resolvers_lock:
+            if key not in _resolvers:
+                _resolvers[key] = AddressResolver(*key)
+            resolver = _resolvers[key]
+    return resolver
+
+
+def is_from_facility(request: HttpRequest, spec: Optional[str] = None) -> bool:
+    """
+    Determines whether the request came from inside the facility, i.e. from one of its public addresses.
+    :param spec: The facility's addresses, as for AddressResolver. Defaults to the BZWOPS_FACILITY_PUBLIC_IP setting.
+    :return: False if the facility's addresses aren't configured.
+    """
+    resolver = facility_resolver(spec)
+    return resolver is not None and resolver.is_from(request)
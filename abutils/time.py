@@ -1,6 +1,7 @@
 # Standard
 from datetime import date, time, timedelta, datetime
 from decimal import Decimal
+from typing import Iterator, Tuple
 import calendar
 
 # Third-Party
@@ -14,6 +15,16 @@ def is_very_last_day_of_month(some_date: date) -> bool:
     return future_day.month != some_date.month
 
 
+def month_segments(start: date, end: date) -> Iterator[Tuple[date, date]]:
+    """Splits the inclusive range start..end into (first day, last day) pieces that don't cross month boundaries."""
+    seg_start = start
+    while seg_start <= end:
+        days_in_month = calendar.monthrange(seg_start.year, seg_start.month)[1]
+        seg_end = min(end, seg_start.replace(day=days_in_month))
+        yield seg_start, seg_end
+        seg_start = seg_end + timedelta(days=1)
+
+
 def is_last_xxxday_of_month(some_date: date) -> bool:
     """True if the given date is the last {mon|tues|...|sun}day of the month"""
     future_xxxday = some_date + timedelta(days=7)  # type: date
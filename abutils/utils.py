@@ -1,9 +1,9 @@
 # Standard
 import uuid
-import socket
 from typing import Type
 
 # Third Party
+from django.core.cache import cache
 from django.db.models import Model
 from django.http import HttpRequest
 from django.conf import settings
@@ -34,6 +34,37 @@ def generate_ctrlid(modelcls: Type[Model]) -> str:
     return "GEN:" + generate_hex_string(8, is_unique)
 
 
+def has_new_data(older: dict, newer: dict) -> bool:
+    """Decides whether newer (e.g. data from an ETL source) would change older (e.g. data already in the DB)."""
+    for newkey, newval in newer.items():
+        if newkey in ['id', 'protected']: continue
+        if newval is None: continue
+        if newkey not in older: return True
+        elif older[newkey] != newer[newkey]: return True
+    return False
+
+
+def bump_cache_generation(key: str) -> str:
+    """
+    Replaces the generation stored under key in the shared cache with a new one, which never expires.
+    Generations are unique tokens rather than counts, so a generation that's lost, e.g. culled from the cache,
+    is never issued again.
+    """
+    generation = uuid.uuid4().hex
+    cache.set(key, generation, timeout=None)
+    return generation
+
+
+def get_cache_generation(key: str) -> str:
+    """The generation stored under key in the shared cache. A new one is started if there isn't one."""
+    generation = cache.get(key)
+    if generation is None:
+        generation = uuid.uuid4().hex
+        if not cache.add(key, generation, timeout=None):
+            generation = cache.get(key, generation)  # Another process started one first.
+    return generation
+
+
 def get_ip_address(request: HttpRequest) -> str:
     """ Get client machine's IP address from request """
     x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
@@ -42,10 +73,3 @@ def get_ip_address(request: HttpRequest) -> str:
     else:
         ip = request.META.get('REMOTE_ADDR')
     return ip
-
-
-def request_is_from_host(request: HttpRequest, hostname: str) -> bool:
-    req_ip = get_ip_address(request)
-    host_ip = socket.gethostbyname(hostname)
-    return req_ip == host_ip
-
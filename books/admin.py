@@ -19,7 +19,7 @@ from django_object_actions import DjangoObjectActions
 from books.models import (
     Account, Budget, CashTransfer,
     DonationNote, MonetaryDonation, DonatedItem, Donation, MonetaryDonationReward,
-    Sale, SaleNote, OtherItem, OtherItemType, ExpenseTransaction,
+    Sale, SaleNote, PayerIndex, OtherItem, OtherItemType, ExpenseTransaction,
     ExpenseTransactionNote, ExpenseClaim, ExpenseClaimNote,
     ExpenseClaimReference, ExpenseLineItem,
     ReceivableInvoice, ReceivableInvoiceNote, ReceivableInvoiceReference, ReceivableInvoiceLineItem,
@@ -119,8 +119,8 @@ class AccountParentFilter(admin.SimpleListFilter):
     parameter_name = 'parent'
 
     def lookups(self, request, model_admin):
-        accts = Account.objects.all()
-        return [(a.id, a.name) for a in accts if len(a.subaccounts)>0]
+        accts = Account.objects.filter(id__in=Account.objects.values('parent_id'))
+        return [(a.id, a.name) for a in accts]
 
     def queryset(self, request, queryset):
         if self.value() is None:
@@ -596,9 +596,10 @@ class SaleAdmin(JournalerAdmin, ModelMailerAdmin):
     @staticmethod
     def link_to_user(modeladmin, request, queryset) -> None:
         # TODO: This should be an asynchronous task if we're going to allow its use on large sets.
-        for obj in queryset.filter(payer_acct__isnull=True):  # type: Sale
-            if obj.link_to_user():
-                obj.save()
+        with PayerIndex():
+            for obj in queryset.filter(payer_acct__isnull=True):  # type: Sale
+                if obj.link_to_user():
+                    obj.save()
 
     actions = ['link_to_user']
 
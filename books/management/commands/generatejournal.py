@@ -1,52 +1,159 @@
 # Standard
-from typing import List
+from typing import List, Dict, Tuple
+from decimal import Decimal
+import multiprocessing as mp
 
 # Third party
 from django.core.management.base import BaseCommand
 from django.conf import settings
 from django.contrib.sites.models import Site
+from django.apps import apps
+from django.db import connection
+from django.utils import timezone
 
 # Local
 from books.models import (
-    JournalEntry,
-    Journaler, JournalLiner,
+    Account, JournalEntry,
+    Journaler, JournalBatch,
+    DirtyJournaler, DailyAccountBalance,
     registered_journaler_classes,
 )
 
 __author__ = 'adrian'
 
+SHARDS_PER_WORKER = 4
+
+
+def pk_range_shards(pks: List[int], num_shards: int) -> List[Tuple[int, int]]:
+    """Splits the given ascending pks into at most num_shards (first_pk, last_pk) ranges of similar size."""
+    shard_size = max(1, -(-len(pks) // num_shards))  # Ceiling division.
+    return [(pks[i], pks[min(i+shard_size, len(pks))-1]) for i in range(0, len(pks), shard_size)]
+
+
+def generate_shard(shard: Tuple[str, int, int, bool]) -> Tuple[List[int], Decimal, Decimal, int, float]:
+    """
+    Runs in a worker process. Generates the journal entries for journalers of one class with pks in the shard's range.
+    Returns the ids of the unbalanced entries, the debit & credit totals, and the rows written & time spent writing
+    them so the parent can merge them.
+    """
+    model_label, first_pk, last_pk, use_copy = shard
+    journaler_class = apps.get_model(model_label)
+    links = journaler_class.link_names_of_relevant_children()
+    journalers = journaler_class.objects.filter(pk__gte=first_pk, pk__lte=last_pk).prefetch_related(*links)
+    with JournalBatch(maintain_rollups=False, use_copy=use_copy) as batch:
+        for journaler in journalers:  # type: Journaler
+            journaler.create_journalentry()
+    unbalanced_ids = [je.id for je in batch.unbalanced_journal_entries]
+    return unbalanced_ids, batch.grand_total_debits, batch.grand_total_credits, batch.rows_written, batch.write_secs
+
 
 class Command(BaseCommand):
 
     help = "(Re)generates the journal from existing transactions."
 
-    def handle(self, *args, **options):
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true',
+            help="Delete the entire journal and regenerate it, instead of just the entries for changed transactions.")
+        parser.add_argument('--workers', type=int, default=1,
+            help="Number of worker processes to use when the entire journal is regenerated.")
+        parser.add_argument('--no-copy', action='store_true',
+            help="Write entries with bulk_create even if the database supports COPY. Useful for comparing the two.")
+
+    def generate_for(self, journaler_class, journalers: List[Journaler], total_count: int):
+        count = 0  # type: int
+        print("{}s".format(journaler_class.__name__), flush=True)
+        print("   Loading data ... ", end="", flush=True)
+        for journaler in journalers:
+            if count==0:
+                print("Done.", flush=True)
+            count += 1
+            progress = 1.0 * count / total_count
+            print("\r   Processed {:.0%} ... ".format(progress), end="")
+            journaler.create_journalentry()
+        print("Done.\n")
 
+    def delete_all(self):
         print("\nDeleting unfrozen journal entries... ", end="", flush=True)
         JournalEntry.objects.all().delete()
         print("Done.\n")
 
+    def generate_full(self):
         for journaler_class in registered_journaler_classes:
-            # print("\rGenerating entries for {} transactions...".format(journaler_class.__name__))
-            count = 0  # type: int
-            total_count = journaler_class.objects.count()
-            print("{}s".format(journaler_class.__name__), flush=True)
-            print("   Loading data ... ", end="", flush=True)
             links = journaler_class.link_names_of_relevant_children()
             journalers = journaler_class.objects.all().prefetch_related(*links)  # type: List[Journaler]
-            for journaler in journalers:
-                if count==0:
-                    print("Done.", flush=True)
+            self.generate_for(journaler_class, journalers, journaler_class.objects.count())
+
+    def generate_full_in_parallel(self, batch: JournalBatch, workers: int):
+
+        shards = []  # type: List[Tuple[str, int, int, bool]]
+        for journaler_class in registered_journaler_classes:
+            pks = list(journaler_class.objects.order_by('pk').values_list('pk', flat=True))
+            for first_pk, last_pk in pk_range_shards(pks, workers*SHARDS_PER_WORKER):
+                shards.append((journaler_class._meta.label, first_pk, last_pk, batch.use_copy))
+
+        # Worker processes must not share the parent's DB connection.
+        connection.close()
+        with mp.Pool(workers) as pool:
+            count = 0  # type: int
+            for unbalanced_ids, total_dr, total_cr, rows, secs in pool.imap_unordered(generate_shard, shards):
+                batch.unbalanced_journal_entries.extend(JournalEntry.objects.filter(id__in=unbalanced_ids))
+                batch.grand_total_debits += total_dr
+                batch.grand_total_credits += total_cr
+                batch.rows_written += rows
+                batch.write_secs += secs
                 count += 1
-                progress = 1.0 * count / total_count
-                print("\r   Processed {:.0%} ... ".format(progress), end="")
-                journaler.create_journalentry()
+                print("\r   Processed {} of {} shards ... ".format(count, len(shards)), end="", flush=True)
+        print("Done.\n")
+
+    def generate_incremental(self, batch: JournalBatch, markers: List[DirtyJournaler]):
+
+        dirty_ids = dict()  # type: Dict[type, List[int]]
+        for marker in markers:
+            journaler_class = marker.content_type.model_class()
+            dirty_ids.setdefault(journaler_class, []).append(marker.object_id)
+
+        print("\nDeleting journal entries for {} changed transactions... ".format(len(markers)), end="", flush=True)
+        for journaler_class, ids in dirty_ids.items():
+            # Journalers that have since been deleted are still matched, by source_url, so their entries go away.
+            urls = [journaler_class(id=id).get_absolute_url() for id in ids]
+            batch.delete_entries(urls)
+        print("Done.\n")
+
+        for journaler_class in registered_journaler_classes:
+            if journaler_class not in dirty_ids:
+                continue
+            links = journaler_class.link_names_of_relevant_children()
+            journalers = journaler_class.objects.filter(id__in=dirty_ids[journaler_class])
+            journalers = journalers.prefetch_related(*links)  # type: List[Journaler]
+            self.generate_for(journaler_class, journalers, len(dirty_ids[journaler_class]))
+
+    def handle(self, *args, **options):
+
+        # Changes made while we're running will leave markers with a later timestamp.
+        started = timezone.now()
+
+        full = options['full'] or not JournalEntry.objects.exists()
+
+        use_copy = False if options['no_copy'] else None  # None lets JournalBatch decide based on the database.
+        with JournalBatch(maintain_rollups=not full, use_copy=use_copy) as batch:
+            if full:
+                self.delete_all()
+                if options['workers'] > 1:
+                    self.generate_full_in_parallel(batch, options['workers'])
+                else:
+                    self.generate_full()
+            else:
+                markers = DirtyJournaler.objects.filter(when_marked__lte=started).select_related('content_type')
+                self.generate_incremental(batch, list(markers))
+
+        if full:
+            print("Rolling up daily account balances... ", end="", flush=True)
+            DailyAccountBalance.refresh()
             print("Done.\n")
 
-        Journaler.save_je_batch()
-        JournalLiner.save_jeli_batch()
+        DirtyJournaler.objects.filter(when_marked__lte=started).delete()
 
-        errors = Journaler.get_unbalanced_journal_entries()
+        errors = batch.unbalanced_journal_entries
         print("Found {} Errors:".format(len(errors)))
         for je in errors:
             url = je.source_url
@@ -57,12 +164,22 @@ class Command(BaseCommand):
             for li in je.journalentrylineitem_set.all():
                 print("      {}".format(str(li)))
 
-        total_dr = Journaler._grand_total_debits
-        total_cr = Journaler._grand_total_credits
+        total_dr = batch.grand_total_debits
+        total_cr = batch.grand_total_credits
         total_diff = total_cr - total_dr
         print("\nTotals")
         print("  debits:  {0:9.2f}".format(total_dr))
         print("  credits: {0:9.2f}".format(total_cr))
         print("  diff:    {0:9.2f}".format(total_diff))
 
+        rate = batch.rows_written / batch.write_secs if batch.write_secs > 0 else 0.0
+        print("\nWrote {} rows in {:.2f} sec ({:.0f} rows/sec) using {}".format(
+            batch.rows_written, batch.write_secs, rate, batch.writer_name))
+        if options['workers'] > 1:
+            print("   (Write time is summed across workers.)")
+
+        stats = Account.acct_cache_stats
+        print("\nAccount cache: {} hits, {} misses, {} invalidations".format(
+            stats['hits'], stats['misses'], stats['invalidations']))
+
         print("\nDone.\n")
@@ -0,0 +1,28 @@
+# Generated by Django 2.1.11 on 2026-10-18 13:54
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('books', '0027_auto_20180903_1542'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DirtyJournaler',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.PositiveIntegerField(help_text='The id of the journaler that changed. It might have been deleted since.')),
+                ('when_marked', models.DateTimeField(help_text='The last time at which the journaler was marked dirty.')),
+                ('content_type', models.ForeignKey(help_text='The type of the journaler that changed.', on_delete=django.db.models.deletion.CASCADE, to='contenttypes.ContentType')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='dirtyjournaler',
+            unique_together={('content_type', 'object_id')},
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 2.1.11 on 2026-10-18 13:57
+
+from decimal import Decimal
+from django.db import migrations, models
+from django.db.models import Sum
+import django.db.models.deletion
+
+
+def forward_func(apps, schema_editor):
+    # Roll up the existing journal so that incremental refreshes have prior balances to build on.
+    # This is DailyAccountBalance.refresh() for historical models. It can't be called here because it uses the cache,
+    # whose table doesn't exist yet when migrations run, e.g. while creating a test database.
+    JournalEntryLineItem = apps.get_model('books', 'JournalEntryLineItem')
+    DailyAccountBalance = apps.get_model('books', 'DailyAccountBalance')
+    sums = JournalEntryLineItem.objects.values('account_id', 'journal_entry__when', 'action')
+    sums = sums.annotate(total=Sum('amount')).order_by('account_id', 'journal_entry__when')
+    rows = []
+    for s in sums:
+        acct_id, when = s['account_id'], s['journal_entry__when']
+        if len(rows) == 0 or rows[-1].account_id != acct_id or rows[-1].when != when:
+            prior = rows[-1].balance if len(rows) > 0 and rows[-1].account_id == acct_id else Decimal("0.00")
+            rows.append(DailyAccountBalance(account_id=acct_id, when=when,
+                                            increases=Decimal("0.00"), decreases=Decimal("0.00"), balance=prior))
+        if s['action'] == ">":  # JournalEntryLineItem.ACTION_BALANCE_INCREASE
+            rows[-1].increases += s['total']
+            rows[-1].balance += s['total']
+        else:
+            rows[-1].decreases += s['total']
+            rows[-1].balance -= s['total']
+    DailyAccountBalance.objects.bulk_create(rows, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0028_auto_20261018_0654'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyAccountBalance',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('when', models.DateField(help_text='The day whose activity is summarized.')),
+                ('increases', models.DecimalField(decimal_places=2, help_text="The total of the day's increases to the account.", max_digits=12)),
+                ('decreases', models.DecimalField(decimal_places=2, help_text="The total of the day's decreases to the account.", max_digits=12)),
+                ('balance', models.DecimalField(decimal_places=2, help_text="The account's balance at the end of the day, i.e. all increases less all decreases to date.", max_digits=12)),
+                ('account', models.ForeignKey(help_text='The account whose activity is summarized.', on_delete=django.db.models.deletion.CASCADE, to='books.Account')),
+            ],
+            options={
+                'ordering': ['when'],
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='dailyaccountbalance',
+            unique_together={('account', 'when')},
+        ),
+        migrations.RunPython(forward_func, migrations.RunPython.noop),
+    ]
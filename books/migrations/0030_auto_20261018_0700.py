@@ -0,0 +1,34 @@
+# Generated by Django 2.1.11 on 2026-10-18 14:00
+
+from django.db import migrations, models
+
+
+def forward_func(apps, schema_editor):
+    Account = apps.get_model('books', 'Account')
+    paths = dict()
+    accts = list(Account.objects.all())
+    while len(paths) < len(accts):
+        progress = False
+        for acct in accts:
+            if acct.id not in paths and (acct.parent_id is None or acct.parent_id in paths):
+                paths[acct.id] = "{}{}/".format(paths.get(acct.parent_id, "/"), acct.id)
+                Account.objects.filter(id=acct.id).update(path=paths[acct.id])
+                progress = True
+        if not progress:
+            raise ValueError("Account hierarchy contains a cycle.")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0029_auto_20261018_0657'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='account',
+            name='path',
+            field=models.CharField(blank=True, db_index=True, editable=False, help_text='The ids of the accounts from the root account down to this one, e.g. /1/5/17/. Maintained automatically.', max_length=255),
+        ),
+        migrations.RunPython(forward_func, migrations.RunPython.noop),
+    ]
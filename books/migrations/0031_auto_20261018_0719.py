@@ -0,0 +1,28 @@
+# Generated by Django 2.1.11 on 2026-10-18 14:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0030_auto_20261018_0700'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='monetarydonation',
+            name='etl_hash',
+            field=models.CharField(blank=True, default='', help_text='Hash of the data that ETL last loaded into this record. ETL skips records whose hash is unchanged.', max_length=40),
+        ),
+        migrations.AddField(
+            model_name='otheritem',
+            name='etl_hash',
+            field=models.CharField(blank=True, default='', help_text='Hash of the data that ETL last loaded into this record. ETL skips records whose hash is unchanged.', max_length=40),
+        ),
+        migrations.AddField(
+            model_name='sale',
+            name='etl_hash',
+            field=models.CharField(blank=True, default='', help_text='Hash of the data that ETL last loaded into this record. ETL skips records whose hash is unchanged.', max_length=40),
+        ),
+    ]
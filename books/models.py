@@ -7,9 +7,14 @@ from typing import Dict, List, Optional, Tuple
 from abc import abstractmethod, ABCMeta
 from logging import getLogger
 from collections import Counter
+import threading
+from io import StringIO
+from time import monotonic, perf_counter
 
 # Third party
-from django.db import models
+from django.db import models, connection
+from django.db.models import Sum, F, Q, Case, When, Value
+from django.db.models.functions import Coalesce
 from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.contrib.auth.models import User
@@ -18,12 +23,13 @@ from django.contrib.sites.models import Site
 from django.conf import settings
 from nameparser import HumanName
 from django.urls import reverse
+from django.utils import timezone
 from django.utils.html import format_html
 from django.utils.translation import ugettext_lazy as _
 
 
 # Local
-from abutils.utils import generate_ctrlid
+from abutils.utils import generate_ctrlid, bump_cache_generation, get_cache_generation
 from abutils.models import get_url_str
 
 logger = getLogger("books")
@@ -42,6 +48,9 @@ ACCT_REVENUE_DONATION = 35  # General Donations.
 ACCT_REVENUE_MEMBERSHIP = 6
 ACCT_REVENUE_DISCOUNT = 49
 
+# Bumped whenever the journal rollups or bank balances change, so results computed from them can be cached.
+CASH_DATA_GENERATION_KEY = "books.cash_data.generation"
+
 try:
     PROD_HOST = Site.objects.get_current().domain
     DEV_HOST = "localhost:8000"
@@ -174,12 +183,46 @@ class Account(models.Model):
     active = models.BooleanField(default=True,
         help_text="Uncheck when an account is no longer actively used.")
 
-    acct_cache = dict()  # type: Dict[str, Account]
+    path = models.CharField(max_length=255, blank=True, db_index=True, editable=False,
+        help_text="The ids of the accounts from the root account down to this one, e.g. /1/5/17/. Maintained automatically.")
+
+    # Accounts are cached in each process. Saving or deleting an account bumps a generation number in the
+    # shared cache. Each process compares that with its own generation at most every ACCT_CACHE_CHECK_SECS
+    # and empties its cache if they differ. Between checks, lookups don't touch the DB or the shared cache.
+    ACCT_CACHE_GENERATION_KEY = "books.Account.generation"
+    ACCT_CACHE_CHECK_SECS = 5.0
+    acct_cache = dict()  # type: Dict[int, Account]
+    acct_cache_generation = None  # type: Optional[str]
+    acct_cache_checked = None  # type: Optional[float]
+    acct_cache_stats = Counter()  # type: Counter
+
+    @staticmethod
+    def _check_acct_cache() -> None:
+        now = monotonic()
+        if Account.acct_cache_checked is not None and now - Account.acct_cache_checked < Account.ACCT_CACHE_CHECK_SECS:
+            return
+        Account.acct_cache_checked = now
+        generation = get_cache_generation(Account.ACCT_CACHE_GENERATION_KEY)
+        if generation != Account.acct_cache_generation:
+            if len(Account.acct_cache) > 0:
+                Account.acct_cache_stats['invalidations'] += 1
+            Account.acct_cache.clear()
+            Account.acct_cache_generation = generation
+
+    @staticmethod
+    def invalidate_acct_cache() -> None:
+        """Makes every process discard its cached accounts. This process does so immediately."""
+        bump_cache_generation(Account.ACCT_CACHE_GENERATION_KEY)
+        Account.acct_cache.clear()
+        Account.acct_cache_checked = None
 
     @staticmethod
     def get(acct_num: int) -> 'Account':
+        Account._check_acct_cache()
         if acct_num in Account.acct_cache:
+            Account.acct_cache_stats['hits'] += 1
             return Account.acct_cache[acct_num]
+        Account.acct_cache_stats['misses'] += 1
         try:
             acct = Account.objects.get(id=acct_num)
             Account.acct_cache[acct_num] = acct
@@ -188,20 +231,73 @@ class Account(models.Model):
             logger.exception("Couldn't find account #{} ".format(acct_num))
             raise
 
+    @staticmethod
+    def path_for(parent_path: Optional[str], acct_id: int) -> str:
+        return "{}{}/".format(parent_path or "/", acct_id)
+
+    @staticmethod
+    def rebuild_paths() -> int:
+        """
+        Recomputes every account's path from the parent links, e.g. after accounts were loaded before their parents.
+        Accounts that aren't connected to a root account in the DB keep an empty path.
+        :return: The number of accounts whose paths changed.
+        """
+        accts = list(Account.objects.only('id', 'parent', 'path'))
+        paths = dict()  # type: Dict[int, str]
+        progress = True
+        while progress:
+            progress = False
+            for acct in accts:
+                if acct.id not in paths and (acct.parent_id is None or acct.parent_id in paths):
+                    paths[acct.id] = Account.path_for(paths.get(acct.parent_id), acct.id)
+                    progress = True
+        changed = [acct for acct in accts if paths.get(acct.id, "") != acct.path]
+        for acct in changed:
+            acct.path = paths.get(acct.id, "")
+        update_rows(Account, ['path'], changed)
+        if len(changed) > 0:
+            Account.invalidate_acct_cache()
+        return len(changed)
+
+    @staticmethod
+    def in_tree_order(accts: List['Account'], root_id: Optional[int] = None) -> List['Account']:
+        """
+        Orders accounts depth first, as in a chart of accounts, starting from the children of root_id.
+        Siblings keep the order in which they're given. Accounts that aren't under root_id are dropped.
+        """
+        children = dict()  # type: Dict[Optional[int], List[Account]]
+        for acct in accts:
+            children.setdefault(acct.parent_id, []).append(acct)
+
+        def visit(parent_id: Optional[int]):
+            for child in children.get(parent_id, []):
+                yield child
+                yield from visit(child.id)
+
+        return list(visit(root_id))
+
+    @property
+    def subtree(self) -> models.QuerySet:
+        """This account and all of its subaccounts, at any depth."""
+        if self.path == "":
+            # The path isn't known (the account is unsaved or isn't connected to a root), so follow the parent links.
+            ids = {self.pk} - {None}
+            frontier = list(ids)
+            while len(frontier) > 0:
+                children = Account.objects.filter(parent_id__in=frontier).exclude(pk__in=ids)
+                frontier = list(children.values_list('id', flat=True))
+                ids.update(frontier)
+            return Account.objects.filter(pk__in=ids)
+        return Account.objects.filter(path__startswith=self.path)
+
     @property
     def subaccounts(self) -> List['Account']:
-        result = []  # type: List['Account']
-        for subacct in self.account_set.all():
-            result.append(subacct)
-            result.extend(subacct.subaccounts)
-        return result
+        return Account.in_tree_order(list(self.subtree.exclude(pk=self.pk)), self.pk)
 
     def is_subaccount_of(self, other: 'Account') -> bool:
-        if self.parent is None:
-            return False
-        if self.parent == other:
-            return True
-        return self.parent.is_subaccount_of(other)
+        if self.path == "":  # Not yet saved, so fall back on the parent chain.
+            return self.parent is not None and (self.parent == other or self.parent.is_subaccount_of(other))
+        return self.pk != other.pk and "/{}/".format(other.pk) in self.path
 
     @property
     def category_name(self):
@@ -392,15 +488,206 @@ class JournalEntryLineItem(models.Model):
         )
 
 
+def _copy_value(value) -> str:
+    """Formats a value for PostgreSQL's COPY text format."""
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, date):
+        return value.isoformat()
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def copy_rows(model_class, field_names: List[str], objs: List[models.Model]) -> None:
+    """
+    Writes objs to model_class's table using PostgreSQL's COPY FROM STDIN, which is much faster than INSERT.
+    Like bulk_create, this doesn't call save() or send signals. Unlike bulk_create, it doesn't set pks.
+    """
+    qn = connection.ops.quote_name
+    fields = [model_class._meta.get_field(name) for name in field_names]
+    rows = StringIO()
+    for obj in objs:
+        rows.write("\t".join(_copy_value(getattr(obj, f.attname)) for f in fields))
+        rows.write("\n")
+    rows.seek(0)
+    sql = "COPY {} ({}) FROM STDIN".format(
+        qn(model_class._meta.db_table),
+        ", ".join(qn(f.column) for f in fields)
+    )
+    with connection.cursor() as cursor:
+        cursor.copy_expert(sql, rows)
+
+
+def reserve_ids(model_class, count: int) -> List[int]:
+    """Takes a block of count ids from the PostgreSQL sequence behind model_class's pk."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)",
+            [model_class._meta.db_table, model_class._meta.pk.column, count]
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def update_rows(model_class, field_names: List[str], objs: List[models.Model]) -> None:
+    """
+    Writes the named fields of objs to model_class's table with a single UPDATE, using CASE on the pk.
+    Like QuerySet.update(), this doesn't call save() or send signals.
+    """
+    objs = [obj for obj in objs if obj.pk is not None]
+    if len(objs) == 0:
+        return
+    updates = dict()
+    for name in field_names:
+        field = model_class._meta.get_field(name)
+        whens = [When(pk=obj.pk, then=Value(getattr(obj, field.attname), output_field=field)) for obj in objs]
+        updates[field.attname] = Case(*whens, output_field=field)
+    model_class.objects.filter(pk__in=[obj.pk for obj in objs]).update(**updates)
+
+
+class JournalBatch(object):
+    """
+    A batching session that stages JournalEntries and JournalEntryLineItems for bulk writes.
+    While a session is active (as a context manager), Journaler.batch(...) and JournalLiner.batch_jeli(...)
+    add to it. It also keeps the grand totals and the list of unbalanced entries for the session.
+    A session is only active in the thread that entered it, e.g. one of a threaded server's concurrent admin saves.
+    Sessions aren't shared between processes, so each generatejournal worker has its own.
+    On PostgreSQL, batches are written with COPY, using ids reserved from the JournalEntry sequence.
+    Elsewhere, or if use_copy is false, they're written with bulk_create.
+    """
+
+    BATCH_SIZE = 1000
+    COPY_BATCH_SIZE = 10000
+
+    _local = threading.local()  # Its "active" attribute is the thread's stack of active sessions.
+
+    def __init__(self, maintain_rollups: bool = True, use_copy: Optional[bool] = None):
+        self.je_batch = []  # type: List[JournalEntry]
+        self.jeli_batch = []  # type: List[JournalEntryLineItem]
+        self.unbalanced_journal_entries = []  # type: List[JournalEntry]
+        self.grand_total_debits = DEC0
+        self.grand_total_credits = DEC0
+        # If maintain_rollups is false, the caller is responsible for refreshing DailyAccountBalance.
+        self.maintain_rollups = maintain_rollups
+        self.rollup_start_dates = dict()  # type: Dict[int, date]
+        if use_copy is None:
+            use_copy = connection.vendor == 'postgresql'
+        self.use_copy = use_copy
+        self.batch_size = self.COPY_BATCH_SIZE if use_copy else self.BATCH_SIZE
+        # For timing reports:
+        self.rows_written = 0
+        self.write_secs = 0.0
+
+    @property
+    def writer_name(self) -> str:
+        return "COPY" if self.use_copy else "bulk_create"
+
+    @classmethod
+    def _active(cls) -> List['JournalBatch']:
+        if not hasattr(cls._local, 'active'):
+            cls._local.active = []
+        return cls._local.active
+
+    def __enter__(self) -> 'JournalBatch':
+        JournalBatch._active().append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.save()
+        finally:
+            JournalBatch._active().remove(self)
+
+    @classmethod
+    def current(cls) -> 'JournalBatch':
+        active = cls._active()
+        assert len(active) > 0, "Journal entries can only be batched inside a JournalBatch session."
+        return active[-1]
+
+    def batch(self, je: JournalEntry) -> JournalEntry:
+        """Adds a JournalEntry instance to the batch that's accumulating for eventual bulk_create."""
+        balance = DEC0
+        for jeli in je.prebatched_lineitems:
+            self._touch(jeli.account_id, je.when)
+            if jeli.iscredit():
+                balance += jeli.amount
+                self.grand_total_credits += jeli.amount
+            else:
+                balance -= jeli.amount
+                self.grand_total_debits += jeli.amount
+        if abs(balance) > Decimal("0.05"):  # Don't report *small* errors due to rounding.
+            self.unbalanced_journal_entries.append(je)
+            je.unbalanced = True
+        self.je_batch.append(je)
+        if len(self.je_batch) > self.batch_size:
+            self.save_je_batch()
+        return je
+
+    def batch_jeli(self, jeli: JournalEntryLineItem) -> JournalEntryLineItem:
+        self.jeli_batch.append(jeli)
+        if len(self.jeli_batch) > self.batch_size:
+            self.save_jeli_batch()
+        return jeli
+
+    def save_je_batch(self):
+        """
+        Save the currently batched JournalEntry instances,
+        and stage the associated pre-batched JournalEntryLineItems for batch creation.
+        """
+        if len(self.je_batch) == 0:
+            return
+        start = perf_counter()
+        if self.use_copy:
+            for je, je_id in zip(self.je_batch, reserve_ids(JournalEntry, len(self.je_batch))):
+                je.id = je_id
+            copy_rows(JournalEntry, ['id', 'frozen', 'source_url', 'when', 'unbalanced'], self.je_batch)
+        else:
+            # NOTE: As of 1/18/2016, this will only work in Django version 1.10 with Postgres
+            JournalEntry.objects.bulk_create(self.je_batch)
+        self.write_secs += perf_counter() - start
+        self.rows_written += len(self.je_batch)
+        for je in self.je_batch:
+            je.process_prebatch()
+        self.je_batch = []
+
+    def save_jeli_batch(self):
+        if len(self.jeli_batch) == 0:
+            return
+        start = perf_counter()
+        if self.use_copy:
+            copy_rows(JournalEntryLineItem, ['journal_entry', 'account', 'action', 'amount', 'description'], self.jeli_batch)
+        else:
+            JournalEntryLineItem.objects.bulk_create(self.jeli_batch)
+        self.write_secs += perf_counter() - start
+        self.rows_written += len(self.jeli_batch)
+        self.jeli_batch = []
+
+    def _touch(self, account_id: int, when: date) -> None:
+        """Notes that the rollups for the account need to be refreshed from the given date onward."""
+        if account_id not in self.rollup_start_dates or when < self.rollup_start_dates[account_id]:
+            self.rollup_start_dates[account_id] = when
+
+    def delete_entries(self, source_urls: List[str]) -> None:
+        """Deletes the journal entries with the given source urls, noting the rollups that they affected."""
+        jelis = JournalEntryLineItem.objects.filter(journal_entry__source_url__in=source_urls)
+        for account_id, when in jelis.values_list('account_id', 'journal_entry__when').distinct():
+            self._touch(account_id, when)
+        JournalEntry.objects.filter(source_url__in=source_urls).delete()
+
+    def save(self):
+        self.save_je_batch()
+        self.save_jeli_batch()
+        if self.maintain_rollups and len(self.rollup_start_dates) > 0:
+            DailyAccountBalance.refresh(self.rollup_start_dates)
+            self.rollup_start_dates = dict()
+
+
 class Journaler(models.Model):
 
     __metaclass__ = ABCMeta
 
-    _je_batch = list()  # type: List[JournalEntry]
     _link_names_of_relevant_children = None
-    _unbalanced_journal_entries = list()  # type: List[JournalEntry]
-    _grand_total_debits = Decimal(0.00)
-    _grand_total_credits = Decimal(0.00)
 
     frozen_in_journal = models.BooleanField(default=False,
         help_text="If true, the journal entries for this transaction are frozen and will not be modified.")
@@ -455,73 +742,34 @@ class Journaler(models.Model):
         relative_url = reverse(url_name, args=[str(self.id)])
         return "https://{}{}".format(PROD_HOST, relative_url)
 
-    @classmethod
-    def save_je_batch(cls):
-        """
-        Save the currently batched JournalEntry instances using bulk_create,
-        and stage the associated pre-batched JournalEntryLineItems for batch creation.
-        """
-        # NOTE: As of 1/18/2016, this will only work in Django version 1.10 with Postgres
-        JournalEntry.objects.bulk_create(cls._je_batch)
-        for je in cls._je_batch:
-            je.process_prebatch()
-        cls._je_batch = []
-
-    @classmethod
-    def batch(cls, je: JournalEntry):
-        """Adds a JournalEntry instance to the batch that's accumulating for eventual bulk_create."""
-        balance = DEC0
-        for jeli in je.prebatched_lineitems:
-            if jeli.iscredit():
-                balance += jeli.amount
-                cls._grand_total_credits += jeli.amount
-            else:
-                balance -= jeli.amount
-                cls._grand_total_debits += jeli.amount
-        if abs(balance) > Decimal("0.05"):  # Don't report *small* errors due to rounding.
-            cls._unbalanced_journal_entries.append(je)
-            je.unbalanced = True
-        cls._je_batch.append(je)
-        if len(cls._je_batch) > 1000:
-            cls.save_je_batch()
-        return je
+    @staticmethod
+    def batch(je: JournalEntry) -> JournalEntry:
+        """Adds a JournalEntry instance to the current JournalBatch session."""
+        return JournalBatch.current().batch(je)
 
     def journal_one_transaction(self):
         """
         Create and save journal entries for this one transaction.
         Intended to be used after a transaction is created or updated in admin.
         """
-        JournalEntry.objects.filter(source_url=self.get_absolute_url()).delete()
-        self.create_journalentry()
-        Journaler.save_je_batch()
-        JournalLiner.save_jeli_batch()
-
-    @classmethod
-    def get_unbalanced_journal_entries(cls):
-        return cls._unbalanced_journal_entries
+        with JournalBatch() as batch:
+            batch.delete_entries([self.get_absolute_url()])
+            self.create_journalentry()
+        DirtyJournaler.clear(self)
 
 
 class JournalLiner(object):
     __metaclass__ = ABCMeta
 
-    _jeli_batch = list()  # type:List[JournalEntryLineItem]
-
     # Each journal liner will have its own logic for creating its line items in the specified entry.
     @abstractmethod
     def create_journalentry_lineitems(self, je: JournalEntry):
         raise NotImplementedError
 
-    @classmethod
-    def save_jeli_batch(cls):
-        created = JournalEntryLineItem.objects.bulk_create(cls._jeli_batch)
-        cls._jeli_batch = []
-
-    @classmethod
-    def batch_jeli(cls, jeli: JournalEntryLineItem):
-        cls._jeli_batch.append(jeli)
-        if len(cls._jeli_batch) > 1000:
-            cls.save_jeli_batch()
-        return jeli
+    @staticmethod
+    def batch_jeli(jeli: JournalEntryLineItem) -> JournalEntryLineItem:
+        """Adds a JournalEntryLineItem instance to the current JournalBatch session."""
+        return JournalBatch.current().batch_jeli(jeli)
 
 
 registered_journaler_classes = []  # type: List[Journaler]
@@ -537,6 +785,152 @@ def register_journaler():
     return _decorator
 
 
+_journaler_parent_fields = dict()  # type: Dict[type, List[models.ForeignKey]]
+
+
+def journaler_parent_fields(model_class) -> List[models.ForeignKey]:
+    """
+    Returns the FKs through which instances of model_class contribute to a Journaler's journal entries.
+    Links marked 'is_not_parent' refer to PEER transactions, so they aren't included.
+    """
+    if model_class not in _journaler_parent_fields:
+        fields = []  # type: List[models.ForeignKey]
+        if not issubclass(model_class, (Journaler, Note)):
+            for f in model_class._meta.get_fields():
+                if f.many_to_one and f.concrete \
+                  and not hasattr(f, 'is_not_parent') \
+                  and f.related_model in registered_journaler_classes:
+                    fields.append(f)
+        _journaler_parent_fields[model_class] = fields
+    return _journaler_parent_fields[model_class]
+
+
+class DirtyJournaler(models.Model):
+    """
+    Marks a Journaler whose journal entries need to be regenerated.
+    Markers are set by signal handlers and consumed by the generatejournal command.
+    """
+
+    content_type = models.ForeignKey(ContentType, null=False, blank=False,
+        on_delete=models.CASCADE,
+        help_text="The type of the journaler that changed.")
+
+    object_id = models.PositiveIntegerField(null=False, blank=False,
+        help_text="The id of the journaler that changed. It might have been deleted since.")
+
+    when_marked = models.DateTimeField(null=False, blank=False,
+        help_text="The last time at which the journaler was marked dirty.")
+
+    @staticmethod
+    def mark(journaler_class, journaler_id: int) -> None:
+        DirtyJournaler.objects.update_or_create(
+            content_type=ContentType.objects.get_for_model(journaler_class),
+            object_id=journaler_id,
+            defaults={'when_marked': timezone.now()}
+        )
+
+    @staticmethod
+    def mark_all(journaler_class, journaler_ids: List[int]) -> None:
+        """Like mark(), but for many journalers of the same class, in a fixed number of queries."""
+        journaler_ids = set(id for id in journaler_ids if id is not None)
+        if len(journaler_ids) == 0:
+            return
+        now = timezone.now()
+        content_type = ContentType.objects.get_for_model(journaler_class)
+        markers = DirtyJournaler.objects.filter(content_type=content_type, object_id__in=journaler_ids)
+        already_marked = set(markers.values_list('object_id', flat=True))
+        markers.update(when_marked=now)
+        DirtyJournaler.objects.bulk_create([
+            DirtyJournaler(content_type=content_type, object_id=id, when_marked=now)
+            for id in journaler_ids - already_marked
+        ])
+
+    @staticmethod
+    def clear(journaler: Journaler) -> None:
+        DirtyJournaler.objects.filter(
+            content_type=ContentType.objects.get_for_model(journaler.__class__),
+            object_id=journaler.id
+        ).delete()
+
+    def __str__(self):
+        return "{} #{}".format(self.content_type.model_class().__name__, self.object_id)
+
+    class Meta:
+        unique_together = ('content_type', 'object_id')
+
+
+class DailyAccountBalance(models.Model):
+    """
+    A rollup of the journal: the total increases and decreases to an account on a given day,
+    and the account's running balance at the end of that day. There's only a row for days with activity.
+    Rows are maintained by JournalBatch sessions, so they shouldn't be edited by hand.
+    """
+
+    account = models.ForeignKey(Account, null=False, blank=False,
+        on_delete=models.CASCADE,
+        help_text="The account whose activity is summarized.")
+
+    when = models.DateField(null=False, blank=False,
+        help_text="The day whose activity is summarized.")
+
+    increases = models.DecimalField(max_digits=12, decimal_places=2, null=False, blank=False,
+        help_text="The total of the day's increases to the account.")
+
+    decreases = models.DecimalField(max_digits=12, decimal_places=2, null=False, blank=False,
+        help_text="The total of the day's decreases to the account.")
+
+    balance = models.DecimalField(max_digits=12, decimal_places=2, null=False, blank=False,
+        help_text="The account's balance at the end of the day, i.e. all increases less all decreases to date.")
+
+    @property
+    def net_change(self) -> Decimal:
+        return self.increases - self.decreases
+
+    @staticmethod
+    def refresh(start_dates: Optional[Dict[int, date]] = None) -> None:
+        """
+        Recalculates rollups from the journal. start_dates maps account ids to the date from which
+        their rollups should be recalculated. If it isn't provided, all rollups are recalculated.
+        """
+        bump_cache_generation(CASH_DATA_GENERATION_KEY)
+
+        if start_dates is None:
+            DailyAccountBalance.objects.all().delete()
+            DailyAccountBalance._rollup(JournalEntryLineItem.objects.all(), dict())
+            return
+
+        for account_id, start_date in start_dates.items():
+            prior = DailyAccountBalance.objects.filter(account_id=account_id, when__lt=start_date).last()
+            DailyAccountBalance.objects.filter(account_id=account_id, when__gte=start_date).delete()
+            jelis = JournalEntryLineItem.objects.filter(account_id=account_id, journal_entry__when__gte=start_date)
+            DailyAccountBalance._rollup(jelis, {account_id: prior.balance if prior is not None else DEC0})
+
+    @staticmethod
+    def _rollup(jelis, opening_balances: Dict[int, Decimal]) -> None:
+        sums = jelis.values('account_id', 'journal_entry__when', 'action').annotate(total=Sum('amount'))
+        sums = sums.order_by('account_id', 'journal_entry__when')
+        rows = []  # type: List[DailyAccountBalance]
+        for s in sums:
+            acct_id, when = s['account_id'], s['journal_entry__when']
+            if len(rows) == 0 or rows[-1].account_id != acct_id or rows[-1].when != when:
+                rows.append(DailyAccountBalance(account_id=acct_id, when=when, increases=DEC0, decreases=DEC0))
+            if s['action'] == JournalEntryLineItem.ACTION_BALANCE_INCREASE:
+                rows[-1].increases += s['total']
+            else:
+                rows[-1].decreases += s['total']
+        for row in rows:
+            row.balance = opening_balances.get(row.account_id, DEC0) + row.net_change
+            opening_balances[row.account_id] = row.balance
+        DailyAccountBalance.objects.bulk_create(rows, batch_size=1000)
+
+    def __str__(self):
+        return "{} on {}".format(self.account, self.when)
+
+    class Meta:
+        unique_together = ('account', 'when')
+        ordering = ['when']
+
+
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 # BUDGET
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
@@ -926,6 +1320,139 @@ class PayableInvoiceLineItem(InvoiceLineItem, JournalLiner):
         ))
 
 
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+# PAYER MATCHING (used by Sale.link_to_user)
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+
+class PayerMatcher(object):
+    """
+    Finds the users that might have paid for a sale. This version queries the DB for each lookup.
+    See PayerIndex for a version that's better suited to linking many sales.
+    """
+
+    def users_with_email(self, email: str) -> List[User]:
+        return list(User.objects.filter(email__iexact=email, is_active=True))
+
+    def users_with_external_id(self, uid: str) -> List[User]:
+        from members.models import ExternalId  # import here to avoid circular dependency.
+        extids = ExternalId.objects.filter(uid=uid).select_related('user')
+        return list(set([x.user for x in extids]))  # Using set to remove duplicates.
+
+    def users_with_name(self, fname: str, lname: str) -> List[User]:
+        return list(User.objects.filter(first_name__iexact=fname, last_name__iexact=lname, is_active=True))
+
+
+class PayerIndex(PayerMatcher):
+    """
+    An in-memory index of users by email, ExternalId uid, and first/last name, built with two queries.
+    It's built on its first lookup, so an index that no sale ends up needing costs nothing.
+    While an index is active (as a context manager), Sale.link_to_user() uses it instead of querying the DB.
+    Signal handlers keep active indexes up to date as users and external ids are saved or deleted,
+    so an index can be kept and reentered, e.g. by a loader for each of its chunks.
+    An index is only active in the thread that entered it, e.g. one of the loader threads of "etl --parallel".
+    Indexes aren't shared between processes.
+    """
+
+    _local = threading.local()  # Its "active" attribute is the thread's stack of active indexes.
+
+    def __init__(self):
+        self.built = False
+        self.users = dict()  # type: Dict[int, User]
+        self.by_email = dict()  # type: Dict[str, Dict[int, User]]
+        self.by_name = dict()  # type: Dict[Tuple[str, str], Dict[int, User]]
+        self.by_uid = dict()  # type: Dict[str, Dict[int, int]]  # uid -> ExternalId pk -> User pk
+        self.extid_uids = dict()  # type: Dict[int, str]  # ExternalId pk -> uid
+
+    def _build(self) -> None:
+        from members.models import ExternalId  # import here to avoid circular dependency.
+        if self.built:
+            return
+        self.built = True
+        for user in User.objects.all():
+            self.add_user(user)
+        for extid_pk, uid, user_pk in ExternalId.objects.values_list('pk', 'uid', 'user_id'):
+            self.add_external_id(extid_pk, uid, user_pk)
+
+    @classmethod
+    def _active(cls) -> List['PayerIndex']:
+        if not hasattr(cls._local, 'active'):
+            cls._local.active = []
+        return cls._local.active
+
+    @classmethod
+    def current(cls) -> Optional['PayerIndex']:
+        active = cls._active()
+        return active[-1] if len(active) > 0 else None
+
+    @classmethod
+    def active_indexes(cls) -> List['PayerIndex']:
+        """The indexes that are active in this thread."""
+        return list(cls._active())
+
+    def __enter__(self) -> 'PayerIndex':
+        PayerIndex._active().append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        PayerIndex._active().remove(self)
+
+    @staticmethod
+    def _name_key(fname: str, lname: str) -> Tuple[str, str]:
+        return fname.lower(), lname.lower()
+
+    def remove_user(self, user_pk: int) -> None:
+        if not self.built:
+            return  # It will be read from the DB when the index is built.
+        old = self.users.pop(user_pk, None)
+        if old is None:
+            return
+        for index, key in [(self.by_email, old.email.lower()), (self.by_name, self._name_key(old.first_name, old.last_name))]:
+            matches = index.get(key, {})
+            matches.pop(user_pk, None)
+            if len(matches) == 0:
+                index.pop(key, None)
+
+    def add_user(self, user: User) -> None:
+        if not self.built:
+            return
+        self.remove_user(user.pk)
+        self.users[user.pk] = user
+        if user.is_active:
+            self.by_email.setdefault(user.email.lower(), dict())[user.pk] = user
+            self.by_name.setdefault(self._name_key(user.first_name, user.last_name), dict())[user.pk] = user
+
+    def remove_external_id(self, extid_pk: int) -> None:
+        if not self.built:
+            return
+        uid = self.extid_uids.pop(extid_pk, None)
+        if uid is None:
+            return
+        matches = self.by_uid[uid]
+        matches.pop(extid_pk, None)
+        if len(matches) == 0:
+            self.by_uid.pop(uid)
+
+    def add_external_id(self, extid_pk: int, uid: str, user_pk: int) -> None:
+        if not self.built:
+            return
+        self.remove_external_id(extid_pk)
+        self.extid_uids[extid_pk] = uid
+        self.by_uid.setdefault(uid, dict())[extid_pk] = user_pk
+
+    def users_with_email(self, email: str) -> List[User]:
+        self._build()
+        return list(self.by_email.get(email.lower(), {}).values())
+
+    def users_with_external_id(self, uid: str) -> List[User]:
+        self._build()
+        user_pks = set(self.by_uid.get(uid, {}).values())
+        return [self.users[pk] for pk in user_pks if pk in self.users]
+
+    def users_with_name(self, fname: str, lname: str) -> List[User]:
+        self._build()
+        return list(self.by_name.get(self._name_key(fname, lname), {}).values())
+
+
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 # SALE (aka Income Transaction in Admin)
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
@@ -1008,53 +1535,45 @@ class Sale(Journaler):
     protected = models.BooleanField(default=False,
         help_text="Protect against further auto processing by ETL, etc. Prevents overwrites of manually enetered data.")
 
+    etl_hash = models.CharField(max_length=40, null=False, blank=True, default="",
+        help_text="Hash of the data that ETL last loaded into this record. ETL skips records whose hash is unchanged.")
+
     def link_to_user(self) -> bool:
 
         if self.protected:
             return False
 
+        # Use the active PayerIndex, if there is one, to avoid querying the DB for each lookup.
+        matcher = PayerIndex.current() or PayerMatcher()
+
         # Attempt to match by Member's EMAIL ----------------------------------------
         if self.payer_email is not None and len(self.payer_email) > 0:
-            try:
-                email_matches = User.objects.filter(email__iexact=self.payer_email, is_active=True)
-                if len(email_matches) == 1:
-                    self.payer_acct = email_matches[0]
-                    return True
-                elif len(email_matches) > 1:
-                    logger.warning("Unable to link sale b/c multiple %s emails", self.payer_email)
-            except User.DoesNotExist:
-                pass
+            email_matches = matcher.users_with_email(self.payer_email)
+            if len(email_matches) == 1:
+                self.payer_acct = email_matches[0]
+                return True
+            elif len(email_matches) > 1:
+                logger.warning("Unable to link sale b/c multiple %s emails", self.payer_email)
 
         # Attempt to match by External IDs ----------------------------------------
         # E.g. PayPal uses email addrs as ids, so we can record them in ExternalIds and use them here.
-        from members.models import ExternalId  # import here to avoid circular dependency.
         if self.payer_email is not None and len(self.payer_email) > 0:
-            extids = ExternalId.objects.filter(uid=self.payer_email)
-            if len(extids) > 0:
-                users = set([x.user for x in extids])  # Using set to remove duplicates.
-                if len(users) > 1:
-                    logger.warning("Unable to link sale b/c multiple accounts for %", self.payer_email)
-                else:
-                    assert len(users) == 1
-                    self.payer_acct = list(users)[0]
-                    return True
+            users = matcher.users_with_external_id(self.payer_email)
+            if len(users) > 1:
+                logger.warning("Unable to link sale b/c multiple accounts for %s", self.payer_email)
+            elif len(users) == 1:
+                self.payer_acct = users[0]
+                return True
 
         # Attempt to match by NAME ----------------------------------------------
         def try_name(fname, lname):
             if fname is not None and lname is not None and len(fname + lname) > 0:
-                try:
-                    name_matches = User.objects.filter(
-                        first_name__iexact=fname,
-                        last_name__iexact=lname,
-                        is_active=True,
-                    )
-                    if len(name_matches) == 1:
-                        self.payer_acct = name_matches[0]
-                        return True
-                    elif len(name_matches) > 1:
-                        logger.warning("Unable to link sale b/c multiple %s %s accts", fname, lname)
-                except User.DoesNotExist:
-                    pass
+                name_matches = matcher.users_with_name(fname, lname)
+                if len(name_matches) == 1:
+                    self.payer_acct = name_matches[0]
+                    return True
+                elif len(name_matches) > 1:
+                    logger.warning("Unable to link sale b/c multiple %s %s accts", fname, lname)
             return False
         nameobj = HumanName(str(self.payer_name))
         if try_name(nameobj.first, nameobj.last):  # This is the usual European case.
@@ -1071,29 +1590,87 @@ class Sale(Journaler):
         unique_together = ('payment_method', 'ctrlid')
         verbose_name = "Income transaction"
 
-    def checksum(self) -> Decimal:
+    @classmethod
+    def line_item_relations(cls) -> list:
         """
-        :return: The sum total of all expense line items. Should match self.amount.
+        :return: The reverse relations from line item models to Sale.
         """
-        total = Decimal(0.0)
-
         # This is coded generically because the 'books' app doesn't know which models in other
         # apps will point back to a sale. So it looks for fields like "sale_price" and "qty_sold"
         # in all related models.
 
         # This is the new way to get_all_related_objects
         # per https://docs.djangoproject.com/en/1.10/ref/models/meta/
-        related_objects = [
-            f for f in self._meta.get_fields()
+        return [
+            f for f in cls._meta.get_fields()
               if (f.one_to_many or f.one_to_one)
               and f.auto_created
               and not f.concrete
+              and f.get_accessor_name() not in ['salenote_set', 'receivableinvoicereference_set']
         ]
-        link_names = [rel.get_accessor_name() for rel in related_objects]
-        for link_name in link_names:
-            if link_name in ['salenote_set', 'receivableinvoicereference_set']: continue
-            # TODO: Can a select_related or prefetch_related improve performance here?
-            line_items = getattr(self, link_name).all()
+
+    @classmethod
+    def line_item_totals(cls, sales: Optional[models.QuerySet] = None) -> Dict[int, Decimal]:
+        """
+        Computes the same totals as checksum(), but for many sales at once,
+        using one aggregate query per line item model instead of one query per relation per sale.
+        :param sales: The sales to total. All sales if None.
+        :return: A dict mapping sale ids to line item totals. Sales without line items are absent.
+        """
+        totals = dict()  # type: Dict[int, Decimal]
+        total_field = models.DecimalField(max_digits=12, decimal_places=2)
+
+        def add_totals(line_items: models.QuerySet, fk_name: str, line_total) -> None:
+            if sales is not None:
+                line_items = line_items.filter(**{fk_name+"__in": sales.values('pk')})
+            line_items = line_items.order_by().values(fk_name)
+            for row in line_items.annotate(total=Sum(line_total, output_field=total_field)):
+                sale_id = row[fk_name]
+                totals[sale_id] = totals.get(sale_id, DEC0) + row['total']
+
+        for rel in cls.line_item_relations():
+            line_item_class = rel.related_model
+            field_names = [f.name for f in line_item_class._meta.get_fields()]
+            if 'amount' in field_names:
+                line_total = F('amount')
+            elif 'sale_price' in field_names:
+                line_total = F('sale_price')
+            else:
+                continue
+            if 'qty_sold' in field_names:
+                # checksum() treats a missing or zero qty_sold as 1.
+                qty = Case(
+                    When(Q(qty_sold__isnull=True) | Q(qty_sold=0), then=Value(1)),
+                    default=F('qty_sold'),
+                    output_field=models.IntegerField()
+                )
+                line_total = line_total * qty
+            add_totals(line_item_class.objects.all(), rel.field.name, line_total)
+
+        add_totals(
+            ReceivableInvoiceReference.objects.all(), 'sale',
+            Coalesce('portion', 'invoice__amount')
+        )
+        return totals
+
+    @classmethod
+    def objs_for_dbcheck(cls) -> List['Sale']:
+        """
+        :return: All sales, with their line item totals precomputed for dbcheck().
+        """
+        totals = cls.line_item_totals()
+        sales = list(cls.objects.all())
+        for sale in sales:
+            sale.precomputed_checksum = totals.get(sale.pk, DEC0)
+        return sales
+
+    def checksum(self) -> Decimal:
+        """
+        :return: The sum total of all expense line items. Should match self.amount.
+        """
+        total = Decimal(0.0)
+        for rel in self.line_item_relations():
+            line_items = getattr(self, rel.get_accessor_name()).all()
             for line_item in line_items:
                 line_total = Decimal(0.0)
                 if hasattr(line_item, 'amount'): line_total += line_item.amount
@@ -1122,7 +1699,10 @@ class Sale(Journaler):
             raise ValidationError(_("Cash payments shouldn't have detail. Cash is cash."))
 
     def dbcheck(self):
-        sum = self.checksum()
+        # See objs_for_dbcheck() for the precomputed checksum.
+        sum = getattr(self, 'precomputed_checksum', None)
+        if sum is None:
+            sum = self.checksum()
         checksum_matches = sum == self.total_paid_by_customer \
          or sum == self.total_paid_by_customer - self.processing_fee
         if not checksum_matches:
@@ -1269,6 +1849,9 @@ class OtherItem(models.Model, JournalLiner):
     protected = models.BooleanField(default=False,
         help_text="Protect against further auto processing by ETL, etc. Prevents overwrites of manually entered data.")
 
+    etl_hash = models.CharField(max_length=40, null=False, blank=True, default="",
+        help_text="Hash of the data that ETL last loaded into this record. ETL skips records whose hash is unchanged.")
+
     def __str__(self):
         return self.type.name
 
@@ -1348,6 +1931,9 @@ class MonetaryDonation(models.Model, JournalLiner):
     protected = models.BooleanField(default=False,
         help_text="Protect against further auto processing by ETL, etc. Prevents overwrites of manually entered data.")
 
+    etl_hash = models.CharField(max_length=40, null=False, blank=True, default="",
+        help_text="Hash of the data that ETL last loaded into this record. ETL skips records whose hash is unchanged.")
+
     def __str__(self):
         return str("$"+str(self.amount))
 
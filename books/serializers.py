@@ -18,6 +18,7 @@ class SaleSerializer(serializers.ModelSerializer):
             'fee_payer',
             'ctrlid',
             'protected',
+            'etl_hash',
         )
 
 
@@ -64,6 +65,7 @@ class MonetaryDonationSerializer(serializers.ModelSerializer):
             'earmark',
             'ctrlid',
             'protected',
+            'etl_hash',
         )
 
 
@@ -78,6 +80,7 @@ class OtherItemSerializer(serializers.ModelSerializer):
             'qty_sold',
             'ctrlid',
             'protected',
+            'etl_hash',
         )
 
 
@@ -2,15 +2,70 @@
 # Standard
 
 # Third Party
-from django.db.models.signals import pre_save
+from django.db import transaction
+from django.db.models import Value
+from django.db.models.functions import Concat, Substr
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
+from django.contrib.auth.models import User
 
 # Local
-from books.models import Sale, MonetaryDonation, Campaign
+from abutils.utils import bump_cache_generation
+from books.models import (
+    Account, Sale, MonetaryDonation, Campaign, BankAccountBalance,
+    DirtyJournaler, PayerIndex, CASH_DATA_GENERATION_KEY,
+    registered_journaler_classes, journaler_parent_fields,
+)
 
 __author__ = 'Adrian'
 
 
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# ACCOUNT
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+@receiver(post_save, sender=Account)
+def update_account_paths(sender, **kwargs):
+    """Keeps Account.path up to date for this account and, if it moved, for all of its subaccounts."""
+    acct = kwargs.get('instance')  # type: Account
+    parent_path = None
+    if acct.parent_id is not None:
+        parent_path = Account.objects.filter(pk=acct.parent_id).values_list('path', flat=True).first()
+        if not parent_path:
+            return  # Parent isn't in the DB yet, as can happen while loading fixtures. See below.
+    new_path = Account.path_for(parent_path, acct.pk)
+    if new_path != acct.path:
+        if acct.path == "":
+            Account.objects.filter(pk=acct.pk).update(path=new_path)
+        else:
+            # Replace the old path prefix of every account in the subtree, this one included.
+            Account.objects.filter(path__startswith=acct.path).update(
+                path=Concat(Value(new_path), Substr('path', len(acct.path)+1))
+            )
+        acct.path = new_path
+    # Accounts that were saved before their parents had paths get theirs once the parents do.
+    if Account.objects.filter(path="").exists():
+        Account.rebuild_paths()
+
+
+@receiver(post_save, sender=Account)
+@receiver(post_delete, sender=Account)
+def invalidate_account_cache(sender, **kwargs):
+    Account.invalidate_acct_cache()
+    # Bump again after the commit, in case another process reloaded the old version in the meantime.
+    transaction.on_commit(Account.invalidate_acct_cache)
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# BANK ACCOUNT BALANCE
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+@receiver(post_save, sender=BankAccountBalance)
+@receiver(post_delete, sender=BankAccountBalance)
+def invalidate_cash_data(sender, **kwargs):
+    bump_cache_generation(CASH_DATA_GENERATION_KEY)
+
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 # SALE
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
@@ -24,6 +79,38 @@ def link_sale_to_user(sender, **kwargs):
             sale.link_to_user()
 
 
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# PAYER INDEX
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+@receiver(post_save, sender=User)
+def index_payer_user(sender, **kwargs):
+    user = kwargs.get('instance')  # type: User
+    for index in PayerIndex.active_indexes():
+        index.add_user(user)
+
+
+@receiver(post_delete, sender=User)
+def unindex_payer_user(sender, **kwargs):
+    user = kwargs.get('instance')  # type: User
+    for index in PayerIndex.active_indexes():
+        index.remove_user(user.pk)
+
+
+@receiver(post_save, sender='members.ExternalId')
+def index_payer_external_id(sender, **kwargs):
+    extid = kwargs.get('instance')
+    for index in PayerIndex.active_indexes():
+        index.add_external_id(extid.pk, extid.uid, extid.user_id)
+
+
+@receiver(post_delete, sender='members.ExternalId')
+def unindex_payer_external_id(sender, **kwargs):
+    extid = kwargs.get('instance')
+    for index in PayerIndex.active_indexes():
+        index.remove_external_id(extid.pk)
+
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 # MONETARY DONATION
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
@@ -38,3 +125,43 @@ def link_donation_to_campaign(sender, **kwargs):
     except Campaign.DoesNotExist:
         pass
 
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# JOURNAL
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+# These receivers aren't restricted to a sender because journalers and their
+# children are spread across apps. They return quickly for unrelated models.
+
+def _mark_parents_dirty(instance, attvalues) -> None:
+    for field, parent_id in zip(journaler_parent_fields(instance.__class__), attvalues):
+        if parent_id is not None:
+            DirtyJournaler.mark(field.related_model, parent_id)
+
+
+@receiver(pre_save)
+def mark_prior_journaler_dirty(sender, **kwargs):
+    """If a child is moved from one journaler to another, the one it left also needs new journal entries."""
+    instance = kwargs.get('instance')
+    if kwargs.get('raw', False) or instance.pk is None:
+        return
+    fields = journaler_parent_fields(sender)
+    if len(fields) == 0:
+        return
+    old_values = sender.objects.filter(pk=instance.pk).values_list(*[f.attname for f in fields]).first()
+    if old_values is not None:
+        _mark_parents_dirty(instance, old_values)
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def mark_journaler_dirty(sender, **kwargs):
+    if kwargs.get('raw', False):
+        return
+    instance = kwargs.get('instance')
+    if sender in registered_journaler_classes:
+        DirtyJournaler.mark(sender, instance.pk)
+    else:
+        fields = journaler_parent_fields(sender)
+        _mark_parents_dirty(instance, [getattr(instance, f.attname) for f in fields])
@@ -2,18 +2,28 @@
 # Standard
 from decimal import Decimal
 from datetime import date
+import random
+import threading
 
 # Third Party
+import numpy as np
 from django.test import TestCase
 from django.core.exceptions import ValidationError
 from django.core.management import call_command
+from django.core.cache import cache
+from django.contrib.auth.models import User
+from django.urls import reverse
 
 # Local
 from books.models import (
-    MonetaryDonation, Sale,
-    JournalEntry, JournalEntryLineItem,
-    Account
+    MonetaryDonation, Sale, OtherItem, OtherItemType, PayerIndex,
+    JournalEntry, JournalEntryLineItem, JournalBatch,
+    Account, DirtyJournaler, DailyAccountBalance,
+    _copy_value
 )
+from books.management.commands.generatejournal import pk_range_shards
+from books.views import count_crossings, fit_offset
+from abutils.utils import bump_cache_generation, get_cache_generation
 
 
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =]
@@ -34,6 +44,100 @@ class TestMonetaryDonation(TestCase):
         self.assertTrue(sum, 100)
 
 
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =]
+
+class TestSaleChecksum(TestCase):
+
+    fixtures = ['test_data']
+
+    def setUp(self):
+        itype = OtherItemType.objects.create(name="Sticker", description="A sticker", revenue_acct_id=1)
+        self.sale1 = Sale.objects.create(total_paid_by_customer=110)
+        MonetaryDonation.objects.create(sale=self.sale1, amount=100)
+        OtherItem.objects.create(sale=self.sale1, type=itype, sale_price=5, qty_sold=2)
+        self.sale2 = Sale.objects.create(total_paid_by_customer=20)
+        OtherItem.objects.create(sale=self.sale2, type=itype, sale_price=3, qty_sold=None)  # Counts as 1.
+        self.sale3 = Sale.objects.create(total_paid_by_customer=0)
+
+    def test_line_item_totals_match_checksum(self):
+        totals = Sale.line_item_totals()
+        for sale in [self.sale1, self.sale2, self.sale3]:
+            self.assertEqual(totals.get(sale.pk, Decimal("0.00")), sale.checksum())
+        self.assertEqual(totals[self.sale1.pk], Decimal("110.00"))
+        self.assertNotIn(self.sale3.pk, totals)
+
+    def test_line_item_totals_for_some_sales(self):
+        totals = Sale.line_item_totals(Sale.objects.filter(pk=self.sale2.pk))
+        self.assertEqual(totals, {self.sale2.pk: Decimal("3.00")})
+
+    def test_dbcheck_uses_precomputed_totals(self):
+        sales = {sale.pk: sale for sale in Sale.objs_for_dbcheck()}
+        sales[self.sale1.pk].dbcheck()
+        sales[self.sale3.pk].dbcheck()
+        with self.assertNumQueries(0):
+            self.assertRaises(ValidationError, sales[self.sale2.pk].dbcheck)
+
+
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =]
+
+class TestPayerIndex(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username="alice", first_name="Alice", last_name="Smith", email="Alice@Example.com")
+        self.bob = User.objects.create(username="bob", first_name="Bob", last_name="Jones")
+        self.bob2 = User.objects.create(username="bob2", first_name="bob", last_name="jones")
+
+    def link(self, sale: Sale):
+        return sale.payer_acct if sale.link_to_user() else None
+
+    def test_index_matches_like_queries(self):
+        cases = [
+            dict(payer_email="alice@example.COM"),
+            dict(payer_name="ALICE SMITH"),
+            dict(payer_name="Bob Jones"),  # Ambiguous.
+            dict(payer_name="Carol King"),
+        ]
+        expected = [self.link(Sale(**case)) for case in cases]
+        self.assertEqual(expected, [self.alice, self.alice, None, None])
+        sales = [Sale(**case) for case in cases]
+        with PayerIndex():
+            with self.assertNumQueries(2):  # It's built by the first lookup.
+                actual = [self.link(sale) for sale in sales]
+        self.assertEqual(actual, expected)
+
+    def test_index_is_built_when_needed(self):
+        with PayerIndex() as index:
+            with self.assertNumQueries(0):
+                PayerIndex()
+            carol = User.objects.create(username="carol", first_name="Carol", last_name="King")
+            self.assertFalse(index.built)
+            self.assertEqual(self.link(Sale(payer_name="Carol King")), carol)  # Read when it was built.
+            sale = Sale(payer_name="Alice Smith")
+            with self.assertNumQueries(0):
+                self.assertEqual(self.link(sale), self.alice)
+
+    def test_index_follows_changes(self):
+        from members.models import ExternalId
+        with PayerIndex():
+            self.bob2.is_active = False
+            self.bob2.save()
+            self.assertEqual(self.link(Sale(payer_name="Bob Jones")), self.bob)
+            ExternalId.objects.create(user=self.bob, provider="paypal", uid="bob@paypal.example")
+            self.assertEqual(self.link(Sale(payer_email="bob@paypal.example")), self.bob)
+            self.alice.delete()
+            self.assertIsNone(self.link(Sale(payer_email="alice@example.com")))
+
+    def test_index_is_per_thread(self):
+        seen = []
+        with PayerIndex() as index:
+            other = threading.Thread(target=lambda: seen.append(PayerIndex.current()))
+            other.start()
+            other.join()
+            self.assertIs(PayerIndex.current(), index)
+        self.assertEqual(seen, [None])
+        self.assertIsNone(PayerIndex.current())
+
+
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =]
 
 class TestJournalEntries(TestCase):
@@ -120,3 +224,280 @@ class TestJournalEntries(TestCase):
     def test_generate(self):
         # TODO: generatejournal should have a test mode that raises exceptions?
         call_command("generatejournal")
+
+
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =]
+
+class TestIncrementalJournal(TestCase):
+
+    fixtures = ['test_data']
+
+    def setUp(self):
+        self.sale = Sale.objects.create(total_paid_by_customer=100)
+        self.mdon = MonetaryDonation.objects.create(sale=self.sale, amount=100)
+        call_command("generatejournal", "--full")
+
+    def donation_amounts(self):
+        return list(JournalEntryLineItem.objects.filter(
+            journal_entry__source_url=self.sale.get_absolute_url(),
+            account_id=35
+        ).values_list("amount", flat=True))
+
+    def test_full_clears_markers(self):
+        self.assertEqual(DirtyJournaler.objects.count(), 0)
+        self.assertEqual(self.donation_amounts(), [Decimal("100.00")])
+
+    def test_child_change_marks_parent(self):
+        self.mdon.amount = 60
+        self.mdon.save()
+        self.assertEqual(DirtyJournaler.objects.get().object_id, self.sale.pk)
+        other_sale = Sale.objects.create(total_paid_by_customer=60)
+        DirtyJournaler.objects.filter(object_id=other_sale.pk).delete()
+        call_command("generatejournal")
+        self.assertEqual(self.donation_amounts(), [Decimal("60.00")])
+        self.assertFalse(JournalEntry.objects.filter(source_url=other_sale.get_absolute_url()).exists())
+        self.assertEqual(DirtyJournaler.objects.count(), 0)
+
+    def test_deleted_journaler(self):
+        url = self.sale.get_absolute_url()
+        self.sale.delete()
+        call_command("generatejournal")
+        self.assertFalse(JournalEntry.objects.filter(source_url=url).exists())
+
+
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =]
+
+class TestJournalBatch(TestCase):
+
+    fixtures = ['test_data']
+
+    def test_session_totals(self):
+        sale = Sale.objects.create(total_paid_by_customer=100)
+        MonetaryDonation.objects.create(sale=sale, amount=90)  # Doesn't balance.
+        with JournalBatch() as batch:
+            sale.create_journalentry()
+        self.assertEqual(batch.grand_total_debits, Decimal("100.00"))
+        self.assertEqual(batch.grand_total_credits, Decimal("90.00"))
+        self.assertEqual(len(batch.unbalanced_journal_entries), 1)
+        self.assertEqual(JournalEntryLineItem.objects.count(), 2)
+
+    def test_batching_requires_session(self):
+        self.assertRaises(AssertionError, JournalBatch.current)
+
+    def test_session_is_per_thread(self):
+        seen = []
+
+        def other_thread():
+            try:
+                seen.append(JournalBatch.current())
+            except AssertionError:
+                seen.append(None)
+        with JournalBatch() as batch:
+            other = threading.Thread(target=other_thread)
+            other.start()
+            other.join()
+            self.assertIs(JournalBatch.current(), batch)
+        self.assertEqual(seen, [None])
+
+    def test_bulk_create_fallback(self):
+        sale = Sale.objects.create(total_paid_by_customer=100)
+        MonetaryDonation.objects.create(sale=sale, amount=100)
+        with JournalBatch(use_copy=False) as batch:
+            sale.create_journalentry()
+        self.assertEqual(batch.writer_name, "bulk_create")
+        self.assertEqual(batch.rows_written, 3)  # One entry and two line items.
+        self.assertEqual(JournalEntry.objects.count(), 1)
+
+    def test_copy_value(self):
+        self.assertEqual(_copy_value(None), "\\N")
+        self.assertEqual(_copy_value(True), "t")
+        self.assertEqual(_copy_value(date(2018, 1, 5)), "2018-01-05")
+        self.assertEqual(_copy_value(Decimal("12.50")), "12.50")
+        self.assertEqual(_copy_value("a\tb\nc\\d"), "a\\tb\\nc\\\\d")
+
+    def test_pk_range_shards(self):
+        self.assertEqual(pk_range_shards([], 4), [])
+        self.assertEqual(pk_range_shards([3, 5, 8, 9, 20], 2), [(3, 8), (9, 20)])
+        self.assertEqual(pk_range_shards([1, 2, 3], 8), [(1, 1), (2, 2), (3, 3)])
+
+
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =]
+
+class TestDailyAccountBalance(TestCase):
+
+    fixtures = ['test_data']
+
+    def setUp(self):
+        self.sale1 = Sale.objects.create(total_paid_by_customer=100, sale_date=date(2018, 1, 5))
+        MonetaryDonation.objects.create(sale=self.sale1, amount=100)
+        self.sale2 = Sale.objects.create(total_paid_by_customer=30, sale_date=date(2018, 1, 9))
+        self.mdon2 = MonetaryDonation.objects.create(sale=self.sale2, amount=30)
+        call_command("generatejournal", "--full")
+
+    def balances(self, acct_id):
+        return [(d.when, d.increases, d.balance) for d in DailyAccountBalance.objects.filter(account_id=acct_id)]
+
+    def test_full_rollup(self):
+        self.assertEqual(self.balances(1), [
+            (date(2018, 1, 5), Decimal("100.00"), Decimal("100.00")),
+            (date(2018, 1, 9), Decimal("30.00"), Decimal("130.00")),
+        ])
+
+    def test_incremental_rollup(self):
+        self.sale1.sale_date = date(2018, 1, 10)
+        self.sale1.total_paid_by_customer = 50
+        self.sale1.save()
+        call_command("generatejournal")
+        self.assertEqual(self.balances(1), [
+            (date(2018, 1, 9), Decimal("30.00"), Decimal("30.00")),
+            (date(2018, 1, 10), Decimal("50.00"), Decimal("80.00")),
+        ])
+
+    def test_journal_one_transaction(self):
+        self.mdon2.amount = 20
+        self.mdon2.save()
+        self.sale2.journal_one_transaction()
+        self.assertEqual(self.balances(35), [
+            (date(2018, 1, 5), Decimal("100.00"), Decimal("100.00")),
+            (date(2018, 1, 9), Decimal("20.00"), Decimal("120.00")),
+        ])
+
+
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =]
+
+class TestAccountHierarchy(TestCase):
+
+    def make_acct(self, name, parent=None):
+        return Account.objects.create(
+            name=name, parent=parent,
+            category=Account.CAT_ASSET, type=Account.TYPE_DEBIT,
+            description=name
+        )
+
+    def setUp(self):
+        self.cash = self.make_acct("Cash")
+        self.bank = self.make_acct("Bank", self.cash)
+        self.checking = self.make_acct("Checking", self.bank)
+        self.drawer = self.make_acct("Drawer", self.cash)
+        self.other = self.make_acct("Other")
+
+    def test_paths(self):
+        self.checking.refresh_from_db()
+        self.assertEqual(self.checking.path, "/{}/{}/{}/".format(self.cash.pk, self.bank.pk, self.checking.pk))
+        self.assertTrue(self.checking.is_subaccount_of(self.cash))
+        self.assertFalse(self.cash.is_subaccount_of(self.cash))
+        self.assertFalse(self.checking.is_subaccount_of(self.drawer))
+
+    def test_subaccounts_in_tree_order(self):
+        self.assertEqual(self.cash.subaccounts, [self.bank, self.checking, self.drawer])
+
+    def test_move_subtree(self):
+        self.bank.parent = self.other
+        self.bank.save()
+        self.checking.refresh_from_db()
+        self.assertEqual(self.checking.path, "/{}/{}/{}/".format(self.other.pk, self.bank.pk, self.checking.pk))
+        self.assertEqual(self.cash.subaccounts, [self.drawer])
+        self.assertEqual(list(self.other.subtree), [self.bank, self.checking, self.other])
+
+    def test_paths_repaired_when_parent_gets_one(self):
+        # As when fixtures load subaccounts before their parents.
+        Account.objects.filter(pk__in=[self.cash.pk, self.bank.pk, self.checking.pk]).update(path="")
+        self.bank.refresh_from_db()
+        self.assertEqual(list(self.bank.subtree), [self.bank, self.checking])
+        self.cash.save()
+        self.checking.refresh_from_db()
+        self.assertEqual(self.checking.path, "/{}/{}/{}/".format(self.cash.pk, self.bank.pk, self.checking.pk))
+
+    def test_account_browser_without_paths(self):
+        Account.objects.update(path="")
+        User.objects.create_user(username="browser", password="pw4browser")
+        self.client.login(username="browser", password="pw4browser")
+        response = self.client.get(reverse("book:account-browser"))
+        self.assertEqual(response.context['asset_accts'], [self.cash, self.bank, self.checking, self.drawer, self.other])
+
+    def test_rebuild_paths(self):
+        Account.objects.filter(pk=self.drawer.pk).update(path="/bogus/")
+        self.assertEqual(Account.rebuild_paths(), 1)
+        self.assertEqual(Account.rebuild_paths(), 0)
+        self.drawer.refresh_from_db()
+        self.assertEqual(self.drawer.path, "/{}/{}/".format(self.cash.pk, self.drawer.pk))
+
+
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =]
+
+class TestAccountCache(TestCase):
+
+    fixtures = ['test_data']
+
+    def setUp(self):
+        Account.invalidate_acct_cache()
+        Account.acct_cache_stats.clear()
+
+    def test_hits_dont_query(self):
+        Account.get(1)
+        with self.assertNumQueries(0):
+            acct = Account.get(1)
+        self.assertEqual(acct.name, "Cash")
+        self.assertEqual(Account.acct_cache_stats['misses'], 1)
+        self.assertEqual(Account.acct_cache_stats['hits'], 1)
+
+    def test_save_invalidates(self):
+        acct = Account.get(1)
+        acct.name = "Cash on Hand"
+        acct.save()
+        self.assertEqual(Account.get(1).name, "Cash on Hand")
+
+    def test_other_process_edit(self):
+        Account.get(1)
+        # Simulate another process editing the account and bumping the shared generation.
+        Account.objects.filter(id=1).update(name="Petty Cash")
+        bump_cache_generation(Account.ACCT_CACHE_GENERATION_KEY)
+        self.assertEqual(Account.get(1).name, "Cash")  # Not checked again yet.
+        Account.acct_cache_checked -= Account.ACCT_CACHE_CHECK_SECS
+        self.assertEqual(Account.get(1).name, "Petty Cash")
+        self.assertEqual(Account.acct_cache_stats['invalidations'], 1)
+
+    def test_lost_generation_isnt_reissued(self):
+        cache.delete(Account.ACCT_CACHE_GENERATION_KEY)
+        Account.invalidate_acct_cache()
+        Account.get(1)
+        held = Account.acct_cache_generation
+        Account.objects.filter(id=1).update(name="Petty Cash")
+        cache.delete(Account.ACCT_CACHE_GENERATION_KEY)  # E.g. culled from the cache.
+        bump_cache_generation(Account.ACCT_CACHE_GENERATION_KEY)
+        self.assertNotEqual(get_cache_generation(Account.ACCT_CACHE_GENERATION_KEY), held)
+        Account.acct_cache_checked -= Account.ACCT_CACHE_CHECK_SECS
+        self.assertEqual(Account.get(1).name, "Petty Cash")
+
+
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =]
+
+class TestCashOnHandFit(TestCase):
+
+    def looped_crossings(self, bs, cs, offset):
+        """The original, unvectorized, crossing count."""
+        crossings = 0
+        r = (bs - (cs + offset))
+        for i in range(1, len(bs)):
+            if r[i-1] == 0 or r[i] == 0:
+                continue
+            if r[i-1]/abs(r[i-1]) != r[i]/abs(r[i]):
+                crossings += 1
+        return crossings
+
+    def setUp(self):
+        random.seed(1)
+        self.bs = np.array([float(random.randrange(5000, 9000)) for _ in range(200)])
+        self.cs = self.bs - 3000 + np.array([float(random.randrange(-400, 400)) for _ in range(200)])
+
+    def test_crossings_match_loop(self):
+        offsets = np.arange(2000, 4000, 100)
+        expected = [self.looped_crossings(self.bs, self.cs, offset) for offset in offsets]
+        self.assertEqual(list(count_crossings(self.bs, self.cs, offsets)), expected)
+
+    def test_fit(self):
+        coarse = fit_offset(self.bs, self.cs)
+        self.assertEqual(coarse % 100, 0)
+        self.assertAlmostEqual(coarse, 3000, delta=200)
+        fine = fit_offset(self.bs, self.cs, fine=True)
+        self.assertLess(abs(fine-coarse), 100)
@@ -18,18 +18,22 @@ from django.views.decorators.csrf import csrf_exempt
 from django.contrib.auth import settings
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
+from django.db.models import Sum
+from django.core.cache import cache
 import requests
+import numpy as np
 from numpy import array
 
 
 # Local
 from .models import (
-    Account, ACCT_ASSET_CASH,
+    Account, ACCT_ASSET_CASH, CASH_DATA_GENERATION_KEY,
     BankAccount, BankAccountBalance,
     Sale, SaleNote, Note,
     MonetaryDonation,
     OtherItem, OtherItemType,
-    Journaler, JournalEntry, JournalEntryLineItem
+    Journaler, JournalEntry, JournalEntryLineItem,
+    DailyAccountBalance
 )
 from .serializers import (
     SaleSerializer, SaleNoteSerializer,
@@ -38,6 +42,7 @@ from .serializers import (
 )
 import members.notifications as notifications  # Temporary
 from members.models import Member  # Temporary
+from abutils.utils import get_cache_generation
 
 _logger = getLogger("books")
 
@@ -179,11 +184,11 @@ def revenues_and_expenses_from_journal(request):
 
     def get_data(category, factor) -> List:
         data = []
-        for jeli in JournalEntryLineItem.objects.filter(
+        for day in DailyAccountBalance.objects.filter(
           account__category=category,
-          journal_entry__when__gte=start,
-          journal_entry__when__lte=end).prefetch_related('journal_entry'):  # type: JournalEntryLineItem
-            pt = (jeli.journal_entry.when.isoformat(), factor * float(jeli.amount))
+          when__gte=start,
+          when__lte=end):  # type: DailyAccountBalance
+            pt = (day.when.isoformat(), factor * float(day.increases + day.decreases))
             data.append(pt)
         return data
 
@@ -207,27 +212,17 @@ def revenues_and_expenses_from_journal(request):
 
 def get_cash_pts(start: date, end:date) -> List[DatedFloat]:
     root_cash_acct = Account.get(ACCT_ASSET_CASH)
-    cash_accts = filter(
-        lambda x: x.is_subaccount_of(root_cash_acct) or x == root_cash_acct,
-        Account.objects.all()
-    ) # type: List[Account]
-    cash_acct_ids = map(
-        lambda x: x.id,
-        cash_accts
-    ) # type: List[int]
-
-    cash_jelis = JournalEntryLineItem.objects.filter(
+    cash_acct_ids = list(root_cash_acct.subtree.values_list('id', flat=True))  # type: List[int]
+
+    cash_days = DailyAccountBalance.objects.filter(
       account_id__in=cash_acct_ids,
-      journal_entry__when__gte=start,
-      journal_entry__when__lte=end
-    ).prefetch_related('journal_entry')
+      when__gte=start,
+      when__lte=end
+    )
 
     cash_deltas = []
-    for jeli in cash_jelis:  # type: JournalEntryLineItem
-        if jeli.action == JournalEntryLineItem.ACTION_BALANCE_DECREASE:
-            pt = (jeli.journal_entry.when, -1.0*float(jeli.amount))
-        else:
-            pt = (jeli.journal_entry.when, 1.0*float(jeli.amount))
+    for day in cash_days:  # type: DailyAccountBalance
+        pt = (day.when, float(day.net_change))
         cash_deltas.append(pt)
     cash_pts = list(_fill(_acc(cash_deltas)))
     return cash_pts
@@ -250,6 +245,35 @@ def get_bank_pts(start: date, end:date) -> List[DatedFloat]:
     return list(grouped_pts)
 
 
+def count_crossings(bs: np.ndarray, cs: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """
+    For each offset, counts the number of times that cs+offset crosses bs.
+    Days on which the curves touch don't count as crossings, nor do the days next to them.
+    """
+    signs = np.sign(bs[np.newaxis, :] - (cs[np.newaxis, :] + offsets[:, np.newaxis]))  # One row per offset.
+    prev_signs, next_signs = signs[:, :-1], signs[:, 1:]
+    crossed = (prev_signs != next_signs) & (prev_signs != 0) & (next_signs != 0)
+    return crossed.sum(axis=1)
+
+
+def fit_offset(bs: np.ndarray, cs: np.ndarray, fine: bool = False) -> float:
+    """
+    Finds the offset that maximizes the number of crossings between cash and bank points.
+    The coarse search is in steps of $100. A fine search refines that in steps of $1.
+    """
+    offsets = np.arange(-50000, 50000, 100)
+    crossings = count_crossings(bs, cs, offsets)
+    best = int(np.argmax(crossings))  # The first of any ties, as with the original loop.
+    if crossings[best] == 0:
+        return 0.0
+    optimal_offset = offsets[best]
+    if fine:
+        offsets = np.arange(optimal_offset-99, optimal_offset+100, 1)
+        crossings = count_crossings(bs, cs, offsets)
+        optimal_offset = offsets[int(np.argmax(crossings))]
+    return float(optimal_offset)
+
+
 @login_required
 def cashonhand_vs_time_chart(request):
 
@@ -271,8 +295,6 @@ def cashonhand_vs_time_chart(request):
     bs = array([y for [x, y] in bank_pts[0:n]])
     cs = array([y for [x, y] in cash_pts[0:n]])
 
-    optimal_offset = None
-
     # This method uses least squares to find a fit between books and bank:
     # sumofsq_min = None
     # for i in range(n):
@@ -283,19 +305,15 @@ def cashonhand_vs_time_chart(request):
     #         sumofsq_min = sumofsq
     #         optimal_offset = offset
 
-    # This method uses crossing count to find a fit between books and bank:
-    crossings_max = 0
-    for offset in range(-50000, 50000, 100):
-        crossings = 0
-        r = (bs - (cs + offset))  # residuals
-        for i in range(1, n):
-            if r[i-1] == 0 or r[i] == 0:
-                continue
-            if r[i-1]/abs(r[i-1]) != r[i]/abs(r[i]):
-                crossings += 1
-        if crossings > crossings_max:
-            crossings_max = crossings
-            optimal_offset = offset
+    # This method uses crossing count to find a fit between books and bank.
+    # The fit only changes when the journal or bank balances do, so it's cached until then, or for a day at most.
+    fine = request.GET.get("fine", "0").lower() not in ("0", "false", "no", "off")  # A bare ?fine turns it on.
+    generation = get_cache_generation(CASH_DATA_GENERATION_KEY)
+    fit_key = "books.cashonhand_fit.{}.{}.{}.{}".format(generation, start, end, fine)
+    optimal_offset = cache.get(fit_key)
+    if optimal_offset is None:
+        optimal_offset = fit_offset(bs, cs, fine)
+        cache.set(fit_key, optimal_offset, timeout=24*60*60)
 
     params = {
         'cash': _shift(optimal_offset, cash_pts),
@@ -345,27 +363,25 @@ def squareup_webhook(request):
 @login_required
 def account_browser(request: HttpRequest):
 
-    def flatten_and_label(accts: List[Account]) -> List[Account]:
-        result = []
-        for acct in accts:
-            result.append(acct)
-            subaccts = list(acct.account_set.all())
-            for acct in flatten_and_label(subaccts):
-                result.append(acct)
-        return result
-
-    asset_root_accts = list(Account.objects.filter(parent=None, category=Account.CAT_ASSET))  # type: List[Account]
-    expense_root_accts = list(Account.objects.filter(parent=None, category=Account.CAT_EXPENSE))  # type: List[Account]
-    liability_root_accts = list(Account.objects.filter(parent=None, category=Account.CAT_LIABILITY))  # type: List[Account]
-    equity_root_accts = list(Account.objects.filter(parent=None, category=Account.CAT_EQUITY))  # type: List[Account]
-    revenue_root_accts = list(Account.objects.filter(parent=None, category=Account.CAT_REVENUE))  # type: List[Account]
+    # The whole chart of accounts comes from a single fetch.
+    accts = Account.in_tree_order(list(Account.objects.all()))  # type: List[Account]
+    accts_by_id = {acct.id: acct for acct in accts}
+
+    def root_of(acct: Account) -> Account:
+        # Follows the parent links rather than the path, which can be empty, e.g. right after loading fixtures.
+        while acct.parent_id is not None:
+            acct = accts_by_id[acct.parent_id]
+        return acct
+
+    def accts_under_roots_of(category: str) -> List[Account]:
+        return [acct for acct in accts if root_of(acct).category == category]
 
     params = {
-        'asset_accts': flatten_and_label(asset_root_accts),
-        'expense_accts': flatten_and_label(expense_root_accts),
-        'liability_accts': flatten_and_label(liability_root_accts),
-        'equity_accts': flatten_and_label(equity_root_accts),
-        'revenue_accts': flatten_and_label(revenue_root_accts),
+        'asset_accts': accts_under_roots_of(Account.CAT_ASSET),
+        'expense_accts': accts_under_roots_of(Account.CAT_EXPENSE),
+        'liability_accts': accts_under_roots_of(Account.CAT_LIABILITY),
+        'equity_accts': accts_under_roots_of(Account.CAT_EQUITY),
+        'revenue_accts': accts_under_roots_of(Account.CAT_REVENUE),
     }
 
     return render(request, 'books/account-browser.html', params)
@@ -428,23 +444,24 @@ def account_history(
         account=account_pk,
         journal_entry__when__gte=begin_date,
         journal_entry__when__lte=end_date,
-    ))
+    ).select_related('journal_entry'))
 
     jelis.sort(key=lambda x: x.journal_entry.when)
 
-    decrease_total = Decimal("0.00")
-    increase_total = Decimal("0.00")
     for jeli in jelis:  # type: JournalEntryLineItem
         je = jeli.journal_entry  # type: JournalEntry
-        if jeli.action == jeli.ACTION_BALANCE_INCREASE:
-            increase_total += jeli.amount
-            jeli.sign = 1
-        else:
-            decrease_total += jeli.amount
-            jeli.sign = -1
+        jeli.sign = 1 if jeli.action == jeli.ACTION_BALANCE_INCREASE else -1
         # DB contains abs URLs pointing to production, so I'll add relative urls.
         je.relative_source_url = urlsplit(je.source_url).path
 
+    # Totals come from the daily rollups instead of the line items.
+    days = DailyAccountBalance.objects.filter(account=account_pk, when__lte=end_date)
+    totals = days.filter(when__gte=begin_date).aggregate(Sum('increases'), Sum('decreases'))
+    increase_total = totals['increases__sum'] or Decimal("0.00")
+    decrease_total = totals['decreases__sum'] or Decimal("0.00")
+    last_day = days.last()  # type: DailyAccountBalance
+    end_balance = last_day.balance if last_day is not None else Decimal("0.00")
+
     params = {
         'begin_date': begin_date,
         'end_date': end_date,
@@ -453,5 +470,6 @@ def account_history(
         'decrease_total': decrease_total,
         'increase_total': increase_total,
         'change_total': increase_total - decrease_total,
+        'end_balance': end_balance,
     }
     return render(request, 'books/account-history.html', params)
@@ -7,7 +7,7 @@ from django.contrib.auth.admin import UserAdmin
 from django.contrib.auth.models import User
 
 # Local
-from bzw_ops.models import TimeBlockType, TimeBlock
+from bzw_ops.models import TimeBlockType, TimeBlock, EtlSyncState, EtlRun
 from abutils.time import (
     days_of_week_str,
     duration_single_unit_str,
@@ -100,3 +100,62 @@ class TimeBlockTypeAdmin(admin.ModelAdmin):
     list_display = ['pk', 'name', 'is_default', 'description']
     list_display_links = ['pk', 'name']
 
+
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+
+@admin.register(EtlSyncState)
+class EtlSyncStateAdmin(admin.ModelAdmin):
+
+    list_display = ['pk', 'fetcher', 'cursor', 'when_updated']
+
+    readonly_fields = ['when_updated']
+
+
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+
+@admin.register(EtlRun)
+class EtlRunAdmin(admin.ModelAdmin):
+
+    def fmt_duration(self, obj) -> str:
+        return "{:.0f} sec".format((obj.finished - obj.started).total_seconds())
+
+    list_display = [
+        'pk',
+        'fetcher',
+        'started',
+        'fmt_duration',
+        'succeeded',
+        'pages_fetched',
+        'items_added',
+        'items_updated',
+        'items_equal',
+        'items_errored',
+        'latency_p95',
+        'fetch_secs',
+        'transform_secs',
+        'load_secs',
+    ]
+
+    list_filter = ['fetcher', 'succeeded', 'replay']
+
+    date_hierarchy = 'started'
+
+    fields = [
+        ('fetcher', 'replay', 'succeeded'),
+        ('started', 'finished'),
+        ('pages_fetched', 'http_requests', 'http_retries', 'bytes_transferred'),
+        ('latency_p50', 'latency_p95', 'latency_p99'),
+        ('items_added', 'items_updated', 'items_equal', 'items_protected', 'items_errored'),
+        ('fetch_secs', 'transform_secs', 'load_secs'),
+    ]
+
+    readonly_fields = [
+        'fetcher', 'replay', 'succeeded', 'started', 'finished',
+        'pages_fetched', 'http_requests', 'http_retries', 'bytes_transferred',
+        'latency_p50', 'latency_p95', 'latency_p99',
+        'items_added', 'items_updated', 'items_equal', 'items_protected', 'items_errored',
+        'fetch_secs', 'transform_secs', 'load_secs',
+    ]
+
+
+EtlRunAdmin.fmt_duration.short_description = "Duration"
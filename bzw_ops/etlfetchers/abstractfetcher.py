@@ -1,10 +1,16 @@
 # Standard
+import os
 import sys
+import json
+import queue
+import hashlib
+import threading
+from datetime import date, timedelta
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
 import abc
 # Third Party
 from django.db.models import Model
-from requests import Session
 from rest_framework.test import APIRequestFactory
 
 # Local
@@ -12,15 +18,72 @@ import books.models as bm
 import books.serializers as bs
 import members.models as mm
 import members.restapi.serializers as ms
+from bzw_ops.etlfetchers.archive import PayloadArchive
+from bzw_ops.etlfetchers.httpclient import ResilientSession
+from bzw_ops.etlfetchers.loaders import EtlLoader, RestLoader
+from bzw_ops.etlfetchers.telemetry import RunTelemetry
+from bzw_ops.restapi.views import UPSERT_EQUAL, UPSERT_PROTECTED
 
 
-def has_new_data(older, newer):
-    for newkey, newval in newer.items():
-        if newkey in ['id', 'protected']: continue
-        if newval is None: continue
-        if newkey not in older: return True
-        elif older[newkey] != newer[newkey]: return True
-    return False
+def prefetched(pages: Iterable, depth: int) -> Iterator:
+    """
+    Iterates over pages, while a background thread retrieves up to depth pages ahead.
+    This lets a fetcher's HTTP requests to the payment processor overlap its transform & load.
+    Exceptions raised while retrieving pages are re-raised to the consumer.
+    """
+    if depth <= 0:
+        yield from pages
+        return
+
+    end_of_pages = object()
+    buffer = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False  # The consumer went away.
+
+    def produce():
+        try:
+            for page in pages:
+                if not put((page, None)):
+                    return
+            put((end_of_pages, None))
+        except Exception as e:
+            put((end_of_pages, e))
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            page, error = buffer.get()
+            if error is not None:
+                raise error
+            if page is end_of_pages:
+                return
+            yield page
+    finally:
+        stop.set()
+
+
+def date_chunks(start: date, stop: date, days: int) -> List[Tuple[date, date]]:
+    """Splits the dates from start up to (but not including) stop into [start, stop) ranges of the given length."""
+    chunks = []
+    while start < stop:
+        chunks.append((start, min(stop, start + timedelta(days=days))))
+        start = chunks[-1][1]
+    return chunks
+
+
+def payload_hash(data: dict) -> str:
+    """A hash of a record's data that doesn't depend on key order. It fits in a model's etl_hash field."""
+    normalized = json.dumps(data, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()
 
 
 class AbstractFetcher(object):
@@ -57,95 +120,353 @@ class AbstractFetcher(object):
         "DISCOVER": "Disc"
     }
 
-    djangosession = Session()
+    UPSERT_URL = "ops/api/etl-upsert/"
+    HASHES_URL = "ops/api/etl-hashes/"
+    CTRLIDS_URL = "ops/api/etl-ctrlids/{}/"
+    UPSERT_CHUNK_SIZE = 100  # Number of records to send to the bulk upsert endpoint at a time.
+    SYNC_STATE_URL = "ops/api/etl-sync-state/{}/"
+    RUNS_URL = "ops/api/etl-runs/"
+
+    djangosession = ResilientSession("django")  # Replaced by a session of the fetcher's own in configure().
+
+    # Concurrency limits, which the etl command can change via configure():
+    prefetch_pages = 2  # Pages retrieved ahead of transform & load. Zero retrieves them inline.
+    pool_size = 4  # Connections kept open per host, per session.
 
     progress_count = 0
     progress_per_row = 50
 
     django_auth_headers = None
 
+    upsert_buffer = None  # type: List[dict]
+    upsert_items = None  # type: List[Model]
+
+    CTRLID_PREFIX = ""  # Fetchers whose ctrlids are like "SQ:..." set this to e.g. "SQ".
+
+    # The existing records of the current date window, by model label & ctrlid. See prefetch_ctrlids().
+    ctrlid_map = None  # type: Optional[Dict[str, Dict[str, dict]]]
+
+    # Where upserted items are loaded. If not set, it's a RestLoader for the server at URLBASE.
+    loader = None  # type: Optional[EtlLoader]
+
+    # Each run refetches this many days before the persisted cursor, to pick up late changes at the source.
+    # The etl command can change these.
+    sync_overlap_days = 7
+    ignore_sync_cursor = False
+
+    pending_sync_cursor = None  # type: Optional[str]
+    sync_blocked = False  # Becomes true if a chunk has errors, so the cursor won't advance past them.
+
+    # Raw payloads are archived here, if set. If replaying, they're read from here instead of being fetched.
+    archive = None  # type: Optional[PayloadArchive]
+    replaying = False
+
+    telemetry = None  # type: Optional[RunTelemetry]
+
+    # If set, fetch() only covers the dates in this [start, stop) range, e.g. in an rq job for one chunk of history.
+    # Chunks don't move the cursor. The job that coordinates them does that once they've all succeeded.
+    chunk = None  # type: Optional[Tuple[date, date]]
+
+    @staticmethod
+    def ask(prompt: str, env_var: str) -> str:
+        """
+        Gets a setting, e.g. a credential, from the given environment variable if it's set, else by prompting for it.
+        If there's nobody to prompt, e.g. in an rq worker, it's "", which makes the fetcher skip itself.
+        """
+        value = os.getenv(env_var)
+        if value is not None:
+            return value
+        return input(prompt) if sys.stdin is not None and sys.stdin.isatty() else ""
+
+    def configure(self, prefetch_pages: int, pool_size: int):
+        """
+        Sets this fetcher's concurrency limits and gives it its own sessions,
+        so that fetchers can safely run in parallel. Fetchers with sessions of their own should extend this.
+        """
+        self.prefetch_pages = prefetch_pages
+        self.pool_size = pool_size
+        self.djangosession = ResilientSession("django", pool_size)
+
+    def http_sessions(self) -> List[ResilientSession]:
+        """The sessions whose requests are measured for runs. Fetchers with sessions of their own should extend this."""
+        return [self.djangosession]
+
+    def get_telemetry(self) -> RunTelemetry:
+        if self.telemetry is None:
+            self.telemetry = RunTelemetry(self.sync_name, self.replaying, self.http_sessions())
+        return self.telemetry
+
+    def chunks(self, days: int) -> List[Tuple[date, date]]:
+        """
+        Splits what a run would fetch into date ranges of about the given length, which can be fetched independently,
+        e.g. by parallel rq jobs. Fetchers that can't be split return [], which is the default.
+        """
+        return []
+
     @abc.abstractmethod
     def fetch(self):
         """Extract, transform, and load data."""
         raise NotImplementedError("fetch() is not implemented")
 
+    def run(self) -> dict:
+        """
+        Runs fetch(), then saves a record of the run via the loader, whether or not it succeeded.
+        :return: The fields of the EtlRun that was saved, if fetch() succeeded.
+        """
+        self.telemetry = None
+        telemetry = self.get_telemetry()
+        succeeded = False
+        try:
+            self.fetch()
+            succeeded = True
+        finally:
+            run = telemetry.record(self.http_sessions(), succeeded)
+            summary = "{}: {} pages, {} added, {} updated, {} errors. {:.1f}s fetch, {:.1f}s transform, {:.1f}s load"
+            print(summary.format(
+                self.sync_name, run['pages_fetched'], run['items_added'], run['items_updated'], run['items_errored'],
+                run['fetch_secs'], run['transform_secs'], run['load_secs']))
+            try:
+                self.get_loader().save_run(run)
+            except Exception as e:
+                # Don't hide whatever made the run fail.
+                print("Couldn't save the record of the run: {}".format(e))
+        return run
+
     def _fetch_complete(self):
+        self.flush_upserts()
+        if self.archive is not None:
+            self.archive.close()
         if self.progress_count % self.progress_per_row != 0:
             print("")
 
+    def archived(self, kind: str, key: str, payload):
+        """Archives a page of raw data that was fetched from the payment processor, and returns it."""
+        if not self.replaying:
+            self.get_telemetry().count_page()
+            if self.archive is not None:
+                self.archive.append(kind, key, payload)
+        return payload
+
+    def fetched(self, pages: Iterable) -> Iterator:
+        """Iterates over pages via prefetched(). Time spent waiting for a page is counted as fetch time."""
+        iterator = prefetched(pages, self.prefetch_pages)
+        end_of_pages = object()
+        while True:
+            with self.get_telemetry().timing('fetch'):
+                page = next(iterator, end_of_pages)
+            if page is end_of_pages:
+                return
+            yield page
+
+    def replayed(self, kind: str) -> Iterator:
+        """Yields the archived pages of the given kind, in the order they were fetched."""
+        return self.archive.payloads(kind)
+
+    def extract(self, kind: str, key: str, fetch_payload: Callable[[], object]):
+        """
+        For data that transforms look up as they go, e.g. the name on a receipt.
+        If replaying, returns the archived payload for kind & key (or None). Otherwise, fetches and archives it.
+        """
+        if self.replaying:
+            if not hasattr(self, 'replay_lookups'):
+                self.replay_lookups = dict()  # type: Dict[str, Dict[str, object]]
+            if kind not in self.replay_lookups:
+                self.replay_lookups[kind] = self.archive.latest(kind)
+            return self.replay_lookups[kind].get(key)
+        with self.get_telemetry().timing('fetch'):
+            payload = fetch_payload()
+        return self.archived(kind, key, payload)
+
+    def get_loader(self) -> EtlLoader:
+        if self.loader is None:
+            self.loader = RestLoader(self)
+        return self.loader
+
     def _massage_sale(self, sale):
         if len(sale.payer_email) > 40:
             sale.payer_email = ""
 
-    def upsert(self, item: Model) -> dict:
+    @property
+    def sync_name(self) -> str:
+        """The name under which this fetcher's cursor is persisted, e.g. 'square'."""
+        return type(self).__module__.split(".")[-1]
+
+    def load_sync_cursor(self) -> Optional[str]:
+        """Gets the cursor persisted by the last run, if any. It's only fetched from the loader once per run."""
+        if self.ignore_sync_cursor:
+            return None
+        if not hasattr(self, 'loaded_sync_cursor'):
+            cursor = self.get_loader().sync_cursor(self.sync_name)
+            self.loaded_sync_cursor = cursor if cursor > "" else None
+        return self.loaded_sync_cursor
+
+    def sync_start_date(self, earliest: date) -> date:
+        """
+        For fetchers whose cursor is an ISO date.
+        :return: The date to start fetching from: the persisted cursor less the overlap, but no earlier than earliest.
+        """
+        cursor = self.load_sync_cursor()
+        if cursor is None:
+            return earliest
+        start = date(*map(int, cursor[:10].split("-"))) - timedelta(days=self.sync_overlap_days)
+        return max(earliest, start)
+
+    def checkpoint(self, cursor: str):
+        """
+        Notes that everything up to cursor has been upserted.
+        The cursor is persisted with the chunk that sends the last of those items, if that chunk has no errors.
+        Replays don't move the cursor, since they don't fetch anything new. Neither do chunks.
+        """
+        if not self.sync_blocked and not self.replaying and self.chunk is None:
+            self.pending_sync_cursor = cursor
+
+    def prefetch_ctrlids(self, start: date, stop: date) -> None:
+        """
+        For fetchers that work through date windows. At the start of a window, gets the ids, protection, and ETL hashes
+        of the records whose sales are in [start, stop), with one paginated download per model. Items found in this
+        map are then recognized as unchanged or protected without asking the loader, and items that aren't are left
+        to the loader. The map is kept up to date as items are loaded.
+        Items buffered in the previous window are loaded first, since they were checked against its map.
+        """
+        self.flush_upserts()
+        prefix = self.CTRLID_PREFIX + ":" if self.CTRLID_PREFIX > "" else ""
+        with self.get_telemetry().timing('load'):
+            self.ctrlid_map = {
+                model_class._meta.label: self.get_loader().ctrlid_map(model_class._meta.label, prefix, start, stop)
+                for model_class in self.SERIALIZERS
+            }
+
+    def _show_progress(self, progchar: str):
+        print(progchar, end='')  # Progress indicator
+        self.progress_count += 1
+        if self.progress_count % self.progress_per_row == 0:
+            print(" {}".format(self.progress_count))
+        sys.stdout.flush()
 
+    def upsert(self, item: Model, wait: bool = False) -> dict:
+        """
+        Buffers the item for the loader, which is given a chunk of items at a time.
+        Line items whose sale hasn't been given an id are matched to their sale by its ctrlid, by the loader.
+        :param wait: If true, load the item (and anything buffered before it) now, so that the result has its id.
+        :return: The item's data, plus 'id' and 'protected' as reported by the loader if wait is true.
+        """
         if type(item) == bm.Sale: self._massage_sale(item)
 
-        url = self.URLBASE + self.URLS[type(item)]
         serializer = self.SERIALIZERS[type(item)]
 
-        # See if the item has previously been sent:
-        get_params = {'ctrlid': item.ctrlid}
-        response = self.djangosession.get(url, params=get_params, headers=self.django_auth_headers)
-        if response.status_code >= 300:
-            raise AssertionError("Unexpected status code from Django: "+str(response.status_code))
-        matchcount = int(response.json()['count'])
-        if matchcount == 0:
-            id = None
-        elif matchcount == 1:
-            djangodata = response.json()['results'][0]
-            id = int(djangodata['id'])
-        else:
-            # Else case is an assertion that matchcount is 0 or 1.
-            raise AssertionError("Too many matches for %s with ctrlid %s" % (str(type(item)), item.ctrlid))
-
         # Creating srcdata is complicated by the fact that the API is now using HyperlinkedIdentityField
         # It requires a Django or DjangoRestFramework "Request" as context.
         # see http://stackoverflow.com/questions/10277748/how-to-get-request-object-in-django-unit-testing
         context = {'request':APIRequestFactory().get('/', SERVER_NAME=self.SERVERNAME, secure=True)}
         srcdata = serializer(item, context=context).data
 
-        # Either POST or PUT depending on whether it already exists
-        if id is None:
-            # The information is not yet on the website, so add it.
-            response = self.djangosession.post(url, srcdata, headers=self.django_auth_headers)
-            djangodata = response.json()
-            progchar = "+"  # Added
-        else:
-            #srcdata.update({'id': djangodata['id'], 'protected': False})  # So subset comparison can be made.
-            if djangodata['protected']:
-                progchar = "P"  # Protected, so will leave it alone.
-            elif has_new_data(djangodata, srcdata):
-                update_url = "{}{}/".format(url, id)
-                response = self.djangosession.put(update_url, srcdata, headers=self.django_auth_headers)
-                progchar = "U"  # Change detected so updated.
-            else:
-                progchar = "="  # Equal so no add or update required. Will leave it alone.
-        if response.status_code >= 300:
-            progchar = "E"  # Error
+        # The hash leaves out the ids, which aren't part of the source data. The sale is identified by its ctrlid.
+        sale = getattr(item, 'sale', None)
+        hashed = {k: v for k, v in srcdata.items() if k not in ('id', 'etl_hash')}
+        if sale is not None:
+            hashed['sale'] = sale.ctrlid
+        item.etl_hash = srcdata['etl_hash'] = payload_hash(hashed)
 
-        print(progchar, end='')  # Progress indicator
-        self.progress_count += 1
-        if self.progress_count % self.progress_per_row == 0:
-            print(" {}".format(self.progress_count))
-        sys.stdout.flush()
+        record = {'model': type(item)._meta.label, 'data': srcdata}
+        if sale is not None and sale.pk is None:
+            record['sale_ctrlid'] = sale.ctrlid
 
-        return djangodata
-
-    def _get_id(self, url: str, filter: dict) -> dict:
-        response = self.djangosession.get(self.URLBASE+url, params=filter, headers=self.django_auth_headers)
-        if response.status_code >= 300:
-            raise AssertionError("Unexpected status code from Django: "+str(response.status_code))
-        matchcount = int(response.json()['count'])
-        if matchcount == 0:
-            id = None
-        elif matchcount == 1:
-            djangodata = response.json()['results'][0]
-            id = int(djangodata['id'])
+        if self.upsert_buffer is None:
+            self.upsert_buffer, self.upsert_items = [], []
+        self.upsert_buffer.append(record)
+        self.upsert_items.append(self._snapshot(item))
+
+        if wait:
+            result = self.flush_upserts()[-1]
+            return dict(srcdata, id=result['id'], protected=result['protected'])
+        if len(self.upsert_buffer) >= self.UPSERT_CHUNK_SIZE:
+            self.flush_upserts()
+        return dict(srcdata)
+
+    @staticmethod
+    def _snapshot(item: Model) -> Model:
+        """
+        A copy of the item as it is now, for the loader. Fetchers can change an item after upserting it, e.g. to
+        upsert it again as a family membership, so the loader mustn't be given the item itself.
+        The copy's sale, if any, only identifies the sale. The loader finds it by ctrlid, as it does for records.
+        """
+        model_class = type(item)
+        copy = model_class(**{f.attname: getattr(item, f.attname) for f in model_class._meta.concrete_fields})
+        sale = getattr(item, 'sale', None)
+        if sale is not None:
+            copy.sale = bm.Sale(pk=sale.pk, ctrlid=sale.ctrlid)
+        return copy
+
+    def flush_upserts(self) -> List[dict]:
+        """
+        Sends the buffered items, and the pending cursor if any, to the loader.
+        Items whose record already exists with the same ETL hash, or is protected, aren't sent.
+        :return: The results for the items, in the order they were buffered.
+        """
+        if not self.upsert_buffer and self.pending_sync_cursor is None:
+            return []
+        records, self.upsert_buffer = self.upsert_buffer or [], []
+        items, self.upsert_items = self.upsert_items or [], []
+        sync_state = None
+        if self.pending_sync_cursor is not None:
+            sync_state = {'fetcher': self.sync_name, 'cursor': self.pending_sync_cursor}
+            self.pending_sync_cursor = None
+
+        with self.get_telemetry().timing('load'):
+            results = self.unchanged_results(records)
+            changed = [i for i, result in enumerate(results) if result is None]
+            if len(changed) > 0 or sync_state is not None:
+                loaded = self.get_loader().load([items[i] for i in changed], [records[i] for i in changed], sync_state)
+                for i, result in zip(changed, loaded['results']):
+                    results[i] = result
+                    if self.ctrlid_map is not None and result['id'] is not None:
+                        record = records[i]
+                        self.ctrlid_map.setdefault(record['model'], {})[result['ctrlid']] = {
+                            'id': result['id'], 'protected': result['protected'],
+                            'etl_hash': record['data']['etl_hash'],
+                        }
+        for result in results:
+            self.get_telemetry().count_outcome(result['outcome'])
+            self._show_progress(result['outcome'])
+            if result['outcome'] == "E":
+                print("\n{}: {}".format(result['ctrlid'], result['errors']))
+                self.sync_blocked = True
+        return results
+
+    def unchanged_results(self, records: List[dict]) -> List[Optional[dict]]:
+        """
+        Gets the hashes of the records' existing counterparts from the current window's ctrlid map, if any.
+        Otherwise, gets them with one request to the loader.
+        :return: For each record, the result of upserting it if it's already known, else None.
+        """
+        if self.ctrlid_map is not None:
+            hashes = self.ctrlid_map
         else:
-            # Else case is an assertion that matchcount is 0 or 1.
-            raise AssertionError("Too many matches searching for {} with {}".format(url, filter))
-        return id
+            ctrlids = dict()  # type: Dict[str, List[str]]
+            for record in records:
+                ctrlids.setdefault(record['model'], []).append(record['data']['ctrlid'])
+            hashes = self.get_loader().hashes(ctrlids) if len(records) > 0 else {}
+        results = []  # type: List[Optional[dict]]
+        for record in records:
+            ctrlid = record['data']['ctrlid']
+            known = hashes.get(record['model'], {}).get(ctrlid)
+            if known is not None and known['protected']:
+                results.append({'ctrlid': ctrlid, 'id': known['id'], 'protected': True, 'outcome': UPSERT_PROTECTED})
+            elif known is not None and known['etl_hash'] == record['data']['etl_hash']:
+                results.append({'ctrlid': ctrlid, 'id': known['id'], 'protected': False, 'outcome': UPSERT_EQUAL})
+            else:
+                results.append(None)
+        return results
+
+    def _get_id(self, url: str, filter: dict) -> Optional[int]:
+        """Looks up the id of a model that ETL doesn't upsert, e.g. an OtherItemType. Ids found are remembered."""
+        if not hasattr(self, 'found_ids'):
+            self.found_ids = dict()  # type: Dict[tuple, Optional[int]]
+        key = (url, tuple(sorted(filter.items())))
+        if key not in self.found_ids:
+            model_class = next(m for m, m_url in self.URLS.items() if m_url == url)
+            self.found_ids[key] = self.get_loader().get_id(model_class, filter)
+        return self.found_ids[key]
 
     def card_type(self, number: str) -> str:
         if number is None: return None
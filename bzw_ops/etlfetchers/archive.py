@@ -0,0 +1,74 @@
+
+# Standard
+import os
+import gzip
+import json
+import threading
+from datetime import datetime
+from glob import glob
+from typing import Dict, Iterator, Optional
+
+# Third Party
+
+# Local
+
+
+class PayloadArchive(object):
+    """
+    An append-only archive of the raw payloads that a fetcher got from its payment processor.
+    Payloads are stored as gzipped JSON lines, partitioned by source and by the month they were fetched in,
+    e.g. <root>/square/2018-01.jsonl.gz. Each line has the payload's kind (e.g. "payments"), a key that
+    identifies what was asked for (e.g. a time window), when it was fetched, and the payload itself.
+    Replaying an archive lets fetchers rerun their transform & load without contacting the payment processor.
+    """
+
+    def __init__(self, root: str, source: str):
+        self.dir = os.path.join(root, source)
+        self._lock = threading.Lock()  # Fetchers can archive from their pipeline thread and their main thread.
+        self._file = None
+        self._file_month = None  # type: Optional[str]
+
+    def append(self, kind: str, key: str, payload) -> None:
+        now = datetime.now()
+        line = json.dumps({'kind': kind, 'key': key, 'fetched': now.isoformat(), 'payload': payload})
+        with self._lock:
+            month = now.strftime("%Y-%m")
+            if self._file_month != month:
+                self._close()
+                os.makedirs(self.dir, exist_ok=True)
+                # Appending to a gzip file adds a new gzip member, which readers handle transparently.
+                self._file = gzip.open(os.path.join(self.dir, month + ".jsonl.gz"), "at", encoding="utf-8")
+                self._file_month = month
+            self._file.write(line + "\n")
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._file_month = None
+
+    def close(self) -> None:
+        with self._lock:
+            self._close()
+
+    def records(self, kind: Optional[str] = None) -> Iterator[dict]:
+        """Yields the archived records, optionally of one kind only, in the order they were fetched."""
+        for path in sorted(glob(os.path.join(self.dir, "*.jsonl.gz"))):
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                try:
+                    for line in f:
+                        record = json.loads(line)
+                        if kind is None or record['kind'] == kind:
+                            yield record
+                except (EOFError, ValueError):
+                    # The last write to this file was interrupted. Everything before it is still good.
+                    print("\nIgnoring truncated end of {}".format(path))
+
+    def payloads(self, kind: str) -> Iterator:
+        """Yields the archived payloads of the given kind, in the order they were fetched."""
+        for record in self.records(kind):
+            yield record['payload']
+
+    def latest(self, kind: str) -> Dict[str, object]:
+        """Returns the most recently fetched payload of the given kind for each key."""
+        return {record['key']: record['payload'] for record in self.records(kind)}
@@ -0,0 +1,242 @@
+
+# Standard
+import time
+import random
+import threading
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Callable, Dict, List, Optional
+
+# Third Party
+from requests import Session, Response
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout
+
+# Local
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of making a request to a provider that has been failing."""
+    pass
+
+
+class RateLimit(object):
+    """
+    A token bucket that allows bursts of up to burst requests and rate requests per second on average.
+    It's thread safe, so sessions that talk to the same provider can share one.
+    """
+
+    def __init__(self, rate: float, burst: int,
+                 clock: Callable[[], float] = time.monotonic, sleep: Callable[[float], None] = time.sleep):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+        self._tokens = float(burst)
+        self._updated = clock()
+        self._resume_at = 0.0  # Nothing is allowed before this, e.g. because the provider said to retry later.
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        """Takes a token, and returns how long to wait before using it."""
+        with self._lock:
+            now = self.clock()
+            self._tokens = min(float(self.burst), self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1.0
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            return max(wait, self._resume_at - now)
+
+    def acquire(self) -> float:
+        """Waits until a request is allowed. Returns the time spent waiting."""
+        wait = self._reserve()
+        if wait > 0:
+            self.sleep(wait)
+        return wait
+
+    def defer(self, secs: float) -> None:
+        """Holds off all requests for secs, e.g. when the provider responds with Retry-After."""
+        with self._lock:
+            self._resume_at = max(self._resume_at, self.clock() + secs)
+
+
+class CircuitBreaker(object):
+    """
+    Stops requests to a provider after failure_threshold consecutive failures. After reset_secs, one trial request
+    is allowed ("half open"). If it succeeds, requests resume. If it fails, the breaker opens again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half open"
+
+    def __init__(self, failure_threshold: int, reset_secs: float, clock: Callable[[], float] = time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_secs = reset_secs
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def before_request(self) -> None:
+        with self._lock:
+            if self.state == self.OPEN:
+                if self.clock() - self._opened_at < self.reset_secs:
+                    raise CircuitOpenError("Circuit is open after {} consecutive failures".format(self.failures))
+                self.state = self.HALF_OPEN
+            elif self.state == self.HALF_OPEN:
+                raise CircuitOpenError("Circuit is half open and its trial request hasn't finished")
+
+    def record(self, success: bool) -> None:
+        with self._lock:
+            if success:
+                self.state = self.CLOSED
+                self.failures = 0
+            else:
+                self.failures += 1
+                if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                    self.state = self.OPEN
+                    self._opened_at = self.clock()
+
+
+class HttpPolicy(object):
+    """How a provider's requests are limited and retried."""
+
+    def __init__(self,
+                 rate: Optional[float] = None, burst: int = 1,
+                 max_retries: int = 5, backoff_secs: float = 1.0, max_backoff_secs: float = 60.0,
+                 failure_threshold: int = 5, reset_secs: float = 60.0,
+                 throttle_marker: Optional[str] = None, timeout_secs: float = 30.0):
+        self.rate = rate  # Requests per second, or None for no limit.
+        self.burst = burst
+        self.max_retries = max_retries
+        self.backoff_secs = backoff_secs  # Backoff doubles with each retry, up to max_backoff_secs.
+        self.max_backoff_secs = max_backoff_secs
+        self.failure_threshold = failure_threshold
+        self.reset_secs = reset_secs
+        self.throttle_marker = throttle_marker  # For providers that report throttling in the body of a response.
+        self.timeout_secs = timeout_secs  # For connecting, and for each read. A request that hangs is retried.
+
+
+# Rates are kept well below what the providers allow, since ETL is never in a hurry.
+POLICIES = {
+    "django": HttpPolicy(),
+    "square": HttpPolicy(rate=5.0, burst=5, throttle_marker="{'type': 'too_many_requests'"),
+    "wepay":  HttpPolicy(rate=2.0, burst=5),
+}
+DEFAULT_POLICY = HttpPolicy()
+
+RETRY_STATUSES = {500, 502, 503, 504}
+THROTTLE_STATUS = 429
+
+_shared = dict()  # type: Dict[str, tuple]
+_shared_lock = threading.Lock()
+
+
+def provider_controls(provider: str, policy: HttpPolicy) -> tuple:
+    """The (RateLimit, CircuitBreaker) shared by all the sessions for the given provider."""
+    with _shared_lock:
+        if provider not in _shared:
+            rate_limit = RateLimit(policy.rate, policy.burst) if policy.rate is not None else None
+            _shared[provider] = (rate_limit, CircuitBreaker(policy.failure_threshold, policy.reset_secs))
+        return _shared[provider]
+
+
+def retry_after_secs(response: Response) -> Optional[float]:
+    """Parses the response's Retry-After header, which is either a number of seconds or an HTTP date."""
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class ResilientSession(Session):
+    """
+    A requests Session for one provider that keeps connections alive, limits its request rate, and retries
+    throttled requests (429, honoring Retry-After), server errors, and connection problems with exponential backoff
+    and jitter. A circuit breaker stops requests to a provider whose servers keep failing.
+    Retried requests must be safe to repeat. For the ETL APIs, they are: finds are read-only and upserts use ctrlids.
+    """
+
+    def __init__(self, provider: str, pool_size: int = 4, policy: Optional[HttpPolicy] = None,
+                 sleep: Callable[[float], None] = time.sleep):
+        super().__init__()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+        self.provider = provider
+        self.policy = policy or POLICIES.get(provider, DEFAULT_POLICY)
+        if policy is None:
+            self.rate_limit, self.breaker = provider_controls(provider, self.policy)
+        else:
+            self.rate_limit = RateLimit(policy.rate, policy.burst, sleep=sleep) if policy.rate is not None else None
+            self.breaker = CircuitBreaker(policy.failure_threshold, policy.reset_secs)
+        self.sleep = sleep
+        self.stats = {'requests': 0, 'retries': 0, 'throttled': 0, 'wait_secs': 0.0, 'bytes': 0}
+        self.latencies = []  # type: List[float]
+        self._stats_lock = threading.Lock()  # A fetcher's pipeline thread and main thread can share a session.
+
+    def count(self, stat: str, amount=1) -> None:
+        with self._stats_lock:
+            self.stats[stat] += amount
+
+    def is_throttled(self, response: Response) -> bool:
+        if response.status_code == THROTTLE_STATUS:
+            return True
+        marker = self.policy.throttle_marker
+        return marker is not None and response.text.startswith(marker)
+
+    def backoff_secs(self, attempt: int) -> float:
+        """Full jitter: a random delay up to the exponential backoff for this attempt."""
+        return random.uniform(0, min(self.policy.max_backoff_secs, self.policy.backoff_secs * 2 ** attempt))
+
+    def request(self, method, url, *args, **kwargs) -> Response:
+        # Without a timeout, requests waits forever on a hung connection, which is never retried.
+        kwargs.setdefault('timeout', self.policy.timeout_secs)
+        attempt = 0
+        while True:
+            self.breaker.before_request()
+            if self.rate_limit is not None:
+                self.count('wait_secs', self.rate_limit.acquire())
+            self.count('requests')
+
+            response, error, delay = None, None, None
+            try:
+                response = super().request(method, url, *args, **kwargs)
+                with self._stats_lock:
+                    self.latencies.append(response.elapsed.total_seconds())
+                    self.stats['bytes'] += len(response.request.body or b"") + len(response.content)
+            except (ConnectionError, Timeout) as e:
+                error = e
+
+            if response is not None and self.is_throttled(response):
+                # The provider is up, so this counts as a success for the circuit breaker.
+                self.breaker.record(success=True)
+                self.count('throttled')
+                delay = retry_after_secs(response)
+                if delay is not None and self.rate_limit is not None:
+                    self.rate_limit.defer(delay)  # Other sessions for this provider should also hold off.
+            elif response is not None and response.status_code not in RETRY_STATUSES:
+                self.breaker.record(success=True)
+                return response
+            else:
+                self.breaker.record(success=False)
+
+            if attempt >= self.policy.max_retries:
+                if error is not None:
+                    raise error
+                return response
+            if delay is None:
+                delay = self.backoff_secs(attempt)
+            self.count('retries')
+            self.count('wait_secs', delay)
+            self.sleep(delay)
+            attempt += 1
@@ -0,0 +1,354 @@
+
+# Standard
+import abc
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Dict, List, Optional, Tuple
+
+# Third Party
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Model, DecimalField
+
+# Local
+import books.models as bm
+import members.models as mm
+from bzw_ops.models import EtlSyncState, EtlRun
+from bzw_ops.restapi.views import (
+    UPSERT_SERIALIZERS, _objs_by_ctrlid, existing_hashes, ctrlid_rows, unique_matches,
+    UPSERT_ADDED, UPSERT_UPDATED, UPSERT_EQUAL, UPSERT_PROTECTED, UPSERT_ERROR,
+)
+from tasks.signals.handlers import debit_time_acct_for_mship
+
+
+class EtlLoader(object):
+    """Loads the items that a fetcher has transformed into Django, a chunk at a time."""
+
+    __metaclass__ = abc.ABCMeta
+
+    @abc.abstractmethod
+    def load(self, items: List[Model], records: List[dict], sync_state: Optional[dict] = None) -> dict:
+        """
+        Adds or updates the items, using ctrlid as the natural key.
+        :param records: The same items, as records for the bulk upsert endpoint. See upsert_records().
+        :param sync_state: {"fetcher": <name>, "cursor": <high-water mark>} to persist if none of the items had errors.
+        :return: {"results": <one result per item>, "sync_state_saved": <bool>}, like upsert_records().
+        """
+        raise NotImplementedError("load() is not implemented")
+
+    @abc.abstractmethod
+    def hashes(self, ctrlids: Dict[str, List[str]]) -> Dict[str, Dict[str, dict]]:
+        """Gets the ids, protection, and ETL hashes of existing records. See existing_hashes()."""
+        raise NotImplementedError("hashes() is not implemented")
+
+    @abc.abstractmethod
+    def ctrlid_map(self, label: str, prefix: str, start: date, stop: date) -> Dict[str, dict]:
+        """
+        Gets the ids, protection, and ETL hashes of a model's records whose ctrlids start with prefix
+        and whose sale dates are in [start, stop), keyed by ctrlid. See ctrlid_rows().
+        """
+        raise NotImplementedError("ctrlid_map() is not implemented")
+
+    @abc.abstractmethod
+    def sync_cursor(self, fetcher: str) -> str:
+        """Gets the given fetcher's persisted cursor, which is "" if it hasn't synced before."""
+        raise NotImplementedError("sync_cursor() is not implemented")
+
+    @abc.abstractmethod
+    def get_id(self, model_class, filter: dict) -> Optional[int]:
+        """Gets the id of the only model_class instance that matches filter, or None if there isn't one."""
+        raise NotImplementedError("get_id() is not implemented")
+
+    @abc.abstractmethod
+    def save_run(self, run: dict) -> None:
+        """Saves the fields of an EtlRun, as recorded by RunTelemetry."""
+        raise NotImplementedError("save_run() is not implemented")
+
+
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+
+class RestLoader(EtlLoader):
+    """Loads via the REST API of the server at the fetcher's URLBASE. This is the default."""
+
+    def __init__(self, fetcher):
+        self.fetcher = fetcher  # Its session and auth headers can change after this is created.
+
+    def _check(self, response):
+        if response.status_code >= 300:
+            raise AssertionError("Unexpected status code from Django: "+str(response.status_code))
+        return response.json()
+
+    def load(self, items: List[Model], records: List[dict], sync_state: Optional[dict] = None) -> dict:
+        f = self.fetcher
+        body = {'records': records}
+        if sync_state is not None:
+            body['sync_state'] = sync_state
+        response = f.djangosession.post(f.URLBASE + f.UPSERT_URL, json=body, headers=f.django_auth_headers)
+        return self._check(response)
+
+    def hashes(self, ctrlids: Dict[str, List[str]]) -> Dict[str, Dict[str, dict]]:
+        f = self.fetcher
+        body = {'ctrlids': ctrlids}
+        return self._check(f.djangosession.post(f.URLBASE + f.HASHES_URL, json=body, headers=f.django_auth_headers))
+
+    def ctrlid_map(self, label: str, prefix: str, start: date, stop: date) -> Dict[str, dict]:
+        f = self.fetcher
+        url = f.URLBASE + f.CTRLIDS_URL.format(label)
+        params = {'prefix': prefix, 'start': start.isoformat(), 'stop': stop.isoformat()}
+        rows = []  # type: List[list]
+        while url is not None:
+            page = self._check(f.djangosession.get(url, params=params, headers=f.django_auth_headers))
+            rows.extend(page['results'])
+            url, params = page['next'], None  # The next page's URL includes the params.
+        return unique_matches(rows)
+
+    def sync_cursor(self, fetcher: str) -> str:
+        f = self.fetcher
+        url = f.URLBASE + f.SYNC_STATE_URL.format(fetcher)
+        return self._check(f.djangosession.get(url, headers=f.django_auth_headers))['cursor']
+
+    def get_id(self, model_class, filter: dict) -> Optional[int]:
+        f = self.fetcher
+        url = f.URLBASE + f.URLS[model_class]
+        data = self._check(f.djangosession.get(url, params=filter, headers=f.django_auth_headers))
+        matchcount = int(data['count'])
+        if matchcount == 0:
+            return None
+        elif matchcount == 1:
+            return int(data['results'][0]['id'])
+        else:
+            # Else case is an assertion that matchcount is 0 or 1.
+            raise AssertionError("Too many matches searching for {} with {}".format(url, filter))
+
+    def save_run(self, run: dict) -> None:
+        f = self.fetcher
+        body = {k: v.isoformat() if isinstance(v, datetime) else v for k, v in run.items()}
+        self._check(f.djangosession.post(f.URLBASE + f.RUNS_URL, json=body, headers=f.django_auth_headers))
+
+
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+
+class OrmLoader(EtlLoader):
+    """
+    Loads directly into the database, for ETL runs on a host that has access to it.
+    Each chunk takes one ctrlid query per model to find the existing rows, and then bulk inserts & updates them
+    in a single transaction. Bulk writes don't send signals, so the work that the signal handlers would have done
+    (linking sales to users and memberships to members, linking donations to campaigns, debiting time accounts
+    for work-trade memberships, updating members' paid-through dates, and marking journalers dirty) is done here,
+    for the whole chunk at once.
+    """
+
+    # Fields maintained by the signal handlers that this loader stands in for.
+    LINKED_FIELDS = {
+        bm.Sale:             ['payer_acct'],
+        bm.MonetaryDonation: ['campaign'],
+        mm.Membership:       ['member'],
+    }
+
+    def __init__(self):
+        self._update_fields = dict()  # type: Dict[type, List[str]]
+        # Reentered for each chunk, so that it's only built once per run. Users saved while it isn't active,
+        # e.g. by the web server, aren't added to it, so their sales are linked by the next run.
+        self.payer_index = bm.PayerIndex()
+
+    def update_fields(self, model_class) -> List[str]:
+        """The fields that the REST API would write, plus the ones that signal handlers would maintain."""
+        if model_class not in self._update_fields:
+            serializer = UPSERT_SERIALIZERS[model_class._meta.label]()
+            names = [name for name, field in serializer.fields.items() if not field.read_only]
+            self._update_fields[model_class] = names + self.LINKED_FIELDS.get(model_class, [])
+        return self._update_fields[model_class]
+
+    @staticmethod
+    def normalize(item: Model) -> None:
+        """Converts the item's values to what they'll be once saved, e.g. decimals rounded to their field's places."""
+        for field in item._meta.concrete_fields:
+            if field.is_relation:
+                continue
+            value = field.to_python(getattr(item, field.attname))
+            if isinstance(field, DecimalField) and isinstance(value, Decimal):
+                value = value.quantize(Decimal(".1") ** field.decimal_places)
+            setattr(item, field.attname, value)
+
+    def hashes(self, ctrlids: Dict[str, List[str]]) -> Dict[str, Dict[str, dict]]:
+        return existing_hashes(ctrlids)
+
+    def ctrlid_map(self, label: str, prefix: str, start: date, stop: date) -> Dict[str, dict]:
+        return unique_matches(ctrlid_rows(label, prefix, start.isoformat(), stop.isoformat()))
+
+    def sync_cursor(self, fetcher: str) -> str:
+        state = EtlSyncState.objects.filter(fetcher=fetcher).first()
+        return state.cursor if state is not None else ""
+
+    def get_id(self, model_class, filter: dict) -> Optional[int]:
+        ids = list(model_class.objects.filter(**filter).values_list('id', flat=True)[:2])
+        if len(ids) > 1:
+            raise AssertionError("Too many matches searching for {} with {}".format(model_class.__name__, filter))
+        return ids[0] if len(ids) == 1 else None
+
+    def save_run(self, run: dict) -> None:
+        EtlRun.objects.create(**run)
+
+    def load(self, items: List[Model], records: List[dict], sync_state: Optional[dict] = None) -> dict:
+        results = [None] * len(items)  # type: List[dict]
+        sync_state_saved = False
+        with transaction.atomic(), self.payer_index:
+            self._load(items, results)
+            if sync_state is not None and all(r['outcome'] != UPSERT_ERROR for r in results):
+                EtlSyncState.objects.update_or_create(
+                    fetcher=sync_state['fetcher'],
+                    defaults={'cursor': sync_state['cursor']}
+                )
+                sync_state_saved = True
+        return {'results': results, 'sync_state_saved': sync_state_saved}
+
+    def _load(self, items: List[Model], results: List[dict]) -> None:
+
+        # Resolve all the existing objects up front, one query per model.
+        ctrlids = dict()  # type: Dict[type, List[str]]
+        for item in items:
+            ctrlids.setdefault(type(item), []).append(item.ctrlid)
+            sale = getattr(item, 'sale', None)
+            if sale is not None:
+                ctrlids.setdefault(bm.Sale, []).append(sale.ctrlid)
+        existing = {model_class: _objs_by_ctrlid(model_class, model_ctrlids)
+                    for model_class, model_ctrlids in ctrlids.items()}
+        self.sales_by_id = {sales[0].pk: sales[0] for sales in existing.get(bm.Sale, {}).values() if len(sales) == 1}
+
+        # Sales are written first, so that line items in the same chunk can refer to them.
+        sale_indexes = [i for i, item in enumerate(items) if type(item) is bm.Sale]
+        other_indexes = [i for i, item in enumerate(items) if type(item) is not bm.Sale]
+        for indexes in [sale_indexes, other_indexes]:
+            created = dict()  # type: Dict[type, List[Model]]
+            updated = dict()  # type: Dict[type, Dict[int, Model]]
+            prior_parents = []  # type: List[Tuple[type, int]]
+            for i in indexes:
+                try:
+                    results[i] = self._plan(items[i], existing, created, updated, prior_parents)
+                except Exception as e:
+                    results[i] = {'ctrlid': items[i].ctrlid, 'id': None, 'protected': False,
+                                  'outcome': UPSERT_ERROR, 'errors': str(e)}
+            self._write(created, updated, prior_parents)
+            for i in indexes:
+                if results[i]['outcome'] in (UPSERT_ADDED, UPSERT_UPDATED):
+                    obj = existing[type(items[i])][items[i].ctrlid][0]
+                    results[i].update(id=obj.pk, protected=obj.protected)
+
+    def _plan(self, item: Model, existing, created, updated, prior_parents) -> dict:
+        """Decides what to do with the item, without writing anything."""
+        model_class = type(item)
+        result = {'ctrlid': item.ctrlid, 'id': None, 'protected': False}
+
+        if model_class._meta.label not in UPSERT_SERIALIZERS:
+            return dict(result, outcome=UPSERT_ERROR, errors="Can't upsert {}".format(model_class._meta.label))
+
+        sale = getattr(item, 'sale', None)
+        if sale is not None:
+            sales = existing[bm.Sale].get(sale.ctrlid, [])
+            if len(sales) != 1:
+                return dict(result, outcome=UPSERT_ERROR, errors="No unique sale with ctrlid {}".format(sale.ctrlid))
+            if sales[0].protected:
+                # If the sale is protected then all details are also protected.
+                return dict(result, outcome=UPSERT_PROTECTED, protected=True)
+            item.sale = sales[0]
+
+        matches = existing[model_class].get(item.ctrlid, [])
+        if len(matches) > 1:
+            return dict(result, outcome=UPSERT_ERROR, errors="Too many matches for ctrlid {}".format(item.ctrlid))
+        obj = matches[0] if len(matches) == 1 else None
+        if obj is not None and obj.protected:
+            return dict(result, outcome=UPSERT_PROTECTED, id=obj.pk, protected=True)
+
+        try:
+            self.normalize(item)
+            item.clean_fields(exclude=[f.name for f in model_class._meta.concrete_fields if f.is_relation])
+        except ValidationError as e:
+            return dict(result, outcome=UPSERT_ERROR, errors=e.message_dict)
+
+        if obj is None:
+            created.setdefault(model_class, []).append(item)
+            existing[model_class][item.ctrlid] = [item]  # In case a later item in this chunk has the same ctrlid.
+            return dict(result, outcome=UPSERT_ADDED)
+
+        fields = [model_class._meta.get_field(name) for name in self.update_fields(model_class)]
+        changed = [f for f in fields
+                   if f.name not in self.LINKED_FIELDS.get(model_class, [])
+                   and getattr(item, f.attname) != getattr(obj, f.attname)]
+        if len(changed) == 0:
+            return dict(result, outcome=UPSERT_EQUAL, id=obj.pk)
+        if obj.pk is not None:
+            # If the item is moved to another parent, the one it left also needs new journal entries.
+            parent_fields = bm.journaler_parent_fields(model_class)
+            prior_parents.extend((f.related_model, getattr(obj, f.attname)) for f in parent_fields)
+            updated.setdefault(model_class, {})[obj.pk] = obj
+        for f in changed:
+            setattr(obj, f.attname, getattr(item, f.attname))
+        return dict(result, outcome=UPSERT_UPDATED)
+
+    def _write(self, created: Dict[type, List[Model]], updated: Dict[type, Dict[int, Model]],
+               prior_parents: List[Tuple[type, int]]) -> None:
+        written = {model_class: created.get(model_class, []) + list(updated.get(model_class, {}).values())
+                   for model_class in set(created) | set(updated)}
+
+        # Stand-ins for the pre_save signal handlers:
+        self._link_sales_to_users(written.get(bm.Sale, []))
+        relinked_sales = self._link_memberships_to_members(written.get(mm.Membership, []))
+        self._link_donations_to_campaigns(written.get(bm.MonetaryDonation, []))
+
+        for model_class, objs in created.items():
+            model_class.objects.bulk_create(objs)
+            if model_class is bm.Sale:
+                self.sales_by_id.update((sale.pk, sale) for sale in objs)
+        for model_class, objs_by_pk in updated.items():
+            bm.update_rows(model_class, self.update_fields(model_class), list(objs_by_pk.values()))
+        bm.update_rows(bm.Sale, ['payer_acct'], relinked_sales)
+
+        # Stand-ins for the post_save signal handlers:
+        for mship in written.get(mm.Membership, []):
+            if mship.membership_type == mm.Membership.MT_WORKTRADE:
+                debit_time_acct_for_mship(mm.Membership, instance=mship)
+        mm.Member.update_paid_through(set(mship.member_id for mship in written.get(mm.Membership, [])) - {None})
+        self._mark_journalers_dirty(list(written.items()) + [(bm.Sale, relinked_sales)], prior_parents)
+
+    def _link_sales_to_users(self, sales: List[bm.Sale]) -> None:
+        for sale in sales:
+            if not sale.protected:
+                sale.link_to_user()
+
+    def _link_memberships_to_members(self, mships: List[mm.Membership]) -> List[bm.Sale]:
+        """
+        Does what Membership.link_to_member() does, for all the mships.
+        :return: The sales that had to be linked to users. They're saved sales that weren't part of this chunk.
+        """
+        relinked_sales = []  # type: List[bm.Sale]
+        unlinked = [m for m in mships if not m.protected and m.member_id is None and m.sale_id is not None]
+        for mship in unlinked:
+            sale = self.sales_by_id[mship.sale_id]
+            if sale.payer_acct_id is None and sale.link_to_user():
+                relinked_sales.append(sale)
+        user_ids = set(self.sales_by_id[m.sale_id].payer_acct_id for m in unlinked) - {None}
+        member_ids = dict(mm.Member.objects.filter(auth_user_id__in=user_ids).values_list('auth_user_id', 'id'))
+        for mship in unlinked:
+            mship.member_id = member_ids.get(self.sales_by_id[mship.sale_id].payer_acct_id)
+        return relinked_sales
+
+    def _link_donations_to_campaigns(self, donations: List[bm.MonetaryDonation]) -> None:
+        earmark_ids = set(don.earmark_id for don in donations)
+        campaigns = bm.Campaign.objects.filter(revenue_account_id__in=earmark_ids)
+        campaign_ids = dict(campaigns.values_list('revenue_account_id', 'id'))
+        for don in donations:
+            if don.earmark_id in campaign_ids:
+                # This is a denormalization. See comments on model.
+                don.campaign_id = campaign_ids[don.earmark_id]
+
+    def _mark_journalers_dirty(self, written, prior_parents: List[Tuple[type, int]]) -> None:
+        dirty_ids = dict()  # type: Dict[type, List[int]]
+        for journaler_class, journaler_id in prior_parents:
+            dirty_ids.setdefault(journaler_class, []).append(journaler_id)
+        for model_class, objs in written:
+            if model_class in bm.registered_journaler_classes:
+                dirty_ids.setdefault(model_class, []).extend(obj.pk for obj in objs)
+            for field in bm.journaler_parent_fields(model_class):
+                dirty_ids.setdefault(field.related_model, []).extend(getattr(obj, field.attname) for obj in objs)
+        for journaler_class, ids in dirty_ids.items():
+            bm.DirtyJournaler.mark_all(journaler_class, ids)
@@ -17,6 +17,11 @@ from books.models import Sale, MonetaryDonation, OtherItem, OtherItemType
 from xis.xerocraft_org_utils.paypalscraper import PaypalScraper
 
 
+def as_dict(resource) -> dict:
+    """Converts PayPal sdk resources to plain dicts, so they can be archived as JSON."""
+    return resource.to_dict() if hasattr(resource, 'to_dict') else resource
+
+
 # Note: This class must be named Fetcher in order for dynamic load to find it.
 class Fetcher(AbstractFetcher):
 
@@ -157,7 +162,7 @@ class Fetcher(AbstractFetcher):
         sale.total_paid_by_customer = Decimal(sale_amt)  # The full amount paid by the person, including payment processing fee IF CUSTOMER PAID IT.
         sale.processing_fee = Decimal(trans_fee)
         sale.ctrlid = "{}:{}".format(self.CTRLID_PREFIX, payment_id)
-        django_sale = self.upsert(sale)
+        django_sale = self.upsert(sale, wait=True)  # Line item ctrlids use the sale's id.
         sale.id = django_sale['id']
 
         if django_sale["protected"] == True:
@@ -178,7 +183,7 @@ class Fetcher(AbstractFetcher):
     # RECURRING PAYMENTS set up by Xerocraft.org (for memberships)
     # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 
-    def _process_recurring_payment(self, agreement: sdk.BillingAgreement, transaction):
+    def _process_recurring_payment(self, agreement: dict, transaction):
         when_datetime = parse(transaction["time_stamp"])  # type: datetime
         when_local_date = localtime(when_datetime).date()
 
@@ -204,18 +209,22 @@ class Fetcher(AbstractFetcher):
         sale.total_paid_by_customer = Decimal(paid_amount)  # The full amount paid by the person, including payment processing fee IF CUSTOMER PAID IT.
         sale.processing_fee = Decimal(fee_amount)
         sale.ctrlid = "{}:{}".format(self.CTRLID_PREFIX, trans_id)
-        django_sale = self.upsert(sale)
-        sale.id = django_sale['id']
-
-        if django_sale["protected"]:
-            # If the sale is protected then all details are also protected.
-            # Otherwise there's no way to protect a deletion.
-            return
+        self.upsert(sale)
 
+        # If the sale is protected then all details are also protected.
+        # The server reports its line items as protected ("P") without changing them.
         self._member_and_family(sale, 1)
 
-    def _process_agreement(self, agreement: sdk.BillingAgreement):
-        transactions = agreement.search_transactions("2016-01-01", date.today().isoformat())
+    def _agreement_pages(self, agreement_ids, start_date: date):
+        """Yields {'agreement_id', 'transactions'} for each agreement, with its transactions since start_date."""
+        for agreement_id in agreement_ids:
+            agreement = sdk.BillingAgreement.find(agreement_id)
+            transactions = agreement.search_transactions(start_date.isoformat(), date.today().isoformat())
+            page = {'agreement_id': agreement_id, 'transactions': as_dict(transactions)}
+            yield self.archived("agreement_transactions", agreement_id, page)
+
+    def _process_agreement(self, agreement_id: str, transactions):
+        agreement = {'id': agreement_id}  # Only its id is needed, and replays don't have the sdk object.
         for transaction in transactions['agreement_transaction_list']:
             stat = transaction["status"]
             if stat == 'Created':
@@ -231,13 +240,29 @@ class Fetcher(AbstractFetcher):
     # INIT & ABSTRACT METHODS
     # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 
+    def _payment_pages(self, start_time: str):
+        """Yields pages of payments made since start_time."""
+        next_id = None
+        while True:
+            hist_params = {"count": 20}
+            if next_id is not None:
+                hist_params["start_id"] = next_id
+            else:
+                hist_params["start_time"] = start_time
+            payment_history = sdk.Payment.all(hist_params)
+            payments = [as_dict(payment) for payment in payment_history.payments]
+            yield self.archived("payments", next_id or start_time, payments)
+            next_id = payment_history.next_id
+            if next_id is None:
+                break
+
     def __init__(self):
 
         self.CTRLID_PREFIX = "PP"
 
         mode = "live"
-        client_id = input("PayPal Client ID: ")
-        client_secret = input("PayPal Secret: ")
+        client_id = self.ask("PayPal Client ID: ", "BZWOPS_ETL_PAYPAL_CLIENT_ID")
+        client_secret = self.ask("PayPal Secret: ", "BZWOPS_ETL_PAYPAL_SECRET")
 
         if len(client_id) * len(client_secret) == 0:
             self.skip = True
@@ -249,29 +274,40 @@ class Fetcher(AbstractFetcher):
                 'client_secret': client_secret,
             })
 
+    def replay(self):
+        for page in self.replayed("agreement_transactions"):
+            self._process_agreement(page['agreement_id'], page['transactions'])
+        for payments in self.replayed("payments"):
+            for payment in payments:
+                self._process_payment(payment)
+        self._fetch_complete()
+
     def fetch(self):
 
+        if self.replaying:
+            self.replay()
+            return
+
+        # PayPal's histories aren't in a dependable order, so the cursor is only advanced once all is loaded.
+        started = date.today()
+        cursor = self.load_sync_cursor()
+        if cursor is None:
+            payments_start_time = "2015-03-06T11:00:00Z"
+        else:
+            payments_start_time = self.sync_start_date(date(2015, 3, 6)).isoformat() + "T00:00:00Z"
+
         # Process billing agreements that were set up by the xerocraft.org website:
+        agreements_start = self.sync_start_date(date(2016, 1, 1))
         scraper = PaypalScraper()
         agreement_ids = scraper.scrape_agreement_ids()
-        for agreement_id in agreement_ids:
-            agreement = sdk.BillingAgreement.find(agreement_id)
-            self._process_agreement(agreement)
+        agreement_pages = self._agreement_pages(agreement_ids, agreements_start)
+        for page in self.fetched(agreement_pages):
+            self._process_agreement(page['agreement_id'], page['transactions'])
 
         # Process all other payments:
-        next_id = None
-        while True:
-            hist_params = {"count": 20}
-            if next_id is not None:
-                hist_params["start_id"] = next_id
-            else:
-                hist_params["start_time"] = "2015-03-06T11:00:00Z"
-            payment_history = sdk.Payment.all(hist_params)
-            payments = payment_history.payments
+        for payments in self.fetched(self._payment_pages(payments_start_time)):
             for payment in payments:
                 self._process_payment(payment)
-            next_id = payment_history.next_id
-            if next_id is None:
-                break
 
+        self.checkpoint(started.isoformat())
         self._fetch_complete()
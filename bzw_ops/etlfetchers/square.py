@@ -1,19 +1,17 @@
 
 # Standard
 from decimal import Decimal
-from datetime import date
-from time import sleep
+from datetime import date, timedelta
 
 # Third Party
-import requests
-import requests.exceptions
 import lxml
 import lxml.html
 from dateutil.parser import parse
 from dateutil.relativedelta import relativedelta
 
 # Local
-from bzw_ops.etlfetchers.abstractfetcher import AbstractFetcher
+from bzw_ops.etlfetchers.abstractfetcher import AbstractFetcher, date_chunks
+from bzw_ops.etlfetchers.httpclient import ResilientSession
 from members.models import Membership, Member, MembershipGiftCardReference
 from books.models import Sale, MonetaryDonation, OtherItem, OtherItemType
 
@@ -21,7 +19,7 @@ from books.models import Sale, MonetaryDonation, OtherItem, OtherItemType
 # Note: This class must be named Fetcher in order for dynamic load to find it.
 class Fetcher(AbstractFetcher):
 
-    squaresession = requests.Session()
+    squaresession = ResilientSession("square")
 
     def month_in_str(self, str):
         str = str.lower()
@@ -72,7 +70,7 @@ class Fetcher(AbstractFetcher):
         quantity = int(float(item['quantity']))
         for n in range(1, quantity+1):
             mship = Membership()
-            mship.sale = Sale(id=sale['id'])
+            mship.sale = Sale(ctrlid=sale['ctrlid'])
             mship.membership_type = membership_type
             mship.ctrlid = "{}:{}:{}".format(sale['ctrlid'], item_num, n)
             mship.start_date = parse(sale['sale_date']).date()
@@ -105,7 +103,7 @@ class Fetcher(AbstractFetcher):
         for n in range(1, quantity+1):
             don = MonetaryDonation()
             don.ctrlid = "{}:{}:{}".format(sale['ctrlid'], item_num, n)
-            don.sale = Sale(id=sale['id'])
+            don.sale = Sale(ctrlid=sale['ctrlid'])
             don.amount = Decimal(item["gross_sales_money"]["amount"]) / Decimal(quantity * 100.0)
             self.upsert(don)
 
@@ -119,7 +117,7 @@ class Fetcher(AbstractFetcher):
         for n in range(1, quantity+1):
             cardref = MembershipGiftCardReference()
             cardref.ctrlid = "{}:{}:{}".format(sale['ctrlid'], item_num, n)
-            cardref.sale = Sale(id=sale['id'])
+            cardref.sale = Sale(ctrlid=sale['ctrlid'])
             cardref.sale_price = Decimal(item["net_sales_money"]["amount"]) / Decimal(quantity * 100.0)
             self.upsert(cardref)
 
@@ -199,7 +197,7 @@ class Fetcher(AbstractFetcher):
         other = OtherItem()
 
         other.type = OtherItemType(id=typepk)
-        other.sale = Sale(id=sale['id'])
+        other.sale = Sale(ctrlid=sale['ctrlid'])
         other.sale_price = Decimal(item["net_sales_money"]["amount"]) / Decimal(quantity * 100.0)
         other.qty_sold = int(float(item['quantity']))
         other.ctrlid = "{}:{}".format(sale['ctrlid'], item_num)
@@ -302,18 +300,18 @@ class Fetcher(AbstractFetcher):
     # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 
     def get_name_from_receipt(self, url):
-        while True:
-            try:
-                # Following get MUST be "text/html" and NOT the "*/*" default.
-                # WePay responds with 406 if Accept = */*
-                response = self.squaresession.get(url, headers={"Accept": "text/html"})
-                parsed_page = lxml.html.fromstring(response.text)
-                if parsed_page is None: raise AssertionError("Couldn't parse receipts page")
-                names = parsed_page.xpath("//div[contains(@class,'name_on_card')]/text()")
-                return names[0] if len(names)>0 else ""
-            except requests.exceptions.ConnectionError:
-                print("!", end='')
-                pass
+        name = self.extract("receipt_name", url, lambda: self._scrape_name_from_receipt(url))
+        return name if name is not None else ""
+
+    def _scrape_name_from_receipt(self, url):
+        # Following get MUST be "text/html" and NOT the "*/*" default.
+        # WePay responds with 406 if Accept = */*
+        # The session retries connection problems.
+        response = self.squaresession.get(url, headers={"Accept": "text/html"})
+        parsed_page = lxml.html.fromstring(response.text)
+        if parsed_page is None: raise AssertionError("Couldn't parse receipts page")
+        names = parsed_page.xpath("//div[contains(@class,'name_on_card')]/text()")
+        return names[0] if len(names)>0 else ""
 
     def _get_tender_type(self, payment) -> str:
         xform = {
@@ -329,7 +327,7 @@ class Fetcher(AbstractFetcher):
 
     def _special_case_ixStxgstn56QI8jnJtcCtzMF(self, sale):
         mship = Membership()
-        mship.sale = Sale(id=sale['id'])
+        mship.sale = Sale(ctrlid=sale['ctrlid'])
         mship.membership_type = Membership.MT_REGULAR
         mship.ctrlid = "{}:1:1".format(sale['ctrlid'])
         mship.start_date = date(2014, 12, 12)
@@ -340,7 +338,7 @@ class Fetcher(AbstractFetcher):
     def _special_case_0JFN0loJ0kcy8DXCvuDVwwMF(self, sale):
         # Verify: This was erroneously entered as a donation but was really a work-trade payment.
         mship = Membership()
-        mship.sale = Sale(id=sale['id'])
+        mship.sale = Sale(ctrlid=sale['ctrlid'])
         mship.member = Member(id=19)  # Lookup by name would be better but I don't want to have names in the code.
         mship.membership_type = Membership.MT_WORKTRADE
         mship.ctrlid = "{}:1:1".format(sale['ctrlid'])
@@ -351,7 +349,7 @@ class Fetcher(AbstractFetcher):
 
     def _special_case_7cQ69ctaeYok1Ry3KOTFbyMF(self, sale):
         mship = Membership()
-        mship.sale = Sale(id=sale['id'])
+        mship.sale = Sale(ctrlid=sale['ctrlid'])
         mship.membership_type = Membership.MT_REGULAR
         mship.ctrlid = "{}:1:1".format(sale['ctrlid'])
         mship.start_date = date(2016, 4, 5)
@@ -419,10 +417,8 @@ class Fetcher(AbstractFetcher):
                 self._special_case_ixStxgstn56QI8jnJtcCtzMF(django_sale)
 
             else:
-                if django_sale["protected"] == True:
-                    # If the sale is protected then all details are also protected.
-                    # Otherwise there's no way to protect a deletion.
-                    return
+                # If the sale is protected then all details are also protected.
+                # The server reports its line items as protected ("P") without changing them.
                 itemizations = payment['itemizations']
                 self._process_itemizations(itemizations, django_sale)
 
@@ -431,8 +427,8 @@ class Fetcher(AbstractFetcher):
     # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 
     def __init__(self):
-        merchant_id = input("Square Merchant ID: ")
-        rest_token = input("Square Token: ")
+        merchant_id = self.ask("Square Merchant ID: ", "BZWOPS_ETL_SQUARE_MERCHANT_ID")
+        rest_token = self.ask("Square Token: ", "BZWOPS_ETL_SQUARE_TOKEN")
         if len(merchant_id) + len(rest_token) == 0:
             self.skip = True
         else:
@@ -440,43 +436,63 @@ class Fetcher(AbstractFetcher):
             self.merchant_id = merchant_id
             self.rest_token = rest_token
 
-    def fetch(self):
+    def configure(self, prefetch_pages: int, pool_size: int):
+        super().configure(prefetch_pages, pool_size)
+        self.squaresession = ResilientSession("square", pool_size)
 
-        get_headers = {
-            'Authorization': "Bearer " + self.rest_token,
-            'Accept': "application/json",
-        }
+    def http_sessions(self):
+        return super().http_sessions() + [self.squaresession]
+
+    # REVIEW: In code below, startdate 2013-12-01 and 1 month windows didn't get newer sales.
+    # REVIEW: Don't know why but starting at 2015-12-01 and using 2 week windows does work.
+    EARLIEST_DATE = date(2015, 12, 1)  # date(2013, 12, 1)
+
+    CTRLID_PREFIX = "SQ"
 
-        post_put_headers = {
+    def chunks(self, days: int):
+        return date_chunks(self.sync_start_date(self.EARLIEST_DATE), date.today() + timedelta(days=1), days)
+
+    def _payment_pages(self):
+        """Yields (window_end, payments) for each window of time, from where the last run left off or in the chunk."""
+
+        get_headers = {
             'Authorization': "Bearer " + self.rest_token,
             'Accept': "application/json",
-            'Content-Type': "application/json",
         }
 
         payments_url = "https://connect.squareup.com/v1/{}/payments".format(self.merchant_id)
 
-        # REVIEW: In code below, startdate 2013-12-01 and 1 month windows didn't get newer sales.
-        # REVIEW: Don't know why but starting at 2015-12-01 and using 2 week windows does work.
-        window_start = date(2015, 12, 1)  # date(2013, 12, 1)
-        while window_start <= date.today():
-            window_start = window_start + relativedelta(weeks=+1)
+        if self.chunk is None:
+            window_start, stop = self.sync_start_date(self.EARLIEST_DATE), date.today() + timedelta(days=1)
+        else:
+            window_start, stop = self.chunk
+        while window_start < stop:
             window_end = window_start + relativedelta(weeks=+1)
+            if self.chunk is not None:
+                window_end = min(window_end, stop)  # So that chunks don't overlap.
             get_data = {
                 'begin_time': window_start.isoformat(),
                 'end_time': window_end.isoformat(),
                 'limit': str(200)  # Max allowed by Square
             }
-            response = None
-            while response is None:
-                try:
-                    response = self.squaresession.get(payments_url, params=get_data, headers=get_headers)
-                    if response.text.startswith("{'type': 'too_many_requests'"):
-                        sleep(10)
-                        print("Z", end='')
-                        response = None
-                except requests.exceptions.ConnectionError:
-                    print("!", end='')
-
-            payments = response.json()
-            self._process_payments(payments)
+            # The session waits out throttling and retries connection problems.
+            response = self.squaresession.get(payments_url, params=get_data, headers=get_headers)
+
+            page = {'window_start': window_start.isoformat(), 'window_end': window_end.isoformat(),
+                    'payments': response.json()}
+            yield self.archived("payments", window_start.isoformat(), page)
+            window_start = window_end
+
+    def fetch(self):
+        if self.replaying:
+            pages = self.replayed("payments")
+        else:
+            pages = self.fetched(self._payment_pages())
+        for page in pages:
+            window_start = parse(page['window_start']).date()
+            window_end = parse(page['window_end']).date()
+            # Square's times are UTC, so a sale's date can be a day outside its window.
+            self.prefetch_ctrlids(window_start - timedelta(days=1), window_end + timedelta(days=1))
+            self._process_payments(page['payments'])
+            self.checkpoint(min(window_end, date.today()).isoformat())
         self._fetch_complete()
\ No newline at end of file
@@ -0,0 +1,99 @@
+
+# Standard
+import math
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from time import perf_counter
+from typing import List, Optional
+
+# Third Party
+from django.utils import timezone
+
+# Local
+from bzw_ops.etlfetchers.httpclient import ResilientSession
+from bzw_ops.restapi.views import UPSERT_ADDED, UPSERT_UPDATED, UPSERT_EQUAL, UPSERT_PROTECTED, UPSERT_ERROR
+
+
+def percentile(ordered: List[float], pct: float) -> Optional[float]:
+    """The nearest-rank percentile of the given ascending values, or None if there aren't any."""
+    if len(ordered) == 0:
+        return None
+    return ordered[max(0, math.ceil(pct / 100.0 * len(ordered)) - 1)]
+
+
+class RunTelemetry(object):
+    """
+    Measures one run of a fetcher. Its record() is saved as a bzw_ops.models.EtlRun.
+    A fetcher's pipeline thread and main thread can both report to it.
+    """
+
+    OUTCOME_FIELDS = {
+        UPSERT_ADDED:     'items_added',
+        UPSERT_UPDATED:   'items_updated',
+        UPSERT_EQUAL:     'items_equal',
+        UPSERT_PROTECTED: 'items_protected',
+        UPSERT_ERROR:     'items_errored',
+    }
+
+    def __init__(self, fetcher: str, replay: bool, sessions: List[ResilientSession]):
+        self.fetcher = fetcher
+        self.replay = replay
+        self.started = timezone.now()
+        self.begin = perf_counter()
+        self.pages_fetched = 0
+        self.outcomes = Counter()
+        self.secs = Counter()  # Keyed by phase: 'fetch' or 'load'. Transform gets the rest.
+        self._lock = threading.Lock()
+        # Sessions can outlive a run, so only what they do after this counts.
+        self._baselines = {id(s): (len(s.latencies), dict(s.stats)) for s in sessions}
+
+    @contextmanager
+    def timing(self, phase: str):
+        begin = perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.secs[phase] += perf_counter() - begin
+
+    def count_page(self) -> None:
+        with self._lock:
+            self.pages_fetched += 1
+
+    def count_outcome(self, outcome: str) -> None:
+        with self._lock:
+            self.outcomes[outcome] += 1
+
+    def record(self, sessions: List[ResilientSession], succeeded: bool) -> dict:
+        """The fields of an EtlRun for this run, as of now."""
+        latencies = []  # type: List[float]
+        http = Counter()
+        for session in sessions:
+            latency_count, stats = self._baselines.get(id(session), (0, {}))
+            latencies.extend(session.latencies[latency_count:])
+            for stat, value in session.stats.items():
+                http[stat] += value - stats.get(stat, 0)
+        latencies.sort()
+
+        elapsed = perf_counter() - self.begin
+        run = {
+            'fetcher': self.fetcher,
+            'started': self.started,
+            'finished': timezone.now(),
+            'succeeded': succeeded,
+            'replay': self.replay,
+            'pages_fetched': self.pages_fetched,
+            'http_requests': http['requests'],
+            'http_retries': http['retries'],
+            'latency_p50': percentile(latencies, 50),
+            'latency_p95': percentile(latencies, 95),
+            'latency_p99': percentile(latencies, 99),
+            'bytes_transferred': http['bytes'],
+            'fetch_secs': self.secs['fetch'],
+            'transform_secs': max(0.0, elapsed - self.secs['fetch'] - self.secs['load']),
+            'load_secs': self.secs['load'],
+        }
+        for outcome, field in self.OUTCOME_FIELDS.items():
+            run[field] = self.outcomes[outcome]
+        return run
@@ -15,8 +15,8 @@ class Fetcher(AbstractFetcher):
     # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 
     def __init__(self):
-        userid = input("2Checkout userid: ")
-        password = input("2Checkout password: ")
+        userid = self.ask("2Checkout userid: ", "BZWOPS_ETL_2CO_USERID")
+        password = self.ask("2Checkout password: ", "BZWOPS_ETL_2CO_PASSWORD")
         if len(userid)+len(password) == 0:
             self.skip = True
         else:
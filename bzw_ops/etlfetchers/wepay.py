@@ -7,10 +7,10 @@ from hashlib import md5
 
 # Third Party
 from dateutil.relativedelta import relativedelta
-import requests
 
 # Local
 from bzw_ops.etlfetchers.abstractfetcher import AbstractFetcher
+from bzw_ops.etlfetchers.httpclient import ResilientSession
 from members.models import Membership
 from books.models import Sale, MonetaryDonation, Account
 
@@ -36,7 +36,7 @@ class Fetcher(AbstractFetcher):
 
         don = MonetaryDonation()
         don.ctrlid = "{}:{}".format(self.CTRLID_PREFIX, checkout['checkout_id'])
-        don.sale = Sale(id=sale.id)
+        don.sale = sale
         don.amount = sale.total_paid_by_customer
         if checkout['fee_payer'] == 'payer': don.amount -= sale.processing_fee
         if earmark is not None:
@@ -46,7 +46,7 @@ class Fetcher(AbstractFetcher):
     def _process_membership_sale(self, sale, checkout, months, family):
 
         mship = Membership()
-        mship.sale = Sale(id=sale.id)
+        mship.sale = sale
         mship.sale_price = sale.total_paid_by_customer
         if checkout['fee_payer'] == 'payer': mship.sale_price -= sale.processing_fee
         if family > 0: mship.sale_price -= Decimal(10.00) * Decimal(family)
@@ -88,8 +88,7 @@ class Fetcher(AbstractFetcher):
             else:
                 sale.fee_payer = Sale.FEE_PAID_BY_US
             sale.ctrlid = "{}:{}".format(self.CTRLID_PREFIX, checkout['checkout_id'])
-            django_sale = self.upsert(sale)
-            sale.id = django_sale['id']
+            self.upsert(sale)
 
             desc = checkout['short_description']
 
@@ -136,12 +135,11 @@ class Fetcher(AbstractFetcher):
 
             print("Didn't recognize: "+desc)
 
-    def _process_checkout_data(self, account):
+    def _checkout_pages(self, account, start_date: date):
         URL = "https://wepayapi.com/v2/checkout/find"
 
-        window_start = date(2013, 12, 1)
+        window_start = start_date
         while window_start < date.today():
-            window_start = window_start + relativedelta(months=+1)
             window_end = window_start + relativedelta(months=+1)
             post_data = {
                 'account_id': account,
@@ -153,7 +151,13 @@ class Fetcher(AbstractFetcher):
             checkouts = response.json()
             if "error" in checkouts:
                 print("\nCheckouts for acct {}: {}".format(account, checkouts))
+                self.sync_blocked = True  # Don't advance the cursor past what we couldn't fetch.
                 return
+            yield self.archived("checkouts", "{}:{}".format(account, window_start.isoformat()), checkouts)
+            window_start = window_end
+
+    def _process_checkout_data(self, account, start_date: date):
+        for checkouts in self.fetched(self._checkout_pages(account, start_date)):
             self._process_checkouts(checkouts)
 
     # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
@@ -184,10 +188,10 @@ class Fetcher(AbstractFetcher):
             sale.total_paid_by_customer = charge["amount"]
             sale.processing_fee = charge["fee"]
             sale.ctrlid = "{}:{}".format(self.CTRLID_PREFIX, charge['subscription_charge_id'])
-            django_sale = self.upsert(sale)
+            self.upsert(sale)
 
             mship = Membership()
-            mship.sale = Sale(id=django_sale['id'])
+            mship.sale = sale
             mship.sale_price = sale.total_paid_by_customer
             if subscription['fee_payer'] == 'payer': mship.sale_price -= sale.processing_fee
             if family > 0: mship.sale_price -= Decimal(10.00) * Decimal(family)
@@ -208,12 +212,11 @@ class Fetcher(AbstractFetcher):
 
     def _process_subscriptions(self, subscriptions, family_count):
         for subscription in subscriptions:
-            response = self.session.post(
+            charges = self.extract("charges", str(subscription['subscription_id']), lambda: self.session.post(
                 "https://wepayapi.com/v2/subscription_charge/find",  # subscription_id --> list of charges
                 {'subscription_id': subscription['subscription_id']},
-                headers = self.auth_headers)
-            charges = response.json()
-            self._process_subscription_charges(charges, subscription, family_count)
+                headers = self.auth_headers).json())
+            self._process_subscription_charges(charges or [], subscription, family_count)
 
     def _process_plans(self, plans):
 
@@ -236,19 +239,17 @@ class Fetcher(AbstractFetcher):
                 countstr = plan['name'].replace("Membership +", "")
                 family_count = int(countstr)
 
-            response = self.session.post(
+            subscriptions = self.extract("subscriptions", str(plan["subscription_plan_id"]), lambda: self.session.post(
                 "https://wepayapi.com/v2/subscription/find",  # subscription_plan_id --> list of subscriptions
                 {'subscription_plan_id': plan["subscription_plan_id"]},
-                headers = self.auth_headers)
-            subscriptions = response.json()
-            self._process_subscriptions(subscriptions, family_count)
+                headers = self.auth_headers).json())
+            self._process_subscriptions(subscriptions or [], family_count)
 
     def _process_subscription_data(self):
-        response = self.session.get(
+        plans = self.extract("plans", "all", lambda: self.session.get(
             "https://wepayapi.com/v2/subscription_plan/find",  # No args --> list of all subscription plans
-            headers=self.auth_headers)
-        plans = response.json()
-        self._process_plans(plans)
+            headers=self.auth_headers).json())
+        self._process_plans(plans or [])
 
     # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
     # INIT & ABSTRACT METHODS
@@ -256,12 +257,12 @@ class Fetcher(AbstractFetcher):
 
     def __init__(self):
 
-        self.session = requests.Session()
+        self.session = ResilientSession("wepay")
         self.limit = 1000  # The max number of checkouts returned per find.
         self.CTRLID_PREFIX = "WE"
 
-        accounts = input("WePay Accounts: ").split()
-        rest_token = input("WePay Token: ")  # So far, same token works for all accts.
+        accounts = self.ask("WePay Accounts: ", "BZWOPS_ETL_WEPAY_ACCOUNTS").split()
+        rest_token = self.ask("WePay Token: ", "BZWOPS_ETL_WEPAY_TOKEN")  # So far, same token works for all accts.
 
         if len(accounts)+len(rest_token) == 0:
             self.skip = True
@@ -270,9 +271,25 @@ class Fetcher(AbstractFetcher):
             self.accounts = accounts
             self.auth_headers = {'Authorization': "Bearer " + rest_token}
 
+    def configure(self, prefetch_pages: int, pool_size: int):
+        super().configure(prefetch_pages, pool_size)
+        self.session = ResilientSession("wepay", pool_size)
+
+    def http_sessions(self):
+        return super().http_sessions() + [self.session]
+
     def fetch(self):
 
+        if self.replaying:
+            self._process_subscription_data()
+            for checkouts in self.replayed("checkouts"):
+                self._process_checkouts(checkouts)
+            self._fetch_complete()
+            return
+
+        start_date = self.sync_start_date(date(2013, 12, 1))
         self._process_subscription_data()
         for account in self.accounts:
-            self._process_checkout_data(account)
+            self._process_checkout_data(account, start_date)
+        self.checkpoint(date.today().isoformat())
         self._fetch_complete()
@@ -0,0 +1,142 @@
+"""
+ETL as rq jobs, for the workers started by bzw_ops/worker.py.
+
+Each source gets a coordinator job, run_source(), which splits the source's history into chunks (date ranges)
+and enqueues a run_chunk() job for each, so that several workers can fetch them in parallel. The last chunk to
+finish enqueues finish_source(), which totals the chunks' results and advances the source's cursor if they all
+succeeded. Chunks are upserted by ctrlid, so a failed chunk can simply be requeued, after which finish_source()
+runs again. Sources that can't be split run as a single chunk, which checkpoints as usual.
+
+Workers can't be prompted for credentials, so fetchers get them from environment variables. See AbstractFetcher.ask().
+"""
+
+# Standard
+import json
+from datetime import date
+from typing import Optional, Tuple
+
+# Third Party
+from django.utils.module_loading import import_string
+from rq import Queue, get_current_job
+from rq.job import Job
+
+# Local
+from bzw_ops.etlfetchers.abstractfetcher import AbstractFetcher
+from bzw_ops.etlfetchers.loaders import OrmLoader
+
+__author__ = 'adrian'
+
+ETL_QUEUE = "low"
+CHUNK_DAYS = 28
+RESULT_TTL_SECS = 7 * 24 * 60 * 60
+
+# How long any of these jobs may run before rq kills it. rq's own default of 3 minutes is far too short for a chunk:
+# a backfill of CHUNK_DAYS days from a rate limited API can take over an hour, and sources that can't be split fetch
+# all of their history as a single chunk. Can be overridden per run with the 'job_timeout_secs' option.
+JOB_TIMEOUT_SECS = 4 * 60 * 60
+
+# The fields of the chunks' EtlRuns that are totaled for a source.
+TOTALED_FIELDS = [
+    'pages_fetched', 'items_added', 'items_updated', 'items_equal', 'items_protected', 'items_errored',
+    'http_requests', 'http_retries', 'bytes_transferred', 'fetch_secs', 'transform_secs', 'load_secs',
+]
+
+
+def fetcher_path(source: str) -> str:
+    """E.g. 'square' and 'bzw_ops.etlfetchers.square' both become 'bzw_ops.etlfetchers.square.Fetcher'."""
+    if "." not in source:
+        source = "bzw_ops.etlfetchers." + source
+    return source + ".Fetcher"
+
+
+def make_fetcher(path: str, options: dict) -> AbstractFetcher:
+    """Creates the fetcher class at path, set up to load directly into the database."""
+    fetcher = import_string(path)()  # type: AbstractFetcher
+    fetcher.loader = OrmLoader()
+    fetcher.sync_overlap_days = options.get('overlap_days', fetcher.sync_overlap_days)
+    fetcher.ignore_sync_cursor = options.get('all_history', False)
+    fetcher.configure(fetcher.prefetch_pages, fetcher.pool_size)
+    return fetcher
+
+
+def _key(run_id: str, name: str) -> str:
+    return "etl:{}:{}".format(run_id, name)
+
+
+def _enqueue(connection, func, options: dict, *args) -> Job:
+    queue = Queue(ETL_QUEUE, connection=connection)
+    timeout = options.get('job_timeout_secs', JOB_TIMEOUT_SECS)
+    return queue.enqueue(func, *args, timeout=timeout, result_ttl=RESULT_TTL_SECS)
+
+
+def enqueue_source(path: str, connection, chunk_days: int = CHUNK_DAYS, options: Optional[dict] = None) -> Job:
+    """Enqueues the coordinator job for the fetcher class at path."""
+    options = options or {}
+    return _enqueue(connection, run_source, options, path, chunk_days, options)
+
+
+def run_source(path: str, chunk_days: int, options: dict) -> dict:
+    """The coordinator job for a source. Enqueues a job for each of its chunks."""
+    job = get_current_job()
+    fetcher = make_fetcher(path, options)
+    if fetcher.skip:
+        return {'fetcher': fetcher.sync_name, 'skipped': True}
+
+    chunks = fetcher.chunks(chunk_days)
+    cursor = None  # type: Optional[str]
+    if len(chunks) > 0:
+        cursor = min(chunks[-1][1], date.today()).isoformat()
+    else:
+        chunks = [None]
+
+    connection = job.connection
+    connection.set(_key(job.id, "remaining"), len(chunks), ex=RESULT_TTL_SECS)
+    for index, chunk in enumerate(chunks):
+        _enqueue(connection, run_chunk, options, job.id, index, path, chunk, options, cursor)
+    return {'fetcher': fetcher.sync_name, 'chunks': len(chunks)}
+
+
+def run_chunk(run_id: str, index: int, path: str, chunk: Optional[Tuple[date, date]], options: dict,
+              cursor: Optional[str]) -> dict:
+    """Fetches one chunk of a source. Its result is kept in Redis for finish_source()."""
+    connection = get_current_job().connection
+    outcome = {'index': index, 'chunk': chunk, 'succeeded': False}
+    try:
+        fetcher = make_fetcher(path, options)
+        fetcher.chunk = chunk
+        run = fetcher.run()
+        outcome.update({field: run[field] for field in TOTALED_FIELDS})
+        outcome['succeeded'] = True
+        return outcome
+    except Exception as e:
+        outcome['error'] = repr(e)
+        raise
+    finally:
+        connection.hset(_key(run_id, "chunks"), index, json.dumps(outcome, default=str))
+        connection.expire(_key(run_id, "chunks"), RESULT_TTL_SECS)
+        # Less than zero if a failed chunk was requeued, in which case the source is finished again.
+        if connection.decr(_key(run_id, "remaining")) <= 0:
+            _enqueue(connection, finish_source, options, run_id, path, options, cursor)
+
+
+def finish_source(run_id: str, path: str, options: dict, cursor: Optional[str]) -> dict:
+    """Totals the results of a source's chunks, and advances its cursor if they all succeeded without errors."""
+    connection = get_current_job().connection
+    outcomes = [json.loads(v.decode()) for v in connection.hgetall(_key(run_id, "chunks")).values()]
+    outcomes.sort(key=lambda o: o['index'])
+
+    result = {field: sum(o.get(field, 0) for o in outcomes) for field in TOTALED_FIELDS}
+    result['chunks'] = len(outcomes)
+    result['failed_chunks'] = [o['chunk'] for o in outcomes if not o['succeeded']]
+    result['succeeded'] = len(result['failed_chunks']) == 0
+
+    result['cursor'] = None
+    if cursor is not None and result['succeeded'] and result['items_errored'] == 0:
+        fetcher = make_fetcher(path, options)
+        fetcher.checkpoint(cursor)
+        fetcher.flush_upserts()
+        result['cursor'] = cursor
+
+    result['fetcher'] = path
+    connection.set(_key(run_id, "result"), json.dumps(result, default=str), ex=RESULT_TTL_SECS)
+    return result
@@ -57,7 +57,10 @@ class DbCheck(unittest.TestCase):
                 model_info_str = "   {}, {} objs".format(modelname, total_obj_count)
                 print(model_info_str, end="")
                 sys.stdout.flush()
-                objs = model.objects.all()  # TODO: Call model.objs_for_dbcheck() instead, if it exists.
+                if hasattr(model, "objs_for_dbcheck"):
+                    objs = model.objs_for_dbcheck()
+                else:
+                    objs = model.objects.all()
                 model_problems = pool.map(
                     test_object,
                     ((modelname, obj) for obj in objs)
@@ -1,42 +1,145 @@
-
 # Standard
-import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
 
 # Third-party
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.utils.module_loading import import_string
 
 # Local
+from bzw_ops.etlfetchers.abstractfetcher import AbstractFetcher
+from bzw_ops.etlfetchers.archive import PayloadArchive
+from bzw_ops.etlfetchers.loaders import OrmLoader
+from bzw_ops.etljobs import CHUNK_DAYS, JOB_TIMEOUT_SECS, fetcher_path, enqueue_source
 
 
 __author__ = 'adrian'
 
 
+def parse_limits(specs: List[str], default: int) -> Dict[str, int]:
+    """Parses specs like ["4", "square=2"] into {"": 4, "square": 2}. The "" key is the default for all sources."""
+    limits = {"": default}
+    for spec in specs:
+        source, _, value = spec.rpartition("=")
+        try:
+            limits[source] = int(value)
+        except ValueError:
+            raise CommandError("Expected N or SOURCE=N, not '{}'".format(spec))
+    return limits
+
+
 class Command(BaseCommand):
 
     help = "Meant to be run on a server other than the web server, this ETLs financials from various sources."
 
     auth_headers = None
 
+    def add_arguments(self, parser):
+        parser.add_argument('sources', nargs='*', metavar="SOURCE",
+            help="Fetchers to run, e.g. 'square' or 'bzw_ops.etlfetchers.square'. Prompted for if not given.")
+        parser.add_argument('--enqueue', action='store_true',
+            help="Enqueue a job per source for the rq workers instead of running the fetchers here. "
+                 "Workers get credentials from BZWOPS_ETL_* environment variables.")
+        parser.add_argument('--chunk-days', type=int, default=CHUNK_DAYS,
+            help="With --enqueue, split sources that allow it into jobs for this many days of history each.")
+        parser.add_argument('--job-timeout', type=int, default=JOB_TIMEOUT_SECS, metavar="SECS",
+            help="With --enqueue, how long each job may run before the worker kills it.")
+        parser.add_argument('--overlap-days', type=int, default=7,
+            help="Refetch this many days before where each fetcher's last run left off.")
+        parser.add_argument('--all-history', action='store_true',
+            help="Ignore where the fetchers' last runs left off and refetch all history.")
+        parser.add_argument('--parallel', action='store_true',
+            help="Run the fetchers concurrently instead of one after another.")
+        parser.add_argument('--prefetch', action='append', default=[], metavar="[SOURCE=]N",
+            help="Pages to retrieve ahead of transform & load, for all sources or just one, e.g. 'square=4'. "
+                 "Zero turns off the pipeline. Can be repeated.")
+        parser.add_argument('--pool-size', action='append', default=[], metavar="[SOURCE=]N",
+            help="HTTP connections to keep open per host, for all sources or just one. Can be repeated.")
+        parser.add_argument('--archive-dir', default="etl-archive",
+            help="Where raw payloads from the payment processors are archived, by source and month.")
+        parser.add_argument('--no-archive', action='store_true',
+            help="Don't archive raw payloads.")
+        parser.add_argument('--loader', choices=["rest", "orm"], default="rest",
+            help="Load via the REST API of the production server, or directly into this host's database. "
+                 "The ORM loader is much faster, but needs access to the production database.")
+        parser.add_argument('--replay', action='store_true',
+            help="Transform & load the archived payloads instead of fetching from the payment processors. "
+                 "Credentials for the payment processors aren't needed.")
+
     def handle(self, *args, **options):
 
         print("")
 
-        rest_token = input("REST API token: ")
-        # rest_token = os.getenv('BZWOPS_ETL_REST_TOKEN', None)
+        prefetch_limits = parse_limits(options['prefetch'], AbstractFetcher.prefetch_pages)
+        pool_limits = parse_limits(options['pool_size'], AbstractFetcher.pool_size)
+
+        sources = options['sources'] or input("Fetchers: ").split()
+        # sources = ["bzw_ops.etlfetchers.paypal"]
+        # sources = ["bzw_ops.etlfetchers.wepay"]
+        # sources = ["bzw_ops.etlfetchers.square_v2"]
 
-        fetchers = input("Fetchers: ").split()
-        # fetchers = ["bzw_ops.etlfetchers.paypal"]
-        # fetchers = ["bzw_ops.etlfetchers.wepay"]
-        # fetchers = ["bzw_ops.etlfetchers.square_v2"]
+        if options['enqueue']:
+            from bzw_ops.worker import conn
+            job_options = {
+                'overlap_days': options['overlap_days'],
+                'all_history': options['all_history'],
+                'job_timeout_secs': options['job_timeout'],
+            }
+            for source in sources:
+                job = enqueue_source(fetcher_path(source), conn, options['chunk_days'], job_options)
+                print("Enqueued {} as job {}".format(source, job.id))
+            return
 
-        fetchers = [__import__(x, fromlist=["Fetcher"]) for x in fetchers]
-        fetchers = [getattr(x, 'Fetcher') for x in fetchers]
-        fetchers = [x() for x in fetchers]
+        use_rest = options['loader'] == "rest"
+        rest_token = AbstractFetcher.ask("REST API token: ", "BZWOPS_ETL_REST_TOKEN") if use_rest else None
 
+        fetchers = [import_string(fetcher_path(x)) for x in sources]
+        fetchers = [x() for x in fetchers]  # These prompt for credentials, so they aren't created in parallel.
+
+        active_fetchers = []  # type: List[AbstractFetcher]
         for fetcher in fetchers:
+            if options['replay']:
+                fetcher.skip = False
             if fetcher.skip:
                 print("\nSkipping {}".format(str(fetcher)))
             else:
+                if rest_token is not None:
+                    fetcher.django_auth_headers = {'Authorization': "Token " + rest_token}
+                else:
+                    fetcher.loader = OrmLoader()
+                fetcher.sync_overlap_days = options['overlap_days']
+                fetcher.ignore_sync_cursor = options['all_history']
+                if options['replay'] or not options['no_archive']:
+                    fetcher.archive = PayloadArchive(options['archive_dir'], fetcher.sync_name)
+                fetcher.replaying = options['replay']
+                source = fetcher.sync_name
+                fetcher.configure(
+                    prefetch_limits.get(source, prefetch_limits[""]),
+                    pool_limits.get(source, pool_limits[""])
+                )
+                active_fetchers.append(fetcher)
+
+        if not options['parallel'] or len(active_fetchers) < 2:
+            for fetcher in active_fetchers:
                 print("\nProcessing {}".format(str(fetcher)))
-                fetcher.django_auth_headers = {'Authorization': "Token " + rest_token}
-                fetcher.fetch()
+                fetcher.run()
+            return
+
+        def run(fetcher: AbstractFetcher):
+            try:
+                fetcher.run()
+            finally:
+                connections.close_all()  # Each thread has its own DB connections.
+
+        print("\nProcessing {} in parallel".format(", ".join(f.sync_name for f in active_fetchers)))
+        with ThreadPoolExecutor(max_workers=len(active_fetchers)) as executor:
+            futures = [(fetcher, executor.submit(run, fetcher)) for fetcher in active_fetchers]
+        failed = 0
+        for fetcher, future in futures:
+            error = future.exception()
+            if error is not None:
+                failed += 1
+                print("\n{} failed: {}".format(fetcher.sync_name, error))
+        if failed > 0:
+            raise CommandError("{} of {} fetchers failed.".format(failed, len(active_fetchers)))
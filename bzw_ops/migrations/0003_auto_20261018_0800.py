@@ -0,0 +1,25 @@
+# Generated by Django 2.1.11 on 2026-10-18 14:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bzw_ops', '0002_auto_20171003_1201'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EtlSyncState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fetcher', models.CharField(help_text="The name of the fetcher, e.g. 'square'.", max_length=40, unique=True)),
+                ('cursor', models.CharField(blank=True, help_text="The fetcher's high-water mark, e.g. the ISO date through which payments were loaded. Clear it to refetch all history.", max_length=80)),
+                ('when_updated', models.DateTimeField(auto_now=True, help_text='The date/time at which the cursor was last advanced.')),
+            ],
+            options={
+                'verbose_name': 'ETL sync state',
+            },
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 2.1.11 on 2026-10-18 14:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bzw_ops', '0003_auto_20261018_0800'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EtlRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fetcher', models.CharField(help_text="The name of the fetcher, e.g. 'square'.", max_length=40)),
+                ('started', models.DateTimeField(help_text='The date/time at which the run started.')),
+                ('finished', models.DateTimeField(help_text='The date/time at which the run finished or failed.')),
+                ('succeeded', models.BooleanField(default=False, help_text='Whether the run finished without raising an exception.')),
+                ('replay', models.BooleanField(default=False, help_text='Whether the run transformed & loaded archived payloads instead of fetching new ones.')),
+                ('pages_fetched', models.PositiveIntegerField(default=0, help_text='The number of payloads fetched from the payment processor, e.g. pages of payments or receipts.')),
+                ('items_added', models.PositiveIntegerField(default=0, help_text='The number of items that were added.')),
+                ('items_updated', models.PositiveIntegerField(default=0, help_text='The number of items that were changed.')),
+                ('items_equal', models.PositiveIntegerField(default=0, help_text='The number of items that were already up to date.')),
+                ('items_protected', models.PositiveIntegerField(default=0, help_text="The number of items that weren't changed because they're protected.")),
+                ('items_errored', models.PositiveIntegerField(default=0, help_text="The number of items that couldn't be loaded because of errors.")),
+                ('http_requests', models.PositiveIntegerField(default=0, help_text='The number of HTTP requests made, including retries.')),
+                ('http_retries', models.PositiveIntegerField(default=0, help_text='The number of HTTP requests that were retried because of throttling or failures.')),
+                ('latency_p50', models.FloatField(blank=True, help_text='Median HTTP latency, in seconds.', null=True)),
+                ('latency_p95', models.FloatField(blank=True, help_text='95th percentile HTTP latency, in seconds.', null=True)),
+                ('latency_p99', models.FloatField(blank=True, help_text='99th percentile HTTP latency, in seconds.', null=True)),
+                ('bytes_transferred', models.BigIntegerField(default=0, help_text='HTTP request and response bodies, in bytes.')),
+                ('fetch_secs', models.FloatField(default=0.0, help_text='Time that transform & load spent waiting for data from the payment processor.')),
+                ('transform_secs', models.FloatField(default=0.0, help_text="Time spent transforming data. This is what's left after fetch and load time.")),
+                ('load_secs', models.FloatField(default=0.0, help_text='Time spent loading data into Django.')),
+            ],
+            options={
+                'verbose_name': 'ETL run',
+                'ordering': ['-started'],
+            },
+        ),
+    ]
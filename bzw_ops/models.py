@@ -84,4 +84,94 @@ class TimeBlock(models.Model):
         ords = ordinals_of_month_str(self)  # type: str
         days = days_of_week_str(self)  # type: str
         dur = duration_single_unit_str(self.duration)  # type: str
-        return "{} / {} at {} for {}".format(ords, days, self.start_time, dur)
\ No newline at end of file
+        return "{} / {} at {} for {}".format(ords, days, self.start_time, dur)
+
+
+class EtlSyncState(models.Model):
+    """Where each ETL fetcher left off, so that the next run only fetches new or changed data."""
+
+    fetcher = models.CharField(max_length=40, unique=True, null=False, blank=False,
+        help_text="The name of the fetcher, e.g. 'square'.")
+
+    cursor = models.CharField(max_length=80, null=False, blank=True,
+        help_text="The fetcher's high-water mark, e.g. the ISO date through which payments were loaded. Clear it to refetch all history.")
+
+    when_updated = models.DateTimeField(auto_now=True,
+        help_text="The date/time at which the cursor was last advanced.")
+
+    def __str__(self):
+        return "{} through {}".format(self.fetcher, self.cursor if self.cursor > "" else "(start)")
+
+    class Meta:
+        verbose_name = "ETL sync state"
+
+
+class EtlRun(models.Model):
+    """A record of one ETL fetcher run, for spotting slow or degrading sources and measuring ETL changes."""
+
+    fetcher = models.CharField(max_length=40, null=False, blank=False,
+        help_text="The name of the fetcher, e.g. 'square'.")
+
+    started = models.DateTimeField(null=False, blank=False,
+        help_text="The date/time at which the run started.")
+
+    finished = models.DateTimeField(null=False, blank=False,
+        help_text="The date/time at which the run finished or failed.")
+
+    succeeded = models.BooleanField(default=False,
+        help_text="Whether the run finished without raising an exception.")
+
+    replay = models.BooleanField(default=False,
+        help_text="Whether the run transformed & loaded archived payloads instead of fetching new ones.")
+
+    pages_fetched = models.PositiveIntegerField(default=0,
+        help_text="The number of payloads fetched from the payment processor, e.g. pages of payments or receipts.")
+
+    items_added = models.PositiveIntegerField(default=0,
+        help_text="The number of items that were added.")
+
+    items_updated = models.PositiveIntegerField(default=0,
+        help_text="The number of items that were changed.")
+
+    items_equal = models.PositiveIntegerField(default=0,
+        help_text="The number of items that were already up to date.")
+
+    items_protected = models.PositiveIntegerField(default=0,
+        help_text="The number of items that weren't changed because they're protected.")
+
+    items_errored = models.PositiveIntegerField(default=0,
+        help_text="The number of items that couldn't be loaded because of errors.")
+
+    http_requests = models.PositiveIntegerField(default=0,
+        help_text="The number of HTTP requests made, including retries.")
+
+    http_retries = models.PositiveIntegerField(default=0,
+        help_text="The number of HTTP requests that were retried because of throttling or failures.")
+
+    latency_p50 = models.FloatField(null=True, blank=True,
+        help_text="Median HTTP latency, in seconds.")
+
+    latency_p95 = models.FloatField(null=True, blank=True,
+        help_text="95th percentile HTTP latency, in seconds.")
+
+    latency_p99 = models.FloatField(null=True, blank=True,
+        help_text="99th percentile HTTP latency, in seconds.")
+
+    bytes_transferred = models.BigIntegerField(default=0,
+        help_text="HTTP request and response bodies, in bytes.")
+
+    fetch_secs = models.FloatField(default=0.0,
+        help_text="Time that transform & load spent waiting for data from the payment processor.")
+
+    transform_secs = models.FloatField(default=0.0,
+        help_text="Time spent transforming data. This is what's left after fetch and load time.")
+
+    load_secs = models.FloatField(default=0.0,
+        help_text="Time spent loading data into Django.")
+
+    def __str__(self):
+        return "{} at {}".format(self.fetcher, self.started)
+
+    class Meta:
+        verbose_name = "ETL run"
+        ordering = ['-started']
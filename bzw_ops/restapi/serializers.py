@@ -51,3 +51,9 @@ class TimeBlockTypeSerializer(serializers.ModelSerializer):
             'is_default',
         )
 
+
+class EtlRunSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = models.EtlRun
+        fields = '__all__'
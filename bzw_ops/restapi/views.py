@@ -1,14 +1,26 @@
 
 # Standard
 from datetime import datetime
+from typing import Dict, Iterable, List, Optional
 
 # Third Party
-from rest_framework import viewsets
-from rest_framework.permissions import IsAuthenticatedOrReadOnly
+from django.db import transaction
+from django.db.models import QuerySet
+from rest_framework import viewsets, status
+from rest_framework.decorators import api_view, authentication_classes, permission_classes
+from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.permissions import IsAuthenticatedOrReadOnly, IsAdminUser
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.response import Response
 
 # Local
 import bzw_ops.models as models
 import bzw_ops.restapi.serializers as serializers
+import books.models as bm
+import books.serializers as bs
+import members.models as mm
+import members.restapi.serializers as ms
+from abutils.utils import has_new_data
 
 
 # ---------------------------------------------------------------------------
@@ -25,3 +37,227 @@ class TimeBlockTypeViewSet(viewsets.ModelViewSet):
     queryset = models.TimeBlockType.objects.all().order_by('id')
     serializer_class = serializers.TimeBlockTypeSerializer
     permission_classes = [IsAuthenticatedOrReadOnly]
+
+
+# ---------------------------------------------------------------------------
+# ETL UPSERT
+# ---------------------------------------------------------------------------
+
+# The models that ETL fetchers can upsert, keyed by model label.
+UPSERT_SERIALIZERS = {
+    bm.Sale._meta.label:                        bs.SaleSerializer,
+    bm.MonetaryDonation._meta.label:            bs.MonetaryDonationSerializer,
+    bm.OtherItem._meta.label:                   bs.OtherItemSerializer,
+    mm.Membership._meta.label:                  ms.MembershipSerializer,
+    mm.MembershipGiftCardReference._meta.label: ms.MembershipGiftCardReferenceSerializer,
+}
+
+# Outcomes reported for each record:
+UPSERT_ADDED = "+"
+UPSERT_UPDATED = "U"
+UPSERT_EQUAL = "="
+UPSERT_PROTECTED = "P"
+UPSERT_ERROR = "E"
+
+
+def _objs_by_ctrlid(model_class, ctrlids: List[str]) -> Dict[str, list]:
+    result = dict()  # type: Dict[str, list]
+    for obj in model_class.objects.filter(ctrlid__in=set(ctrlids)):
+        result.setdefault(obj.ctrlid, []).append(obj)
+    return result
+
+
+def unique_matches(rows: Iterable) -> Dict[str, dict]:
+    """
+    :param rows: (ctrlid, id, protected, etl_hash) for some records.
+    :return: {"id", "protected", "etl_hash"} keyed by ctrlid, for the ctrlids that match exactly one record.
+    """
+    matches = dict()  # type: Dict[str, dict]
+    duplicates = set()
+    for ctrlid, id, protected, etl_hash in rows:
+        if ctrlid in matches:
+            duplicates.add(ctrlid)
+        matches[ctrlid] = {'id': id, 'protected': protected, 'etl_hash': etl_hash}
+    return {ctrlid: match for ctrlid, match in matches.items() if ctrlid not in duplicates}
+
+
+def existing_hashes(ctrlids: Dict[str, List[str]]) -> Dict[str, Dict[str, dict]]:
+    """
+    Looks up the records with the given ctrlids, one query per model.
+    :param ctrlids: Lists of ctrlids, keyed by model label.
+    :return: {"id", "protected", "etl_hash"} for each ctrlid that matches exactly one record, keyed by label & ctrlid.
+    """
+    result = dict()  # type: Dict[str, Dict[str, dict]]
+    for label, model_ctrlids in ctrlids.items():
+        if label not in UPSERT_SERIALIZERS:
+            continue
+        model_class = UPSERT_SERIALIZERS[label].Meta.model
+        rows = model_class.objects.filter(ctrlid__in=set(model_ctrlids))
+        result[label] = unique_matches(rows.values_list('ctrlid', 'id', 'protected', 'etl_hash'))
+    return result
+
+
+def ctrlid_rows(label: str, prefix: str = "", start: Optional[str] = None, stop: Optional[str] = None) -> QuerySet:
+    """
+    The (ctrlid, id, protected, etl_hash) of a model's records, ordered by id.
+    :param prefix: If given, only records whose ctrlid starts with it, e.g. "SQ:".
+    :param start, stop: If given, only records whose sale date is in [start, stop), as ISO dates.
+    """
+    model_class = UPSERT_SERIALIZERS[label].Meta.model
+    sale_date = 'sale_date' if model_class is bm.Sale else 'sale__sale_date'
+    rows = model_class.objects.all()
+    if prefix > "":
+        rows = rows.filter(ctrlid__startswith=prefix)
+    if start is not None:
+        rows = rows.filter(**{sale_date + '__gte': start})
+    if stop is not None:
+        rows = rows.filter(**{sale_date + '__lt': stop})
+    return rows.order_by('id').values_list('ctrlid', 'id', 'protected', 'etl_hash')
+
+
+def upsert_records(records: List[dict], context: dict, sync_state: Optional[dict] = None) -> dict:
+    """
+    Adds or updates the given records, using ctrlid as the natural key.
+    Each record is {"model": <label>, "data": <serializer data>} and can also have a "sale_ctrlid"
+    that identifies its sale, in which case it needn't know the sale's id. Records are processed in order,
+    so a sale can be followed by its line items in the same list.
+    If sync_state ({"fetcher": <name>, "cursor": <high-water mark>}) is given, the fetcher's EtlSyncState
+    is advanced in the same transaction, but only if none of the records had errors.
+    :return: {"results": <one result per record>, "sync_state_saved": <bool>}.
+      Each result has "ctrlid", "outcome", "id", "protected", and "errors" on failure.
+    """
+    # Resolve all the existing objects up front, one query per model.
+    ctrlids = dict()  # type: Dict[str, List[str]]
+    for record in records:
+        ctrlids.setdefault(record['model'], []).append(record['data'].get('ctrlid'))
+        if record.get('sale_ctrlid') is not None:
+            ctrlids.setdefault(bm.Sale._meta.label, []).append(record['sale_ctrlid'])
+    existing = dict()  # type: Dict[str, Dict[str, list]]
+    for label, model_ctrlids in ctrlids.items():
+        if label in UPSERT_SERIALIZERS:
+            model_class = UPSERT_SERIALIZERS[label].Meta.model
+            existing[label] = _objs_by_ctrlid(model_class, model_ctrlids)
+
+    def upsert_record(record: dict) -> dict:
+        label = record['model']
+        data = dict(record['data'])
+        ctrlid = data.get('ctrlid')
+        result = {'ctrlid': ctrlid, 'id': None, 'protected': False}
+
+        if label not in UPSERT_SERIALIZERS:
+            return dict(result, outcome=UPSERT_ERROR, errors="Can't upsert {}".format(label))
+        serializer_class = UPSERT_SERIALIZERS[label]
+
+        sale_ctrlid = record.get('sale_ctrlid')
+        if sale_ctrlid is not None:
+            sales = existing[bm.Sale._meta.label].get(sale_ctrlid, [])
+            if len(sales) != 1:
+                return dict(result, outcome=UPSERT_ERROR, errors="No unique sale with ctrlid {}".format(sale_ctrlid))
+            if sales[0].protected:
+                # If the sale is protected then all details are also protected.
+                return dict(result, outcome=UPSERT_PROTECTED, protected=True)
+            data['sale'] = sales[0].pk
+
+        matches = existing[label].get(ctrlid, [])
+        if len(matches) > 1:
+            return dict(result, outcome=UPSERT_ERROR, errors="Too many matches for ctrlid {}".format(ctrlid))
+        obj = matches[0] if len(matches) == 1 else None
+
+        if obj is None:
+            serializer = serializer_class(data=data, context=context)
+            outcome = UPSERT_ADDED
+        elif obj.protected:
+            return dict(result, outcome=UPSERT_PROTECTED, id=obj.pk, protected=True)
+        elif data.get('etl_hash', "") > "":
+            # The hash covers all of the record's data, so there's no need to compare it field by field.
+            if data['etl_hash'] == obj.etl_hash:
+                return dict(result, outcome=UPSERT_EQUAL, id=obj.pk)
+            serializer = serializer_class(obj, data=data, context=context)
+            outcome = UPSERT_UPDATED
+        elif has_new_data(serializer_class(obj, context=context).data, data):
+            serializer = serializer_class(obj, data=data, context=context)
+            outcome = UPSERT_UPDATED
+        else:
+            return dict(result, outcome=UPSERT_EQUAL, id=obj.pk)
+
+        if not serializer.is_valid():
+            return dict(result, outcome=UPSERT_ERROR, errors=serializer.errors)
+        with transaction.atomic():  # A savepoint, so that one bad record doesn't spoil the rest.
+            obj = serializer.save()
+        existing[label][ctrlid] = [obj]  # In case a later record in this batch refers to it.
+        return dict(result, outcome=outcome, id=obj.pk, protected=obj.protected)
+
+    results = []  # type: List[dict]
+    sync_state_saved = False
+    with transaction.atomic(), bm.PayerIndex():  # Only built if a sale needs linking to a user.
+        for record in records:
+            try:
+                results.append(upsert_record(record))
+            except Exception as e:
+                ctrlid = record.get('data', {}).get('ctrlid')
+                results.append({'ctrlid': ctrlid, 'id': None, 'protected': False, 'outcome': UPSERT_ERROR, 'errors': str(e)})
+        if sync_state is not None and all(r['outcome'] != UPSERT_ERROR for r in results):
+            models.EtlSyncState.objects.update_or_create(
+                fetcher=sync_state['fetcher'],
+                defaults={'cursor': sync_state['cursor']}
+            )
+            sync_state_saved = True
+    return {'results': results, 'sync_state_saved': sync_state_saved}
+
+
+@api_view(['POST'])
+@authentication_classes([TokenAuthentication])
+@permission_classes([IsAdminUser])
+def etl_upsert(request) -> Response:
+    """ Upsert a batch of records from an ETL fetcher in a single transaction. See upsert_records(). """
+    records = request.data.get('records', [])
+    sync_state = request.data.get('sync_state', None)
+    return Response(upsert_records(records, {'request': request}, sync_state))
+
+
+@api_view(['POST'])
+@authentication_classes([TokenAuthentication])
+@permission_classes([IsAdminUser])
+def etl_hashes(request) -> Response:
+    """ Get the ids, protection, and ETL hashes of records, given their ctrlids by model label. """
+    return Response(existing_hashes(request.data.get('ctrlids', {})))
+
+
+class CtrlidMapPagination(LimitOffsetPagination):
+    """The rows of a ctrlid map are small, so its pages are bigger than the API's usual."""
+    default_limit = 5000
+    max_limit = 20000
+
+
+@api_view(['GET'])
+@authentication_classes([TokenAuthentication])
+@permission_classes([IsAdminUser])
+def etl_ctrlids(request, label: str) -> Response:
+    """ Get a page of [ctrlid, id, protected, etl_hash] rows for a model. Filters are as for ctrlid_rows(). """
+    if label not in UPSERT_SERIALIZERS:
+        return Response({'detail': "Can't upsert {}".format(label)}, status=status.HTTP_404_NOT_FOUND)
+    params = request.query_params
+    rows = ctrlid_rows(label, params.get('prefix', ""), params.get('start'), params.get('stop'))
+    paginator = CtrlidMapPagination()
+    page = paginator.paginate_queryset(rows, request)
+    return paginator.get_paginated_response([list(row) for row in page])
+
+
+@api_view(['GET'])
+@authentication_classes([TokenAuthentication])
+@permission_classes([IsAdminUser])
+def etl_sync_state(request, fetcher: str) -> Response:
+    """ Get the given ETL fetcher's cursor, which is "" if it hasn't synced before. """
+    state = models.EtlSyncState.objects.filter(fetcher=fetcher).first()
+    return Response({'fetcher': fetcher, 'cursor': state.cursor if state is not None else ""})
+
+
+@api_view(['POST'])
+@authentication_classes([TokenAuthentication])
+@permission_classes([IsAdminUser])
+def etl_runs(request) -> Response:
+    """ Save the record of an ETL fetcher's run. """
+    serializer = serializers.EtlRunSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+    serializer.save()
+    return Response(serializer.data, status=status.HTTP_201_CREATED)
@@ -216,6 +216,18 @@ DATABASES = {
     }
 }
 
+# Cache
+# https://docs.djangoproject.com/en/2.1/topics/cache/
+# This is shared by the web and worker processes, so it's used to coordinate their
+# per-process caches, e.g. Account.acct_cache. Its table is made by "createcachetable".
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'bzw_ops_cache',
+    }
+}
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.8/topics/i18n/
 
@@ -396,8 +408,12 @@ BZWOPS_ORG_NAME_POSSESSIVE = "Xerocraft's"
 # Set the BZWOPS_FACILITY_PUBLIC_IP environment variable to either:
 #   (1) A DNS name that resolves to the facility's public IP
 #   (2) The facility's static IP address.
+# Several of these, and CIDR ranges, can be given, separated by commas. See abutils.facility.
 BZWOPS_FACILITY_PUBLIC_IP = os.getenv('XEROPS_FACILITY_PUBLIC_IP', None)
 
+# DNS names in BZWOPS_FACILITY_PUBLIC_IP are resolved again, in the background, after this many seconds.
+BZWOPS_FACILITY_IP_TTL_SECS = 300
+
 
 # TODO: Switch to the following format for BzwOps config?
 # These are settings that can be used by any of the BzwOps apps.
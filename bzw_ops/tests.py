@@ -1,12 +1,39 @@
 
 # Standard
+import os
+import json
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import date, timedelta
+from decimal import Decimal
 
 # Third Party
+import fakeredis
+from rq import Queue, SimpleWorker
+from rq.job import Job
+from rq.registry import FinishedJobRegistry
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.contrib import admin
+from django.contrib.auth.models import User
 from django.core.management import call_command
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
 
 # Local
+from books.models import Sale, MonetaryDonation, DirtyJournaler
+from members.models import Membership
+from bzw_ops.models import EtlSyncState, EtlRun
+from bzw_ops.etlfetchers.abstractfetcher import AbstractFetcher, prefetched, date_chunks
+from bzw_ops.etlfetchers.archive import PayloadArchive
+from bzw_ops.etlfetchers.httpclient import ResilientSession, HttpPolicy, RateLimit, CircuitOpenError
+from bzw_ops.etlfetchers.loaders import OrmLoader
+from bzw_ops.etlfetchers.telemetry import percentile
+from bzw_ops.management.commands.etl import parse_limits
+from bzw_ops.etljobs import ETL_QUEUE, JOB_TIMEOUT_SECS, enqueue_source, fetcher_path
 
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 
@@ -73,6 +100,513 @@ class TestAdminConfig(TestCase):
                         check_fieldname(fieldname, model_class, admin_obj)
 
 
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+
+def external_id_queries(queries: CaptureQueriesContext) -> int:
+    """The number of queries of all ExternalIds, which are only made to build a PayerIndex."""
+    return sum('FROM "members_externalid"' in q['sql'] and 'WHERE' not in q['sql'] for q in queries.captured_queries)
+
+
+class TestEtlUpsert(TestCase):
+
+    fixtures = ['test_data']
+
+    def setUp(self):
+        admin_user = User.objects.create_superuser("etl", "etl@example.com", "pw")
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + Token.objects.create(user=admin_user).key)
+
+    def records(self, amount="25.00", sale_protected=False):
+        sale = {
+            'sale_date': "2018-01-05", 'payer_name': "Jane Doe", 'payer_email': "",
+            'payment_method': Sale.PAID_BY_SQUARE, 'method_detail': "Visa",
+            'total_paid_by_customer': amount, 'processing_fee': "0.00", 'fee_payer': Sale.FEE_PAID_BY_US,
+            'ctrlid': "SQ:123", 'protected': sale_protected,
+        }
+        don = {'sale': None, 'amount': amount, 'ctrlid': "SQ:123:1:1", 'protected': False}
+        return [
+            {'model': "books.Sale", 'data': sale},
+            {'model': "books.MonetaryDonation", 'data': don, 'sale_ctrlid': "SQ:123"},
+        ]
+
+    def upsert(self, records):
+        response = self.client.post("/ops/api/etl-upsert/", {'records': records}, format='json')
+        self.assertEqual(response.status_code, 200)
+        return [result['outcome'] for result in response.json()['results']]
+
+    def test_add_then_equal_then_update(self):
+        self.assertEqual(self.upsert(self.records()), ["+", "+"])
+        self.assertEqual(MonetaryDonation.objects.get(ctrlid="SQ:123:1:1").sale.ctrlid, "SQ:123")
+        self.assertEqual(self.upsert(self.records()), ["=", "="])
+        self.assertEqual(self.upsert(self.records(amount="30.00")), ["U", "U"])
+        self.assertEqual(Sale.objects.get(ctrlid="SQ:123").total_paid_by_customer, 30)
+
+    def test_payer_index_is_built_when_needed(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.upsert(self.records()), ["+", "+"])
+            self.assertEqual(self.upsert(self.records()), ["=", "="])  # No sales to link.
+        self.assertEqual(external_id_queries(queries), 1)
+
+    def test_protected_sale_protects_line_items(self):
+        self.upsert(self.records())
+        Sale.objects.filter(ctrlid="SQ:123").update(protected=True)
+        self.assertEqual(self.upsert(self.records(amount="30.00")), ["P", "P"])
+        self.assertEqual(MonetaryDonation.objects.get(ctrlid="SQ:123:1:1").amount, 25)
+
+    def test_errors_dont_spoil_batch(self):
+        records = self.records()
+        records[0]['data']['payment_method'] = "?"
+        records.append({'model': "books.Sale", 'data': dict(records[0]['data'], ctrlid="SQ:456", payment_method="S")})
+        self.assertEqual(self.upsert(records), ["E", "E", "+"])
+        self.assertTrue(Sale.objects.filter(ctrlid="SQ:456").exists())
+
+    def test_sync_state_advances_with_chunk(self):
+        response = self.client.get("/ops/api/etl-sync-state/square/")
+        self.assertEqual(response.json()['cursor'], "")
+        body = {'records': self.records(), 'sync_state': {'fetcher': "square", 'cursor': "2018-01-06"}}
+        response = self.client.post("/ops/api/etl-upsert/", body, format='json')
+        self.assertTrue(response.json()['sync_state_saved'])
+        response = self.client.get("/ops/api/etl-sync-state/square/")
+        self.assertEqual(response.json()['cursor'], "2018-01-06")
+
+    def test_sync_state_doesnt_advance_past_errors(self):
+        EtlSyncState.objects.create(fetcher="square", cursor="2018-01-01")
+        records = self.records()
+        records[0]['data']['payment_method'] = "?"
+        body = {'records': records, 'sync_state': {'fetcher': "square", 'cursor': "2018-01-06"}}
+        response = self.client.post("/ops/api/etl-upsert/", body, format='json')
+        self.assertFalse(response.json()['sync_state_saved'])
+        self.assertEqual(EtlSyncState.objects.get(fetcher="square").cursor, "2018-01-01")
+
+    def test_same_hash_is_equal(self):
+        records = self.records()
+        records[0]['data']['etl_hash'] = "a" * 40
+        self.assertEqual(self.upsert(records), ["+", "+"])
+        ctrlids = {'books.Sale': ["SQ:123", "SQ:999"]}
+        response = self.client.post("/ops/api/etl-hashes/", {'ctrlids': ctrlids}, format='json')
+        self.assertEqual(list(response.json()['books.Sale'].keys()), ["SQ:123"])
+        self.assertEqual(response.json()['books.Sale']["SQ:123"]['etl_hash'], "a" * 40)
+        records[0]['data']['total_paid_by_customer'] = "30.00"  # Not looked at, because the hash is the same.
+        self.assertEqual(self.upsert(records), ["=", "="])
+        records[0]['data']['etl_hash'] = "b" * 40
+        self.assertEqual(self.upsert(records), ["U", "="])
+
+    def test_ctrlid_map(self):
+        records = self.records()
+        records.append({'model': "books.Sale", 'data': dict(records[0]['data'], ctrlid="PP:1", sale_date="2018-01-09")})
+        self.upsert(records)
+
+        def rows(label, **params):
+            response = self.client.get("/ops/api/etl-ctrlids/{}/".format(label), params)
+            self.assertEqual(response.status_code, 200)
+            return response.json()
+
+        page = rows("books.Sale", limit=1)
+        self.assertEqual((page['count'], len(page['results'])), (2, 1))
+        self.assertIsNotNone(page['next'])
+        sale_id = Sale.objects.get(ctrlid="SQ:123").id
+        self.assertEqual(rows("books.Sale", prefix="SQ:")['results'], [["SQ:123", sale_id, False, ""]])
+        self.assertEqual(rows("books.Sale", start="2018-01-06")['results'][0][0], "PP:1")
+        self.assertEqual(rows("books.MonetaryDonation", stop="2018-01-06")['count'], 1)  # By the date of its sale.
+        self.assertEqual(rows("books.MonetaryDonation", stop="2018-01-05")['count'], 0)
+        self.assertEqual(self.client.get("/ops/api/etl-ctrlids/auth.User/").status_code, 404)
+
+    def test_save_run(self):
+        run = {
+            'fetcher': "square", 'started': "2018-01-06T10:00:00Z", 'finished': "2018-01-06T10:05:00Z",
+            'succeeded': True, 'items_added': 3, 'latency_p95': 0.25, 'load_secs': 12.5,
+        }
+        response = self.client.post("/ops/api/etl-runs/", run, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(EtlRun.objects.get(fetcher="square").items_added, 3)
+
+    def test_requires_admin(self):
+        self.client.credentials()
+        response = self.client.post("/ops/api/etl-upsert/", {'records': []}, format='json')
+        self.assertEqual(response.status_code, 401)
+
+
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+
+class TestOrmLoader(TestCase):
+
+    fixtures = ['test_data']
+
+    def setUp(self):
+        self.fetcher = AbstractFetcher()
+        self.fetcher.loader = OrmLoader()
+
+    def upsert(self, amount="25.00", sale_protected=False):
+        sale = Sale(
+            sale_date=date(2018, 1, 5), payer_name="Jane Doe", payer_email="jdoe@example.com",
+            payment_method=Sale.PAID_BY_SQUARE, method_detail="Visa",
+            total_paid_by_customer=Decimal(amount), processing_fee=Decimal("0.00"), fee_payer=Sale.FEE_PAID_BY_US,
+            ctrlid="SQ:123", protected=sale_protected,
+        )
+        mship = Membership(
+            sale=Sale(ctrlid="SQ:123"), sale_price=Decimal(amount) / Decimal(3), ctrlid="SQ:123:1:1",
+            membership_type=Membership.MT_REGULAR, start_date=date(2018, 1, 5), end_date=date(2018, 2, 4),
+        )
+        self.fetcher.upsert(sale)
+        self.fetcher.upsert(mship)
+        return [result['outcome'] for result in self.fetcher.flush_upserts()]
+
+    def test_add_then_equal_then_update(self):
+        self.assertEqual(self.upsert(), ["+", "+"])
+        self.assertEqual(Membership.objects.get(ctrlid="SQ:123:1:1").sale.ctrlid, "SQ:123")
+        self.assertEqual(self.upsert(), ["=", "="])  # Decimals are compared as they were saved.
+        self.assertEqual(self.upsert(amount="30.00"), ["U", "U"])
+        self.assertEqual(Membership.objects.get(ctrlid="SQ:123:1:1").sale_price, Decimal("10.00"))
+
+    def test_payer_index_is_built_once(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.upsert(), ["+", "+"])
+            self.assertEqual(self.upsert(amount="30.00"), ["U", "U"])
+        self.assertEqual(external_id_queries(queries), 1)
+
+    def test_links_and_marks_like_signals(self):
+        user = User.objects.create_user("jdoe", "jdoe@example.com", "pw")
+        self.upsert()
+        sale = Sale.objects.get(ctrlid="SQ:123")
+        self.assertEqual(sale.payer_acct, user)
+        self.assertEqual(Membership.objects.get(ctrlid="SQ:123:1:1").member, user.member)
+        self.assertTrue(DirtyJournaler.objects.filter(object_id=sale.pk).exists())
+
+    def test_protected_sale_protects_line_items(self):
+        self.upsert()
+        Sale.objects.filter(ctrlid="SQ:123").update(protected=True)
+        self.assertEqual(self.upsert(amount="30.00"), ["P", "P"])
+        self.assertEqual(Membership.objects.get(ctrlid="SQ:123:1:1").sale_price, Decimal("8.33"))
+
+    def test_unchanged_items_arent_loaded(self):
+        loaded = []
+        load = self.fetcher.loader.load
+
+        def counting_load(items, records, sync_state):
+            loaded.append(len(items))
+            return load(items, records, sync_state)
+        self.fetcher.loader.load = counting_load
+        self.assertEqual(self.upsert(), ["+", "+"])
+        self.assertEqual(self.upsert(), ["=", "="])
+        self.assertEqual(self.upsert(amount="30.00"), ["U", "U"])
+        self.assertEqual(loaded, [2, 2])
+        self.assertEqual(len(Sale.objects.get(ctrlid="SQ:123").etl_hash), 40)
+
+    def test_ctrlid_map_replaces_hash_lookups(self):
+        self.upsert()
+        lookups = []
+        hashes = self.fetcher.loader.hashes
+
+        def counting_hashes(ctrlids):
+            lookups.append(ctrlids)
+            return hashes(ctrlids)
+        self.fetcher.loader.hashes = counting_hashes
+        self.fetcher.CTRLID_PREFIX = "SQ"
+        self.fetcher.prefetch_ctrlids(date(2018, 1, 1), date(2018, 1, 8))
+        self.assertEqual(set(self.fetcher.ctrlid_map['books.Sale'].keys()), {"SQ:123"})
+        self.assertEqual(self.upsert(), ["=", "="])
+        self.assertEqual(self.upsert(amount="30.00"), ["U", "U"])
+        self.assertEqual(self.upsert(amount="30.00"), ["=", "="])  # The map was updated as they were loaded.
+        self.assertEqual(lookups, [])
+
+    def test_items_are_loaded_as_they_were_upserted(self):
+        # Like PayPal's family memberships, which reuse the primary membership's instance.
+        self.fetcher.ctrlid_map = dict()
+        sale = Sale(
+            sale_date=date(2018, 1, 5), payer_name="Jane Doe", payer_email="jdoe@example.com",
+            payment_method=Sale.PAID_BY_SQUARE, method_detail="Visa",
+            total_paid_by_customer=Decimal("60.00"), processing_fee=Decimal("0.00"), fee_payer=Sale.FEE_PAID_BY_US,
+            ctrlid="SQ:123", protected=False,
+        )
+        self.fetcher.upsert(sale)
+        mship = Membership(
+            sale=sale, sale_price=Decimal("50.00"), ctrlid="SQ:123:P",
+            membership_type=Membership.MT_REGULAR, start_date=date(2018, 1, 5), end_date=date(2018, 2, 4),
+        )
+        self.fetcher.upsert(mship)
+        mship.membership_type, mship.ctrlid, mship.sale_price = Membership.MT_FAMILY, "SQ:123:1", Decimal("10.00")
+        self.fetcher.upsert(mship)
+        results = self.fetcher.flush_upserts()
+        self.assertEqual([r['outcome'] for r in results], ["+", "+", "+"])
+        self.assertEqual([r['ctrlid'] for r in results], ["SQ:123", "SQ:123:P", "SQ:123:1"])
+        mships = Membership.objects.filter(sale__ctrlid="SQ:123").order_by('ctrlid')
+        self.assertEqual([(m.ctrlid, m.membership_type, m.sale_price) for m in mships], [
+            ("SQ:123:1", Membership.MT_FAMILY, Decimal("10.00")),
+            ("SQ:123:P", Membership.MT_REGULAR, Decimal("50.00")),
+        ])
+        for m in mships:
+            self.assertEqual(self.fetcher.ctrlid_map['members.Membership'][m.ctrlid]['etl_hash'], m.etl_hash)
+
+    def test_sync_state(self):
+        self.fetcher.checkpoint("2018-01-06")
+        self.upsert()
+        self.assertEqual(self.fetcher.get_loader().sync_cursor("abstractfetcher"), "2018-01-06")
+
+
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+
+class StubFetcher(AbstractFetcher):
+
+    def __init__(self, ctrlids, fail=False):
+        self.ctrlids = ctrlids
+        self.fail = fail
+        self.loader = OrmLoader()
+
+    def fetch(self):
+        def pages():
+            yield self.archived("payments", "2018-01-05", self.ctrlids)
+            if self.fail:
+                raise ConnectionError("Lost the connection")
+        for page in self.fetched(pages()):
+            for ctrlid in page:
+                self.upsert(Sale(
+                    sale_date=date(2018, 1, 5), payer_name="Jane Doe", payer_email="",
+                    payment_method=Sale.PAID_BY_SQUARE, method_detail="Visa",
+                    total_paid_by_customer=Decimal("25.00"), processing_fee=Decimal("0.00"),
+                    fee_payer=Sale.FEE_PAID_BY_US, ctrlid=ctrlid,
+                ))
+        self._fetch_complete()
+
+
+class TestEtlRunTelemetry(TestCase):
+
+    def test_run_is_recorded(self):
+        StubFetcher(["SQ:1", "SQ:2"]).run()
+        with self.assertRaises(ConnectionError):
+            StubFetcher(["SQ:1", "SQ:3"], fail=True).run()
+        failed, succeeded = EtlRun.objects.all()  # Most recent first.
+        self.assertTrue(succeeded.succeeded)
+        self.assertEqual((succeeded.pages_fetched, succeeded.items_added), (1, 2))
+        self.assertFalse(failed.succeeded)
+        self.assertEqual((failed.items_added, failed.items_equal), (0, 0))  # Failed before its chunk was loaded.
+        self.assertGreaterEqual(succeeded.load_secs, 0.0)
+
+    def test_percentile(self):
+        self.assertIsNone(percentile([], 50))
+        self.assertEqual(percentile([1.0, 2.0, 3.0, 4.0], 50), 2.0)
+        self.assertEqual(percentile(list(range(1, 101)), 95), 95)
+
+
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+
+class TestEtlPipeline(TestCase):
+
+    def test_prefetched_keeps_order(self):
+        for depth in [0, 1, 3]:
+            self.assertEqual(list(prefetched(iter(range(10)), depth)), list(range(10)))
+
+    def test_prefetched_reraises(self):
+        def pages():
+            yield 1
+            raise ValueError("Page 2 failed")
+        consumed = []
+        with self.assertRaises(ValueError):
+            for page in prefetched(pages(), 2):
+                consumed.append(page)
+        self.assertEqual(consumed, [1])
+
+    def test_parse_limits(self):
+        self.assertEqual(parse_limits(["3", "square=1"], 2), {"": 3, "square": 1})
+        self.assertEqual(parse_limits([], 2), {"": 2})
+
+
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+
+class TestPayloadArchive(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.archive = PayloadArchive(self.root.name, "square")
+
+    def tearDown(self):
+        self.archive.close()
+        self.root.cleanup()
+
+    def test_round_trip(self):
+        self.archive.append("payments", "2018-01-01", [{'id': "A"}])
+        self.archive.append("receipt_name", "http://r/1", "Jane Doe")
+        self.archive.append("payments", "2018-01-01", [{'id': "A"}, {'id': "B"}])
+        self.archive.close()
+        self.archive.append("payments", "2018-01-08", [])  # Appends a new gzip member to the same file.
+        self.archive.close()
+        self.assertEqual(len(os.listdir(os.path.join(self.root.name, "square"))), 1)
+        self.assertEqual(list(self.archive.payloads("payments")), [[{'id': "A"}], [{'id': "A"}, {'id': "B"}], []])
+        self.assertEqual(self.archive.latest("payments")["2018-01-01"], [{'id': "A"}, {'id': "B"}])
+
+    def test_replay_uses_archive(self):
+        self.archive.append("receipt_name", "http://r/1", "Jane Doe")
+        self.archive.close()
+        fetcher = AbstractFetcher()
+        fetcher.archive = self.archive
+        fetcher.replaying = True
+
+        def no_network():
+            raise AssertionError("Replays shouldn't fetch anything.")
+        self.assertEqual(fetcher.extract("receipt_name", "http://r/1", no_network), "Jane Doe")
+        self.assertIsNone(fetcher.extract("receipt_name", "http://r/2", no_network))
+
+
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+
+class StubProviderHandler(BaseHTTPRequestHandler):
+    """Responds with the server's queued (status, headers) pairs, then with 200s. None is a 200 after a hang."""
+
+    def do_GET(self):
+        status, headers = self.server.queued.pop(0) if len(self.server.queued) > 0 else (200, {})
+        self.server.request_count += 1
+        if status is None:
+            time.sleep(1.0)
+            status = 200
+        try:
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(b"{}")
+        except BrokenPipeError:
+            pass  # The client stopped waiting.
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestResilientSession(TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubProviderHandler)
+        self.server.queued = []
+        self.server.request_count = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:{}/".format(self.server.server_port)
+        self.sleeps = []
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def session(self, **policy) -> ResilientSession:
+        session = ResilientSession("stub", policy=HttpPolicy(**policy), sleep=self.sleeps.append)
+        session.trust_env = False  # Don't use a proxy for the stub server.
+        return session
+
+    def test_retries_throttling_and_server_errors(self):
+        self.server.queued = [(429, {'Retry-After': "2"}), (503, {})]
+        session = self.session(backoff_secs=1.0)
+        self.assertEqual(session.get(self.url).status_code, 200)
+        self.assertEqual(self.server.request_count, 3)
+        self.assertEqual(self.sleeps[0], 2.0)  # As the provider asked.
+        self.assertTrue(0 <= self.sleeps[1] <= 2.0)  # Jittered backoff for the second attempt.
+        self.assertEqual(session.stats['throttled'], 1)
+
+    def test_retries_hung_requests(self):
+        self.server.queued = [(None, {})]
+        session = self.session(timeout_secs=0.1)
+        self.assertEqual(session.get(self.url).status_code, 200)
+        self.assertEqual(self.server.request_count, 2)
+        self.assertEqual(session.stats['retries'], 1)
+
+    def test_gives_up_after_max_retries(self):
+        self.server.queued = [(500, {})] * 3
+        self.assertEqual(self.session(max_retries=1).get(self.url).status_code, 500)
+        self.assertEqual(self.server.request_count, 2)
+
+    def test_circuit_opens(self):
+        self.server.queued = [(503, {})] * 10
+        with self.assertRaises(CircuitOpenError):
+            self.session(failure_threshold=3).get(self.url)
+        self.assertEqual(self.server.request_count, 3)
+
+    def test_rate_limit(self):
+        now = [0.0]
+        limit = RateLimit(rate=2.0, burst=2, clock=lambda: now[0], sleep=self.sleeps.append)
+        self.assertEqual([limit.acquire() for _ in range(3)], [0.0, 0.0, 0.5])
+        now[0] = 10.0
+        limit.defer(3.0)
+        self.assertEqual(limit.acquire(), 3.0)
+
+
+class ChunkedStubFetcher(AbstractFetcher):
+    """Upserts a sale per day from 2018-01-01 through 2018-01-10, in chunks."""
+
+    fail_on = None  # A day whose chunk fails.
+
+    def __init__(self):
+        self.skip = False
+
+    def chunks(self, days):
+        return date_chunks(date(2018, 1, 1), date(2018, 1, 11), days)
+
+    def fetch(self):
+        day, stop = self.chunk
+        while day < stop:
+            if day == self.fail_on:
+                raise ConnectionError("Lost the connection")
+            self.upsert(Sale(
+                sale_date=day, payer_name="Jane Doe", payer_email="",
+                payment_method=Sale.PAID_BY_SQUARE, method_detail="Visa",
+                total_paid_by_customer=Decimal("25.00"), processing_fee=Decimal("0.00"),
+                fee_payer=Sale.FEE_PAID_BY_US, ctrlid="SQ:" + day.isoformat(),
+            ))
+            day += timedelta(days=1)
+        self._fetch_complete()
+
+
+class TestEtlJobs(TestCase):
+
+    path = "bzw_ops.tests.ChunkedStubFetcher"
+
+    def setUp(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        self.worker = SimpleWorker([Queue(ETL_QUEUE, connection=self.redis)], connection=self.redis)
+        ChunkedStubFetcher.fail_on = None
+
+    def run_source(self) -> dict:
+        job = enqueue_source(self.path, self.redis, chunk_days=4)
+        self.worker.work(burst=True)
+        return json.loads(self.redis.get("etl:{}:result".format(job.id)).decode())
+
+    def test_chunks_are_totaled(self):
+        result = self.run_source()
+        self.assertEqual((result['chunks'], result['items_added']), (3, 10))
+        self.assertEqual(Sale.objects.count(), 10)
+        self.assertEqual(EtlRun.objects.count(), 3)  # One per chunk.
+        self.assertEqual(EtlSyncState.objects.get(fetcher="tests").cursor, "2018-01-11")
+
+        # Running again is harmless, since chunks are upserted by ctrlid.
+        result = self.run_source()
+        self.assertEqual((result['items_added'], result['items_equal']), (0, 10))
+        self.assertEqual(Sale.objects.count(), 10)
+
+    def test_failed_chunk_blocks_cursor(self):
+        ChunkedStubFetcher.fail_on = date(2018, 1, 6)
+        result = self.run_source()
+        self.assertFalse(result['succeeded'])
+        self.assertEqual(result['failed_chunks'], [["2018-01-05", "2018-01-09"]])
+        self.assertEqual(Sale.objects.count(), 6)  # The other chunks were loaded.
+        self.assertFalse(EtlSyncState.objects.filter(fetcher="tests").exists())
+
+    def test_job_timeouts(self):
+        self.assertEqual(enqueue_source(self.path, self.redis).timeout, JOB_TIMEOUT_SECS)
+        self.worker.work(burst=True)
+
+        # The coordinator passes the option on to the chunks and to finish_source().
+        enqueue_source(self.path, self.redis, chunk_days=4, options={'job_timeout_secs': 3600})
+        registry = FinishedJobRegistry(ETL_QUEUE, connection=self.redis)
+        before = set(registry.get_job_ids())
+        self.worker.work(burst=True)
+        jobs = [Job.fetch(x, connection=self.redis) for x in set(registry.get_job_ids()) - before]
+        self.assertEqual(len(jobs), 5)  # Coordinator, 3 chunks, and finish_source().
+        self.assertEqual({x.timeout for x in jobs}, {3600})
+
+    def test_chunks(self):
+        self.assertEqual(date_chunks(date(2018, 1, 1), date(2018, 1, 1), 7), [])
+        self.assertEqual(
+            date_chunks(date(2018, 1, 1), date(2018, 1, 10), 7),
+            [(date(2018, 1, 1), date(2018, 1, 8)), (date(2018, 1, 8), date(2018, 1, 10))]
+        )
+        self.assertEqual(fetcher_path("square"), "bzw_ops.etlfetchers.square.Fetcher")
+
+
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 
 # class TestProductionDatabase(TestCase):
@@ -41,6 +41,11 @@ urlpatterns = [
     #url('', include('social.apps.django_app.urls', namespace='social')),
 
     # DJANGO REST FRAMEWORK API
+    url(r'^ops/api/etl-upsert/$', restviews.etl_upsert),
+    url(r'^ops/api/etl-hashes/$', restviews.etl_hashes),
+    url(r'^ops/api/etl-ctrlids/(?P<label>[.a-zA-Z]+)/$', restviews.etl_ctrlids),
+    url(r'^ops/api/etl-runs/$', restviews.etl_runs),
+    url(r'^ops/api/etl-sync-state/(?P<fetcher>[-_a-zA-Z0-9]+)/$', restviews.etl_sync_state),
     url(r'^ops/api/', include(router.urls)),
     url(r'^ops/log-message/$', views.log_message),
 
@@ -147,8 +147,8 @@ def api_get_membership_info(request, provider: str, uid: str) -> HttpResponse:
 
     member = social_auth.user.member
 
-    try:
-        latest_pm = Membership.objects.filter(member=member).latest('start_date')
+    latest_pm = member.latest_nonfuture_membership
+    if latest_pm is not None:
         json = {
             'provider': provider,
             'uid': uid,
@@ -156,7 +156,7 @@ def api_get_membership_info(request, provider: str, uid: str) -> HttpResponse:
             'start-date': latest_pm.start_date,
             'end-date': latest_pm.end_date,
         }
-    except Membership.DoesNotExist:
+    else:
         json = {
             'provider': provider,
             'uid': uid,
@@ -0,0 +1,75 @@
+# Standard
+import random
+from datetime import date, timedelta
+from decimal import Decimal
+from time import perf_counter
+from typing import List, Tuple
+
+# Third Party
+from django.core.management.base import BaseCommand
+from dateutil.relativedelta import relativedelta
+
+# Local
+from abutils.time import is_very_last_day_of_month
+from members.models import MembershipJournalLiner
+
+__author__ = 'Adrian'
+
+
+def daily_revenue_recognition(start_date: date, end_date: date, sale_price: Decimal) -> List[Tuple[date, Decimal]]:
+    """The day-by-day algorithm that MembershipJournalLiner used before it switched to month segments."""
+    schedule = []  # type: List[Tuple[date, Decimal]]
+    mship_days = (end_date - start_date).days + 1
+    rev_per_day = sale_price / Decimal(mship_days)
+    curr_date = start_date
+    rev_acc = Decimal("0.00")
+    while curr_date <= end_date:
+        rev_acc += rev_per_day
+        if is_very_last_day_of_month(curr_date) or curr_date == end_date:
+            schedule.append((curr_date, rev_acc))
+            rev_acc = Decimal("0.00")
+        curr_date += timedelta(days=1)
+    return schedule
+
+
+class Command(BaseCommand):
+
+    help = "Compares the day-by-day and month-segment revenue recognition for randomly generated memberships."
+
+    def add_arguments(self, parser):
+        parser.add_argument('-n', '--count', type=int, default=5000, help="The number of memberships to generate.")
+
+    def handle(self, *args, **options):
+
+        random.seed(0)  # So that runs are comparable.
+        mships = []  # type: List[Tuple[date, date, Decimal]]
+        for _ in range(options['count']):
+            start = date(2015, 1, 1) + timedelta(days=random.randrange(4*365))
+            months = random.choice([1, 1, 1, 3, 6, 12])
+            end = start + relativedelta(months=months) - timedelta(days=1)
+            price = Decimal(random.choice([10, 25, 40, 50, 110, 300, 500]) * months)
+            mships.append((start, end, price))
+
+        results = {}
+        for name, func in [
+          ("day-by-day", daily_revenue_recognition),
+          ("month-segment", MembershipJournalLiner.revenue_recognition_schedule)]:
+            begin = perf_counter()
+            schedules = [func(start, end, price) for (start, end, price) in mships]
+            results[name] = schedules
+            print("{:>14}: {:.3f} sec for {} memberships".format(name, perf_counter()-begin, len(mships)))
+
+        # The old amounts weren't rounded to cents, so they'll differ from the new ones by fractions of a cent.
+        mismatched_dates = 0
+        mismatched_totals = 0
+        max_difference = Decimal("0.00")
+        for (_, _, price), old, new in zip(mships, results["day-by-day"], results["month-segment"]):
+            if [d for d, _ in old] != [d for d, _ in new]:
+                mismatched_dates += 1
+            if sum(amt for _, amt in new) != price:
+                mismatched_totals += 1
+            for (_, old_amt), (_, new_amt) in zip(old, new):
+                max_difference = max(max_difference, abs(old_amt - new_amt))
+        print("Memberships with different recognition dates: {}".format(mismatched_dates))
+        print("Month-segment totals that don't match the sale price: {}".format(mismatched_totals))
+        print("Largest difference in a month's amount: {:.4f}".format(max_difference))
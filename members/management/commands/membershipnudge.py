@@ -12,7 +12,7 @@ from django.conf import settings
 from freezegun import freeze_time
 
 # Local
-from members.models import Membership, VisitEvent
+from members.models import Member, Membership, VisitEvent
 
 __author__ = 'adrian'
 
@@ -124,6 +124,8 @@ class Command(BaseCommand):
         bad_visitors = {}
 
         yesterdays_visits = VisitEvent.objects.filter(when__range=[self.yesterday, self.today])
+        yesterdays_visits = list(yesterdays_visits.select_related('who', 'who__latest_membership'))
+        Member.load_tag_sets(visit.who for visit in yesterdays_visits)
         for visit in yesterdays_visits:
             pms = None
             work_count = None
@@ -136,6 +138,20 @@ class Command(BaseCommand):
                 # Ignore visits by directors (who have decided they don't need to pay).
                 continue
 
+            # The member's denormalized membership fields usually settle the visit without querying memberships.
+            # Each of these checks agrees with the loop below, whatever day the fields were computed on.
+            who = visit.who  # type: Member
+            latest = who.latest_membership  # type: Membership
+            if latest is None and who.paid_through_recheck is None:
+                # Has NEVER paid. See below.
+                continue
+            if who.paid_through_recheck is not None and who.paid_through_recheck > visit.when.date():
+                # There is a future paid membership.
+                continue
+            if latest is not None and latest.start_date <= visit.when.date() <= (latest.end_date + self.leeway):
+                # The latest paid membership covers the visit.
+                continue
+
             pms = Membership.objects.filter(member=visit.who).all()
             if len(pms) == 0:
                 # Don't nag people that have NEVER paid because either:
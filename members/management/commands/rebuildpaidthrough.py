@@ -0,0 +1,18 @@
+# Standard
+
+# Third Party
+from django.core.management.base import BaseCommand
+
+# Local
+from members.models import Member
+
+__author__ = 'adrian'
+
+
+class Command(BaseCommand):
+
+    help = "Recomputes every member's paid-through date and latest membership, which are normally kept by signals."
+
+    def handle(self, *args, **options):
+        changed = Member.update_paid_through()
+        print("{} member(s) were out of date.".format(changed))
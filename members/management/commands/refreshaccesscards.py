@@ -0,0 +1,28 @@
+# Standard
+from datetime import date
+
+# Third Party
+from django.core.management.base import BaseCommand
+
+# Local
+from members.models import Member, AccessCard
+
+__author__ = 'adrian'
+
+
+class Command(BaseCommand):
+
+    help = "Meant to be run daily. Updates the paid-through dates and access cards of members whose future " \
+           "memberships have started. Cards are otherwise kept current by signals."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+            help="Also recompute every member's access card, e.g. after bulk changes that didn't send signals.")
+
+    def handle(self, *args, **options):
+        due_ids = Member.objects.filter(paid_through_recheck__lte=date.today()).values_list('id', flat=True)
+        changed = Member.update_paid_through(list(due_ids))
+        print("{} member(s) had memberships start.".format(changed))
+        if options['all']:
+            changed = AccessCard.update_for_members()
+            print("{} access card(s) were out of date.".format(changed))
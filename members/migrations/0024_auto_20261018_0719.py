@@ -0,0 +1,23 @@
+# Generated by Django 2.1.11 on 2026-10-18 14:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('members', '0023_auto_20180824_2228'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='membership',
+            name='etl_hash',
+            field=models.CharField(blank=True, default='', help_text='Hash of the data that ETL last loaded into this record. ETL skips records whose hash is unchanged.', max_length=40),
+        ),
+        migrations.AddField(
+            model_name='membershipgiftcardreference',
+            name='etl_hash',
+            field=models.CharField(blank=True, default='', help_text='Hash of the data that ETL last loaded into this record. ETL skips records whose hash is unchanged.', max_length=40),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 2.1.11 on 2026-10-18 14:32
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('members', '0024_auto_20261018_0719'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccessCard',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('card_md5', models.CharField(help_text='MD5 of the card#, as in Member.membership_card_md5.', max_length=32, unique=True)),
+                ('paid_through', models.DateField(blank=True, help_text="The end date of the member's latest membership that has started. Null if there isn't one.", null=True)),
+                ('tag_flags', models.IntegerField(default=0, help_text='Bit N is set if the member has the Nth of AccessCard.ACCESS_TAGS.')),
+                ('revoked', models.BooleanField(default=False, help_text="If True, the card is no longer any member's, and readers should forget it.")),
+                ('version', models.IntegerField(db_index=True, help_text="The snapshot version in which this card's information last changed.")),
+                ('member', models.ForeignKey(blank=True, help_text='The member whose card this is.', null=True, on_delete=django.db.models.deletion.SET_NULL, to='members.Member')),
+            ],
+        ),
+    ]
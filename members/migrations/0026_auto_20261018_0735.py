@@ -0,0 +1,49 @@
+# Generated by Django 2.1.11 on 2026-10-18 14:35
+
+from django.db import migrations, models
+import django.db.models.deletion
+from datetime import date
+
+
+def forward_func(apps, schema_editor):
+    Member = apps.get_model('members', 'Member')
+    Membership = apps.get_model('members', 'Membership')
+    today = date.today()
+    computed = dict()
+    mships = Membership.objects.filter(member__isnull=False).order_by('end_date', 'id')
+    for member_id, mship_id, start_date, end_date in mships.values_list('member_id', 'id', 'start_date', 'end_date'):
+        latest_id, paid_through, recheck = computed.get(member_id, (None, None, None))
+        if start_date <= today:
+            latest_id, paid_through = mship_id, end_date
+        elif recheck is None or start_date < recheck:
+            recheck = start_date
+        computed[member_id] = (latest_id, paid_through, recheck)
+    for member_id, (latest_id, paid_through, recheck) in computed.items():
+        Member.objects.filter(id=member_id).update(
+            latest_membership_id=latest_id, paid_through=paid_through, paid_through_recheck=recheck)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('members', '0025_auto_20261018_0732'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='member',
+            name='latest_membership',
+            field=models.ForeignKey(blank=True, help_text='The latest membership from among those that are not entirely in the future. Maintained automatically.', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='members.Membership'),
+        ),
+        migrations.AddField(
+            model_name='member',
+            name='paid_through',
+            field=models.DateField(blank=True, help_text='The end date of the latest membership. Maintained automatically.', null=True),
+        ),
+        migrations.AddField(
+            model_name='member',
+            name='paid_through_recheck',
+            field=models.DateField(blank=True, help_text="The start date of the member's next future membership, on which the fields above are recomputed.", null=True),
+        ),
+        migrations.RunPython(forward_func, migrations.RunPython.noop),
+    ]
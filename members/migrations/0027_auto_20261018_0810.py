@@ -0,0 +1,35 @@
+# Generated by Django 2.1.11 on 2026-10-18 15:10
+
+from django.db import migrations
+
+
+def forward_func(apps, schema_editor):
+    # The cards are kept current by signals from now on. This is AccessCard.update_for_members() for historical models.
+    Member = apps.get_model('members', 'Member')
+    Tagging = apps.get_model('members', 'Tagging')
+    AccessCard = apps.get_model('members', 'AccessCard')
+    if AccessCard.objects.exists():
+        return  # Readers' polls have already created them.
+    access_tags = ["Member", "Staff", "Director", "Keyholder"]  # AccessCard.ACCESS_TAGS
+    tag_flags = dict()
+    taggings = Tagging.objects.filter(is_tagged=True, tag__name__in=access_tags)
+    for member_id, tag_name in taggings.values_list('member_id', 'tag__name'):
+        tag_flags[member_id] = tag_flags.get(member_id, 0) | 1 << access_tags.index(tag_name)
+    cards = dict()
+    members = Member.objects.exclude(membership_card_md5=None).exclude(membership_card_md5="")
+    for member_id, card_md5, paid_through in members.order_by('id').values_list('id', 'membership_card_md5', 'paid_through'):
+        if card_md5 not in cards:
+            cards[card_md5] = AccessCard(card_md5=card_md5, member_id=member_id, paid_through=paid_through,
+                                         tag_flags=tag_flags.get(member_id, 0), version=1)
+    AccessCard.objects.bulk_create(cards.values(), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('members', '0026_auto_20261018_0735'),
+    ]
+
+    operations = [
+        migrations.RunPython(forward_func, migrations.RunPython.noop),
+    ]
@@ -7,13 +7,13 @@ import hashlib
 import re
 from datetime import datetime, date, timedelta, time
 from decimal import Decimal
-from typing import Union, Tuple, Optional
+from typing import Dict, Iterable, Union, Tuple, Optional, List
 import abc
 from logging import getLogger
 
 # Third Party
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
 from django.utils import timezone
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
@@ -24,10 +24,10 @@ from books.models import (
     Account, Sale, ReceivableInvoice,
     JournalEntry, JournalEntryLineItem, Journaler, JournalLiner,
     ACCT_REVENUE_MEMBERSHIP, ACCT_LIABILITY_UNEARNED_MSHIP_REVENUE,
-    quote_entity
+    quote_entity, update_rows
 )
 from abutils.utils import generate_ctrlid
-from abutils.time import is_very_last_day_of_month
+from abutils.time import month_segments
 
 TZ = timezone.get_default_timezone()
 
@@ -169,6 +169,18 @@ class Member(models.Model):
     is_adult = models.NullBooleanField(default=None, blank=True,
         help_text="Member can specify that they are an adult without providing birth date.")
 
+    # The following are denormalized from the member's memberships by signals. See update_paid_through().
+
+    latest_membership = models.ForeignKey('Membership', null=True, blank=True, related_name='+',
+        on_delete=models.SET_NULL,  # Signals will find the member's new latest membership.
+        help_text="The latest membership from among those that are not entirely in the future. Maintained automatically.")
+
+    paid_through = models.DateField(null=True, blank=True,
+        help_text="The end date of the latest membership. Maintained automatically.")
+
+    paid_through_recheck = models.DateField(null=True, blank=True,
+        help_text="The start date of the member's next future membership, on which the fields above are recomputed.")
+
     # TODO: Remove QR code oriented member identities because we're sticking with RFID.
     @staticmethod
     def generate_auth_token_str(is_unique):
@@ -204,13 +216,39 @@ class Member(models.Model):
         self.save()
         return b64
 
+    # Members' tag sets are memoized on the instances, e.g. for the duration of a request or command run.
+    # Signals replace this with a new number whenever a Tag or Tagging changes, which makes them all stale.
+    tag_set_generation = 0
+
+    @property
+    def tag_set(self) -> Dict[str, 'Tagging']:
+        """The member's taggings, keyed by tag name. Loaded with a single query the first time it's needed."""
+        memo = getattr(self, '_tag_set', None)
+        if memo is None or memo[0] != Member.tag_set_generation:
+            Member.load_tag_sets([self])
+            memo = self._tag_set
+        return memo[1]
+
+    @staticmethod
+    def load_tag_sets(members: Iterable['Member']) -> List['Member']:
+        """
+        Loads the tag sets of all the given members with a single query, for code that checks the tags of each.
+        :return: The members, as a list.
+        """
+        members = list(members)
+        by_id = dict()  # type: Dict[int, List[Member]]
+        generation = Member.tag_set_generation  # Taken before the query, so a change during it isn't missed.
+        for member in members:
+            member._tag_set = (generation, dict())
+            by_id.setdefault(member.pk, []).append(member)
+        for tagging in Tagging.objects.filter(member_id__in=by_id).select_related('tag'):
+            for member in by_id[tagging.member_id]:
+                member._tag_set[1][tagging.tag.name] = tagging
+        return members
+
     def get_tagging(self, tag_or_tagname: Union[Tag, str]) -> Optional['Tagging']:
-        tag = Tag.get(tag_or_tagname)
-        if tag is not None:
-            for tagging in self.taggings.all():
-                if tagging.tag.name == tag.name:
-                    return tagging
-        return None
+        tagname = tag_or_tagname.name if type(tag_or_tagname) is Tag else tag_or_tagname
+        return self.tag_set.get(tagname)
 
     def is_tagged_with(self, tag_or_tagname: Union[Tag, str]) -> bool:
         """Determine if member is tagged with the given tag or tag-name."""
@@ -231,23 +269,59 @@ class Member(models.Model):
 
     def is_currently_paid(self, grace_period=timedelta(0)) -> bool:
         """Determine whether member is currently covered by a membership with a given grace period."""
-        mship = self.latest_nonfuture_membership
-        if mship is None:
+        self.refresh_paid_through_if_due()
+        if self.paid_through is None:
             return False
         else:
-            return mship.end_date + grace_period >= date.today()
+            return self.paid_through + grace_period >= date.today()
 
     @property
     def latest_nonfuture_membership(self) -> Optional['Membership']:
         """The latest membership from among those that are not entirely in the future."""
-        now = datetime.now().date()  # type: datetime
-        try:
-            params = {"member": self, "start_date__lte": now}
-            nonfuture_mships = Membership.objects.filter(**params)
-            latest_nonfuture_mship = nonfuture_mships.latest('end_date')  # type: Membership
-            return latest_nonfuture_mship
-        except Membership.DoesNotExist:
-            return None
+        self.refresh_paid_through_if_due()
+        return self.latest_membership
+
+    def refresh_paid_through_if_due(self) -> None:
+        """Recomputes the denormalized membership fields if one of the member's future memberships has started."""
+        if self.paid_through_recheck is not None and self.paid_through_recheck <= date.today():
+            Member.update_paid_through([self.pk])
+            self.refresh_from_db(fields=['latest_membership', 'paid_through', 'paid_through_recheck'])
+
+    @staticmethod
+    def update_paid_through(member_ids: Optional[Iterable[int]] = None) -> int:
+        """
+        Recomputes latest_membership, paid_through, and paid_through_recheck for the given members, or for all of
+        them, with two queries plus one update for those that changed. Their access cards are updated too.
+        :return: The number of members that changed.
+        """
+        today = date.today()
+        members = Member.objects.all()
+        mships = Membership.objects.filter(member__isnull=False)
+        if member_ids is not None:
+            member_ids = set(member_ids)
+            members = members.filter(pk__in=member_ids)
+            mships = mships.filter(member_id__in=member_ids)
+
+        computed = dict()  # type: Dict[int, tuple]
+        mships = mships.order_by('end_date', 'id').values_list('member_id', 'id', 'start_date', 'end_date')
+        for member_id, mship_id, start_date, end_date in mships:
+            latest_id, paid_through, recheck = computed.get(member_id, (None, None, None))
+            if start_date <= today:
+                latest_id, paid_through = mship_id, end_date  # Ordered by end date, so the last one is the latest.
+            elif recheck is None or start_date < recheck:
+                recheck = start_date
+            computed[member_id] = (latest_id, paid_through, recheck)
+
+        changed = []  # type: List[Member]
+        for member in members.only('id', 'latest_membership', 'paid_through', 'paid_through_recheck'):
+            values = computed.get(member.pk, (None, None, None))
+            if (member.latest_membership_id, member.paid_through, member.paid_through_recheck) != values:
+                member.latest_membership_id, member.paid_through, member.paid_through_recheck = values
+                changed.append(member)
+        update_rows(Member, ['latest_membership', 'paid_through', 'paid_through_recheck'], changed)
+        if len(changed) > 0:
+            AccessCard.update_for_members([member.pk for member in changed])
+        return len(changed)
 
     @property
     def first_name(self)->str:
@@ -732,17 +806,31 @@ class MembershipJournalLiner(JournalLiner, models.Model):
             description=desc
         ))
 
-        mship_duration = self.end_date - self.start_date  # type: timedelta
-        mship_days = mship_duration.days + 1
-        rev_per_day = self.sale_price / Decimal(mship_days)
-        curr_date = self.start_date
-        rev_acc = Decimal("0.00")
-        while curr_date <= self.end_date:
-            rev_acc += rev_per_day
-            if is_very_last_day_of_month(curr_date) or curr_date == self.end_date:
-                recognize_revenue(curr_date, rev_acc)
-                rev_acc = Decimal("0.00")
-            curr_date += timedelta(days=1)
+        schedule = self.revenue_recognition_schedule(self.start_date, self.end_date, self.sale_price)
+        for date_to_recognize, amount in schedule:
+            recognize_revenue(date_to_recognize, amount)
+
+    @staticmethod
+    def revenue_recognition_schedule(start_date: date, end_date: date, sale_price: Decimal) -> List[Tuple[date, Decimal]]:
+        """
+        Splits sale_price across the months of a membership, in proportion to the number of days in each.
+        Returns (date to recognize, amount) pairs, where the date is the last day of the membership in that month.
+        Amounts are whole cents and they always add up to sale_price.
+        """
+        mship_days = (end_date - start_date).days + 1
+        if mship_days <= 0:
+            return []
+        total_cents = int((sale_price * 100).to_integral_value())
+        schedule = []  # type: List[Tuple[date, Decimal]]
+        days_to_date = 0
+        cents_to_date = 0
+        for seg_start, seg_end in month_segments(start_date, end_date):
+            days_to_date += (seg_end - seg_start).days + 1
+            # Rounding the cumulative amount (half up) instead of each month's amount keeps the total exact.
+            cents = (2 * total_cents * days_to_date + mship_days) // (2 * mship_days)
+            schedule.append((seg_end, Decimal(cents - cents_to_date).scaleb(-2)))
+            cents_to_date = cents
+        return schedule
 
 
 class GroupMembership(MembershipJournalLiner):
@@ -857,7 +945,7 @@ class Membership(MembershipJournalLiner):
         on_delete=models.CASCADE,  # Line items are parts of the sale so they should be deleted.
         help_text="The sale that includes this line item, if any. E.g. comp memberships don't have a corresponding sale.")
 
-    # ETL related fields: ctrlid, protected
+    # ETL related fields: ctrlid, protected, etl_hash
 
     ctrlid = models.CharField(max_length=40, null=False, blank=False, unique=True,
         default=next_membership_ctrlid,
@@ -866,6 +954,9 @@ class Membership(MembershipJournalLiner):
     protected = models.BooleanField(default=False,
         help_text="Protect against further auto processing by ETL, etc. Prevents overwrites of manually entered data.")
 
+    etl_hash = models.CharField(max_length=40, null=False, blank=True, default="",
+        help_text="Hash of the data that ETL last loaded into this record. ETL skips records whose hash is unchanged.")
+
     # Fields related to nudges, i.e. reminders to renew membership
 
     when_nudged = models.DateField(null=True, blank=True, default=None,
@@ -1019,6 +1110,143 @@ class ExternalId(models.Model):
         unique_together = ('provider', 'uid')
 
 
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+# RFID ACCESS SNAPSHOT
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+
+class AccessCard(models.Model):
+    """
+    What an RFID reader needs to know about a card to decide on its own whether to let it in.
+    Readers keep a copy of these, which they update with the changes since the version they have.
+    See snapshot().
+    """
+
+    # The tags that readers are told about. Bit N of tag_flags is set if the member has ACCESS_TAGS[N].
+    # Only append to this list, since readers interpret their flags by position.
+    ACCESS_TAGS = ["Member", "Staff", "Director", "Keyholder"]
+
+    card_md5 = models.CharField(max_length=Member.MEMB_CARD_STR_LEN, unique=True,
+        help_text="MD5 of the card#, as in Member.membership_card_md5.")
+
+    member = models.ForeignKey(Member, null=True, blank=True,
+        on_delete=models.SET_NULL,  # The card is revoked by the next refresh.
+        help_text="The member whose card this is.")
+
+    paid_through = models.DateField(null=True, blank=True,
+        help_text="The end date of the member's latest membership that has started. Null if there isn't one.")
+
+    tag_flags = models.IntegerField(default=0,
+        help_text="Bit N is set if the member has the Nth of AccessCard.ACCESS_TAGS.")
+
+    revoked = models.BooleanField(default=False,
+        help_text="If True, the card is no longer any member's, and readers should forget it.")
+
+    version = models.IntegerField(db_index=True,
+        help_text="The snapshot version in which this card's information last changed.")
+
+    @staticmethod
+    def update_for_members(member_ids: Optional[Iterable[int]] = None) -> int:
+        """
+        Brings the cards of the given members, or of all members, up to date with their card numbers, paid-through
+        dates, and taggings, using a few queries. Signal handlers call this as those change, so that snapshot()
+        only has to read. Cards whose information changed get the next version. Cards that aren't in use anymore,
+        including those whose member was deleted, are revoked.
+        :return: The number of cards that changed.
+        """
+        with transaction.atomic():
+            cards = AccessCard.objects.select_for_update()
+            members = Member.objects.exclude(membership_card_md5=None).exclude(membership_card_md5="")
+            if member_ids is not None:
+                member_ids = set(member_ids)
+                card_md5s = set(members.filter(pk__in=member_ids).values_list('membership_card_md5', flat=True))
+                mine = models.Q(member_id__in=member_ids) | models.Q(card_md5__in=card_md5s)
+                cards = cards.filter(mine | models.Q(member=None, revoked=False))
+            existing = {card.card_md5: card for card in cards}
+            if member_ids is not None:
+                # Other members might have the same card#s, in which case the first of them has the card, as below.
+                members = members.filter(membership_card_md5__in=card_md5s | set(existing))
+
+            # Members' denormalized paid-through dates are used, as in Member.is_currently_paid().
+            # See Member.update_paid_through(), which calls this as they change.
+            current = dict()  # type: Dict[str, list]
+            members = members.order_by('id').values_list('id', 'membership_card_md5', 'paid_through')
+            for member_id, card_md5, paid_through in members:
+                if card_md5 not in current:
+                    current[card_md5] = [member_id, paid_through, 0, False]
+
+            taggings = Tagging.objects.filter(is_tagged=True, tag__name__in=AccessCard.ACCESS_TAGS)
+            if member_ids is not None:
+                taggings = taggings.filter(member_id__in=[info[0] for info in current.values()])
+            tag_flags = dict()  # type: Dict[int, int]
+            for member_id, tag_name in taggings.values_list('member_id', 'tag__name'):
+                tag_flags[member_id] = tag_flags.get(member_id, 0) | 1 << AccessCard.ACCESS_TAGS.index(tag_name)
+            for info in current.values():
+                info[2] = tag_flags.get(info[0], 0)
+
+            changed = []  # type: List[AccessCard]
+            for card_md5, info in current.items():
+                card = existing.get(card_md5, AccessCard(card_md5=card_md5))
+                if card.pk is None or [card.member_id, card.paid_through, card.tag_flags, card.revoked] != info:
+                    card.member_id, card.paid_through, card.tag_flags, card.revoked = info
+                    changed.append(card)
+            for card_md5, card in existing.items():
+                if card_md5 not in current and not card.revoked:
+                    card.member_id, card.revoked = None, True
+                    changed.append(card)
+
+            if len(changed) > 0:
+                version = AccessCard._next_version()
+                for card in changed:
+                    card.version = version
+                AccessCard.objects.bulk_create([card for card in changed if card.pk is None])
+                update_rows(AccessCard, ['member', 'paid_through', 'tag_flags', 'revoked', 'version'],
+                            [card for card in changed if card.pk is not None])
+        return len(changed)
+
+    @staticmethod
+    def _next_version() -> int:
+        """
+        The version for a change to the cards. Locks the newest card until the transaction ends, so that concurrent
+        changes get increasing versions, and are committed in that order. Otherwise a reader could miss a change.
+        """
+        list(AccessCard.objects.select_for_update().order_by('-version').values_list('id', flat=True)[:1])
+        return AccessCard.current_version() + 1
+
+    @staticmethod
+    def current_version() -> int:
+        return AccessCard.objects.aggregate(models.Max('version'))['version__max'] or 0
+
+    @staticmethod
+    def snapshot(since: int = 0) -> dict:
+        """
+        Gets the changes to the cards since the given version, or all of the cards if it's 0.
+        A reader should let a card in if its paid-through date, plus any grace period, isn't in the past.
+        :return: {"version", "since", "tags": ACCESS_TAGS, "cards": [[card_md5, paid_through, tag_flags], ...]
+            sorted by card_md5, "revoked": [card_md5, ...]}. Paid-through dates are ISO dates or None.
+        """
+        # The version is read first, so a change committed while the cards are read is sent again next time.
+        version = AccessCard.current_version()
+        if since > version:
+            since = 0  # The reader's copy isn't from this server, so it needs all of the cards.
+        cards = AccessCard.objects.filter(version__gt=since)
+        if since == 0:
+            cards = cards.filter(revoked=False)
+        cards = list(cards.order_by('card_md5').values_list('card_md5', 'paid_through', 'tag_flags', 'revoked'))
+        return {
+            'version': version,
+            'since': since,
+            'tags': AccessCard.ACCESS_TAGS,
+            'cards': [
+                [card_md5, paid_through.isoformat() if paid_through is not None else None, tag_flags]
+                for card_md5, paid_through, tag_flags, revoked in cards if not revoked
+            ],
+            'revoked': [card_md5 for card_md5, _, _, revoked in cards if revoked],
+        }
+
+    def __str__(self):
+        return "{} through {}".format(self.card_md5, self.paid_through)
+
+
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 # Additional Line-Item Models for SaleAdmin in Books app.
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
@@ -1043,7 +1271,7 @@ class MembershipGiftCardReference(models.Model, JournalLiner):
     sale_price = models.DecimalField(max_digits=6, decimal_places=2, null=False, blank=False,
         help_text="The price at which this item sold.")
 
-    # ETL related fields: ctrlid, protected
+    # ETL related fields: ctrlid, protected, etl_hash
 
     ctrlid = models.CharField(max_length=40, null=False, blank=False, unique=True,
         default=next_giftcardref_ctrlid,
@@ -1052,6 +1280,9 @@ class MembershipGiftCardReference(models.Model, JournalLiner):
     protected = models.BooleanField(default=False,
         help_text="Protect against further auto processing by ETL, etc. Prevents overwrites of manually entered data.")
 
+    etl_hash = models.CharField(max_length=40, null=False, blank=True, default="",
+        help_text="Hash of the data that ETL last loaded into this record. ETL skips records whose hash is unchanged.")
+
     def __str__(self):
         return "CARD NOT YET SPECIFIED!" if self.card is None else self.card.redemption_code
 
@@ -28,3 +28,17 @@ class VisitEventPermission(permissions.BasePermission):
             return True
         else:
             return user_is_kiosk(request)
+
+
+# ---------------------------------------------------------------------------
+# ACCESS CARD
+# ---------------------------------------------------------------------------
+
+class AccessCardReaderPermission(permissions.BasePermission):
+    """
+    For the endpoints of RFID readers that keep their own copy of the access cards, since they reveal members'
+    card md5s. Each reader authenticates with the token of a user that has the "Can view access card" permission.
+    """
+
+    def has_permission(self, request: Request, view) -> bool:
+        return request.user.is_authenticated and request.user.has_perm('members.view_accesscard')
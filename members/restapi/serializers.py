@@ -62,6 +62,7 @@ class MembershipSerializer(serializers.ModelSerializer):
             # ETL related fields:
             'ctrlid',
             'protected',
+            'etl_hash',
         )
 
 
@@ -78,6 +79,7 @@ class MembershipGiftCardReferenceSerializer(serializers.ModelSerializer):
             # ETL related fields:
             'ctrlid',
             'protected',
+            'etl_hash',
         )
 
 
@@ -24,7 +24,8 @@ class MemberViewSet(viewsets.ModelViewSet):
     """
     REST API endpoint that allows members to be viewed or edited.
     """
-    queryset = Member.objects.all()
+    # The serializer reads the member's user, latest membership, and worker, so they're fetched in the same query.
+    queryset = Member.objects.select_related('auth_user', 'latest_membership', 'worker')
     serializer_class = ser.get_MemberSerializer(True)  # Default to privacy.
     permission_classes = [IsAuthenticated]
     filter_backends = viewsets.ModelViewSet.filter_backends + [filt.HasRfidNumFilterBackend]
@@ -1,15 +1,16 @@
 # Standard
 from datetime import timedelta
+import itertools
 import logging
 
 # Third Party
-from django.db.models.signals import post_save, pre_save, pre_delete
+from django.db.models.signals import post_save, pre_save, pre_delete, post_delete
 from django.dispatch import receiver
 from django.contrib.auth.models import User
 from django.core.exceptions import ObjectDoesNotExist
 
 # Local
-from members.models import Member, Tag, Tagging, MemberLogin, GroupMembership, Membership, VisitEvent
+from members.models import Member, Tag, Tagging, MemberLogin, GroupMembership, Membership, VisitEvent, AccessCard
 import members.notifications as notifications
 from abutils.utils import get_ip_address
 
@@ -37,17 +38,81 @@ def create_default_member(sender, **kwargs):
         Tagging.objects.create(member=m, tag=t, is_tagged=True, can_tag=False)
 
 
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# MEMBER
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+@receiver(post_save, sender=Member)
+@receiver(post_delete, sender=Member)
+def update_member_access_card(sender, **kwargs):
+    """E.g. if the member's card# changed. Cards of deleted members are revoked. See AccessCard.update_for_members()."""
+    if not kwargs.get('raw', False):
+        AccessCard.update_for_members([kwargs.get('instance').pk])
+
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 # TAGGING
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 # NOTE: DO NOT attempt to automatically manage group memberships here.
 
+_tag_set_generations = itertools.count(1)
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+@receiver(post_save, sender=Tagging)
+@receiver(post_delete, sender=Tagging)
+def invalidate_tag_sets(sender, **kwargs):
+    """Members' memoized tag sets are reloaded the next time they're used. See Member.tag_set."""
+    # next() on a count is atomic, so concurrent changes can't leave the generation as it was.
+    Member.tag_set_generation = next(_tag_set_generations)
+
+
+@receiver(post_save, sender=Tagging)
+@receiver(post_delete, sender=Tagging)
+def update_tagged_access_card(sender, **kwargs):
+    """Access cards have flags for some tags. See AccessCard.ACCESS_TAGS."""
+    tagging = kwargs.get('instance')  # type: Tagging
+    if not kwargs.get('raw', False):
+        AccessCard.update_for_members([tagging.member_id])
+
+
+@receiver(post_save, sender=Tag)
+def update_tag_access_cards(sender, **kwargs):
+    """In case the tag was renamed to or from one of AccessCard.ACCESS_TAGS. Deleted tags' taggings are deleted too."""
+    tag = kwargs.get('instance')  # type: Tag
+    if not kwargs.get('created', False) and not kwargs.get('raw', False):
+        AccessCard.update_for_members(Tagging.objects.filter(tag=tag).values_list('member_id', flat=True))
+
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 # MEMBERSHIP
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
+@receiver(pre_save, sender=Membership)
+def note_prior_member(sender, **kwargs):
+    """If a membership is moved to another member, the member it was moved from needs updating too."""
+    mship = kwargs.get('instance')  # type: Membership
+    mship._prior_member_id = None
+    if mship.pk is not None and not kwargs.get('raw', False):
+        mship._prior_member_id = Membership.objects.filter(pk=mship.pk).values_list('member_id', flat=True).first()
+
+
+@receiver(post_save, sender=Membership)
+@receiver(post_delete, sender=Membership)
+def update_member_paid_through(sender, **kwargs):
+    """
+    Keeps the member's denormalized paid_through and latest_membership current.
+    This covers group and gift card memberships too, which are saved with their GroupMembership or
+    MembershipGiftCardRedemption in admin, and deleted along with them.
+    """
+    mship = kwargs.get('instance')  # type: Membership
+    member_ids = {mship.member_id, getattr(mship, '_prior_member_id', None)} - {None}
+    if len(member_ids) > 0:
+        Member.update_paid_through(member_ids)
+
+
 # TODO: Attempt to auto-link based on name/email in sale. Only for WePay, 2Checkout, Square?
 @receiver(pre_save, sender=Membership)
 def link_membership_to_member(sender, **kwargs):
@@ -106,5 +171,3 @@ def group_membership_post_save(sender, **kwargs):
                     end_date=gm.end_date,
                     membership_type=Membership.MT_GROUP
                 )
-
-
@@ -1,26 +1,31 @@
 
 # Standard
 from datetime import date, timedelta
+from time import mktime
+from decimal import Decimal
 import json
 import os
 import hashlib
+import threading
 
 # Third Party
 from django.conf import settings
 from django.test import Client
 from django.test import TestCase
-from django.contrib.auth.models import User
+from django.contrib.auth.models import User, Permission
 from django.core import management, mail
 from django.utils import timezone
 from django.urls import reverse
 from freezegun import freeze_time
+from rest_framework.authtoken.models import Token
 import members.notifications as notifications
 
 # Local
 from members.models import (
-    Member, Tag, Tagging, VisitEvent, Membership, Pushover, MembershipGiftCard, DiscoveryMethod
+    Member, Tag, Tagging, VisitEvent, Membership, Pushover, MembershipGiftCard, DiscoveryMethod, AccessCard
 )
 from members.notifications import pushover_available
+from abutils.facility import AddressResolver
 from members.management.commands.membershipnudge import Command as MembershipNudgeCmd
 import members.views as views
 
@@ -143,6 +148,23 @@ class TestMembers(TestCase):
             self.assertTrue(m.is_tagged_with("Member"))  # Every member should have this tag.
             self.assertTrue(m.auth_user is not None)  # Every member should be connected to a Django user.
 
+    def test_tag_set_is_memoized_and_invalidated(self):
+        m = Member.objects.get(auth_user__username='fake1')
+        staff = Tag.objects.create(name="Staff", meaning="spam")
+        with self.assertNumQueries(1):
+            self.assertTrue(m.is_tagged_with("Member"))
+            self.assertFalse(m.is_tagged_with(staff))
+            self.assertFalse(m.can_tag_with("Member"))
+        Tagging.objects.create(member=m, tag=staff, can_tag=True)
+        self.assertTrue(m.is_tagged_with("Staff"))
+        self.assertTrue(m.can_tag_with(staff))
+
+    def test_load_tag_sets(self):
+        User.objects.create_user(username='fake2')
+        with self.assertNumQueries(2):
+            members = Member.load_tag_sets(Member.objects.all())
+            self.assertTrue(all(m.is_tagged_with("Member") and not m.is_tagged_with("Director") for m in members))
+
 
 class TestCardsAndApi(TestCase):
 
@@ -198,12 +220,117 @@ class TestMembership(TestCase):
         mship = Membership.objects.create(sale_price=0)
         self.assertTrue(mship.ctrlid.startswith("GEN"))
 
+    def test_revenue_recognition_schedule(self):
+        schedule = Membership.revenue_recognition_schedule(date(2018, 1, 15), date(2018, 4, 14), Decimal("100.00"))
+        self.assertEqual([d for d, _ in schedule], [date(2018, 1, 31), date(2018, 2, 28), date(2018, 3, 31), date(2018, 4, 14)])
+        self.assertEqual([amt for _, amt in schedule], [Decimal("18.89"), Decimal("31.11"), Decimal("34.44"), Decimal("15.56")])
+        self.assertEqual(sum(amt for _, amt in schedule), Decimal("100.00"))
+
+    def test_revenue_recognition_schedule_exact_total(self):
+        for days in range(1, 400, 7):
+            end = date(2017, 12, 20) + timedelta(days=days-1)
+            schedule = Membership.revenue_recognition_schedule(date(2017, 12, 20), end, Decimal("33.33"))
+            self.assertEqual(sum(amt for _, amt in schedule), Decimal("33.33"))
+            self.assertEqual(schedule[-1][0], end)
+
+    def test_paid_through_follows_memberships(self):
+        member = User.objects.create(username='payer').member
+        other = User.objects.create(username='other').member
+        today = date.today()
+        old = Membership.objects.create(member=member, start_date=today-timedelta(days=60),
+                                        end_date=today-timedelta(days=31), sale_price=0)
+        member.refresh_from_db()
+        self.assertEqual(member.latest_membership_id, old.pk)
+        self.assertFalse(member.is_currently_paid())
+
+        current = Membership.objects.create(member=member, start_date=today-timedelta(days=30),
+                                            end_date=today+timedelta(days=10), sale_price=0)
+        member.refresh_from_db()
+        self.assertEqual((member.latest_membership_id, member.paid_through), (current.pk, current.end_date))
+        self.assertTrue(member.is_currently_paid())
+
+        current.member = other
+        current.save()
+        member.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual(member.paid_through, old.end_date)
+        self.assertEqual(other.paid_through, current.end_date)
+
+        old.delete()
+        member.refresh_from_db()
+        self.assertIsNone(member.latest_membership)
+        self.assertIsNone(member.paid_through)
+
+    def test_paid_through_rechecked_when_future_membership_starts(self):
+        member = User.objects.create(username='renewer').member
+        start = date.today() + timedelta(days=5)
+        future = Membership.objects.create(member=member, start_date=start, end_date=start+timedelta(days=30),
+                                           sale_price=0)
+        member.refresh_from_db()
+        self.assertEqual((member.paid_through, member.paid_through_recheck), (None, start))
+        self.assertIsNone(member.latest_nonfuture_membership)
+        with freeze_time(start):
+            self.assertEqual(member.latest_nonfuture_membership, future)
+            self.assertTrue(member.is_currently_paid())
+
+    def test_rebuild_paid_through(self):
+        member = User.objects.create(username='rebuilt').member
+        mship = Membership.objects.create(member=member, start_date=date.today(),
+                                          end_date=date.today()+timedelta(days=30), sale_price=0)
+        Member.objects.filter(pk=member.pk).update(latest_membership=None, paid_through=None)
+        management.call_command('rebuildpaidthrough')
+        member.refresh_from_db()
+        self.assertEqual((member.latest_membership_id, member.paid_through), (mship.pk, mship.end_date))
+
 
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 # VIEWS
 
 class TestViews(TestCase):
-    pass
+
+    def test_member_count_data(self):
+        today = date.today()
+        for mtype, start, end in [
+            (Membership.MT_REGULAR, date(2014, 12, 1), date(2015, 1, 20)),  # Starts before the chart does.
+            (Membership.MT_GIFTCARD, date(2015, 1, 10), date(2015, 2, 9)),
+            (Membership.MT_FAMILY, date(2015, 1, 15), date(2015, 1, 15)),
+            (Membership.MT_WORKTRADE, date(2015, 3, 1), date(2015, 3, 31)),  # After a gap with no memberships.
+            (Membership.MT_SCHOLARSHIP, date(2015, 4, 1), date(2015, 4, 3)),  # Charted days, but not counted.
+            (Membership.MT_GROUP, today - timedelta(days=3), today + timedelta(days=30)),  # Ends after today.
+            (Membership.MT_COMPLIMENTARY, today + timedelta(days=1), today + timedelta(days=9)),  # In the future.
+            (Membership.MT_REGULAR, date(2015, 1, 5), date(2015, 1, 4)),  # Ends before it starts.
+        ]:
+            Membership.objects.create(membership_type=mtype, start_date=start, end_date=end, sale_price=0)
+
+        # The day-by-day tally that the difference array replaced.
+        tallies = dict()
+        for pm in Membership.objects.all():
+            row = views.MEMBER_COUNT_ROWS.get(pm.membership_type)
+            day = max(pm.start_date, date(2015, 1, 1))
+            while day <= min(pm.end_date, today):
+                js_time = int(mktime(day.timetuple())) * 1000
+                tally = tallies.setdefault(js_time, [0] * 5)
+                if row is not None:
+                    tally[row] += 1
+                day += timedelta(days=1)
+        js_times = sorted(tallies)
+        columns = [views.zero_to_null([tallies[t][row] for t in js_times]) for row in range(5)]
+        self.assertEqual(views.member_count_data(today), list(zip(js_times, *columns)))
+
+    def test_member_count_data_without_memberships(self):
+        self.assertEqual(views.member_count_data(date.today()), [])
+
+    def test_member_count_vs_date_is_cached_for_the_day(self):
+        director = User.objects.create_user(username="director", password="pw4director")
+        Tagging.objects.create(member=director.member, tag=Tag.objects.create(name="Director", meaning="spam"))
+        Membership.objects.create(start_date=date.today(), end_date=date.today(), sale_price=0)
+        self.client.login(username="director", password="pw4director")
+        url = reverse("memb:desktop-member-count-vs-date")
+        response = self.client.get(url)
+        self.assertEqual(len(response.context['data']), 1)
+        Membership.objects.create(start_date=date.today()-timedelta(days=1), end_date=date.today(), sale_price=0)
+        response = self.client.get(url)
+        self.assertEqual(len(response.context['data']), 1)
 
 
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
@@ -336,6 +463,11 @@ class RfidEntry(TestCase):
         self.memb.clean()
         self.memb.save()
 
+        # Readers that keep their own copy of the access cards authenticate with a token.
+        reader = User.objects.create_user(username='reader1', password="reader1")
+        reader.user_permissions.add(Permission.objects.get(codename='view_accesscard'))
+        self.reader_auth = {'HTTP_AUTHORIZATION': "Token " + Token.objects.create(user=reader).key}
+
         # This simulates requests from inside the facility.
         views.FACILITY_PUBLIC_IP = "127.0.0.1"
 
@@ -416,6 +548,166 @@ class RfidEntry(TestCase):
         response = self.client.get(path)
         self.assertTrue(response.status_code == 200)
 
+    def snapshot(self, since=0):
+        path = reverse('memb:rfid-access-snapshot')
+        response = self.client.get(path, {'since': since}, **self.reader_auth)
+        self.assertTrue(response.status_code == 200)
+        return json.loads(response.content.decode())
+
+    def test_access_snapshot(self):
+        md5 = self.memb.membership_card_md5
+        full = self.snapshot()
+        self.assertEqual(full['cards'], [[md5, None, 0b01]])  # New users are tagged as members.
+        self.assertEqual(self.snapshot(full['version'])['cards'], [])  # Nothing changed.
+
+        end_date = date.today()+timedelta(days=7)
+        Membership.objects.create(member=self.memb, start_date=date.today()-timedelta(days=7), end_date=end_date)
+        Tagging.objects.create(member=self.memb, tag=Tag.objects.get_or_create(name="Staff", defaults={"meaning": "Staff"})[0])
+        delta = self.snapshot(full['version'])
+        self.assertEqual(delta['cards'], [[md5, end_date.isoformat(), 0b11]])
+        self.assertEqual(delta['tags'][1], "Staff")
+
+        self.memb.membership_card_md5 = hashlib.md5(b"1111").hexdigest()
+        self.memb.save()
+        delta = self.snapshot(delta['version'])
+        self.assertEqual(delta['revoked'], [md5])
+        self.assertEqual([card[0] for card in delta['cards']], [self.memb.membership_card_md5])
+        self.assertEqual(len(self.snapshot()['cards']), 1)  # Revoked cards aren't in full snapshots.
+
+    def test_snapshot_only_reads(self):
+        since = AccessCard.current_version()
+        with self.assertNumQueries(2):
+            self.assertEqual(AccessCard.snapshot(since)['cards'], [])
+
+    def test_cards_follow_signals(self):
+        md5 = self.memb.membership_card_md5
+        version = AccessCard.current_version()
+        staff = Tag.objects.create(name="Staff Emeritus", meaning="Former staff")
+        Tagging.objects.create(member=self.memb, tag=staff)
+        self.assertEqual(AccessCard.current_version(), version)  # Not one of the access tags.
+        staff.name = "Staff"
+        staff.save()
+        self.assertEqual(AccessCard.snapshot(version)['cards'], [[md5, None, 0b11]])
+
+        # Memberships that start in the future are picked up by the daily command.
+        start_date, end_date = date.today()+timedelta(days=1), date.today()+timedelta(days=30)
+        Membership.objects.create(member=self.memb, start_date=start_date, end_date=end_date)
+        with freeze_time(start_date):
+            management.call_command("refreshaccesscards")
+        self.assertEqual(AccessCard.objects.get(card_md5=md5).paid_through, end_date)
+
+        version = AccessCard.current_version()
+        self.memb.auth_user.delete()
+        self.assertEqual(AccessCard.snapshot(version)['revoked'], [md5])
+        self.assertEqual(AccessCard.update_for_members(), 0)  # The signals left nothing for a full update to do.
+
+    def test_note_granted_batch(self):
+        path = reverse('memb:rfid-entries-granted')
+        entries = [
+            {'card_md5': self.memb.membership_card_md5, 'when': "2018-01-05T10:00:00"},
+            {'card_md5': self.memb.membership_card_md5, 'when': "2018-01-05T18:00:00-07:00"},
+            {'card_md5': "0" * 32, 'when': "2018-01-05T10:00:00"},
+        ]
+        body = json.dumps({'entries': entries})
+        response = self.client.post(path, body, content_type="application/json", **self.reader_auth)
+        self.assertTrue(response.status_code == 200)
+        self.assertEqual(json.loads(response.content.decode())['recorded'], 2)
+        self.assertEqual(VisitEvent.objects.filter(who=self.memb, method=VisitEvent.METHOD_RFID).count(), 2)
+
+    def test_reader_credential_required(self):
+        body = json.dumps({'entries': [{'card_md5': self.memb.membership_card_md5, 'when': "2018-01-05T10:00:00"}]})
+        other = User.objects.create_user(username='other', password="other")
+        for auth, status in [({}, 401), ({'HTTP_AUTHORIZATION': "Token " + Token.objects.create(user=other).key}, 403)]:
+            response = self.client.get(reverse('memb:rfid-access-snapshot'), **auth)
+            self.assertEqual(response.status_code, status)
+            response = self.client.post(
+                reverse('memb:rfid-entries-granted'), body, content_type="application/json", **auth)
+            self.assertEqual(response.status_code, status)
+        self.assertFalse(VisitEvent.objects.filter(method=VisitEvent.METHOD_RFID).exists())
+
+        # Readers must also be inside the facility.
+        views.FACILITY_PUBLIC_IP = "1.1.1.1"
+        response = self.client.get(reverse('memb:rfid-access-snapshot'), **self.reader_auth)
+        self.assertEqual(response.status_code, 403)
+
+    def test_note_granted_batch_bad_input(self):
+        path = reverse('memb:rfid-entries-granted')
+        for body in ["[]", '{"entries": {}}', '{"entries": "x"}', "not json"]:
+            response = self.client.post(path, body, content_type="application/json", **self.reader_auth)
+            self.assertEqual(response.status_code, 400)
+        entries = [
+            "not an entry",
+            {'card_md5': ["not", "a", "string"], 'when': "2018-01-05T10:00:00"},
+            {'card_md5': self.memb.membership_card_md5, 'when': "2018-13-45T10:00:00"},  # Out of range.
+            {'card_md5': self.memb.membership_card_md5, 'when': 12345},
+            {'card_md5': self.memb.membership_card_md5, 'when': "2018-01-05T10:00:00"},
+        ]
+        body = json.dumps({'entries': entries})
+        response = self.client.post(path, body, content_type="application/json", **self.reader_auth)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content.decode())['recorded'], 1)
+        self.assertEqual(json.loads(response.content.decode())['ignored'], 4)
+
+
+class TestAddressResolver(TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.answers = {'facility.example.org': ["203.0.113.7", "2001:db8::7"]}
+
+    def resolve(self, hostname):
+        answer = self.answers[hostname]
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    def resolver(self, spec):
+        resolver = AddressResolver(spec, ttl_secs=60.0, resolve=self.resolve, clock=lambda: self.now)
+        with resolver._refreshing:  # Waits for the first resolution, which is in the background.
+            return resolver
+
+    def test_addresses_and_ranges(self):
+        resolver = self.resolver("facility.example.org, 198.51.100.0/28 192.0.2.1")
+        for addr in ["203.0.113.7", "2001:db8::7", "198.51.100.15", "192.0.2.1"]:
+            self.assertTrue(resolver.contains(addr), addr)
+        for addr in ["198.51.100.16", "192.0.2.2", "not an address"]:
+            self.assertFalse(resolver.contains(addr), addr)
+
+    def test_refresh_keeps_last_good_set(self):
+        resolver = self.resolver("facility.example.org")
+        self.answers['facility.example.org'] = OSError("DNS is down")
+        self.now = 61.0
+        resolver.refresh()
+        self.assertTrue(resolver.contains("203.0.113.7"))
+        self.answers['facility.example.org'] = ["203.0.113.8"]
+        self.now = 200.0
+        resolver.refresh()
+        self.assertFalse(resolver.contains("203.0.113.7"))
+        metrics = resolver.metrics()
+        self.assertEqual((metrics['resolutions'], metrics['failures']), (3, 1))
+        self.assertEqual(metrics['networks'], ["203.0.113.8/32"])
+
+    def test_first_resolution_doesnt_block(self):
+        answered = threading.Event()
+
+        def hung_resolve(hostname):
+            answered.wait()
+            return ["203.0.113.7"]
+        resolver = AddressResolver("facility.example.org 192.0.2.1", resolve=hung_resolve)
+        self.assertTrue(resolver.contains("192.0.2.1"))
+        self.assertFalse(resolver.contains("203.0.113.7"))
+        answered.set()
+        with resolver._refreshing:
+            self.assertTrue(resolver.contains("203.0.113.7"))
+
+    def test_stale_set_is_refreshed_in_background(self):
+        resolver = self.resolver("facility.example.org")
+        self.answers['facility.example.org'] = ["203.0.113.8"]
+        self.now = 61.0
+        resolver.contains("203.0.113.8")  # Answered from the stale set, while it's refreshed.
+        with resolver._refreshing:  # Waits for the refresh to finish.
+            self.assertTrue(resolver.contains("203.0.113.8"))
+
 
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 # RECEPTION KIOSK API
@@ -54,6 +54,7 @@ urlpatterns = [
     url(r'^api/visit-event/(?P<member_card_str>[-_a-zA-Z0-9]{32})_(?P<event_type>[APD])/$', views.api_log_visit_event, name="api-visit-event"),
 
     # DJANGO REST FRAMEWORK API (AKA "XisApi")
+    url(r'^api/facility-ip-metrics/$', views.api_facility_ip_metrics, name='api-facility-ip-metrics'),
     url(r'^api/', include(router.urls)),
     url(r'^api-authenticate/', views.api_authenticate, name='api-authenticate'),
 
@@ -61,4 +62,6 @@ urlpatterns = [
     url(r'^rfid-entry-requested/(?P<rfid_cardnum>[0-9]{1,32})/$', views.rfid_entry_requested, name='rfid-entry-requested'),
     url(r'^rfid-entry-granted/(?P<rfid_cardnum>[0-9]{1,32})/$', views.rfid_entry_granted, name='rfid-entry-granted'),
     url(r'^rfid-entry-denied/(?P<rfid_cardnum>[0-9]{1,32})/$', views.rfid_entry_denied, name='rfid-entry-denied'),
+    url(r'^rfid-entries-granted/$', views.rfid_entries_granted, name='rfid-entries-granted'),
+    url(r'^rfid-access-snapshot/$', views.rfid_access_snapshot, name='rfid-access-snapshot'),
 ]
@@ -1,14 +1,12 @@
 
 # Standard
 from datetime import date, timedelta
-from collections import Counter
 from time import mktime
 from logging import getLogger
 from typing import Union, Tuple, Optional
 import json
 
 # Third party
-from dateutil.relativedelta import relativedelta
 from django.shortcuts import render
 from django.http import HttpResponse, JsonResponse
 from django.urls import reverse
@@ -16,9 +14,14 @@ from django.core.exceptions import PermissionDenied
 from django.contrib.auth import authenticate
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.csrf import ensure_csrf_cookie, csrf_exempt
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.conf import settings
 from django.core.mail import EmailMultiAlternatives
 from django.template.loader import get_template
+from django.core.cache import cache
+
+import numpy as np
 
 from rest_framework.decorators import api_view, authentication_classes, permission_classes, throttle_classes
 from rest_framework.permissions import IsAdminUser, AllowAny
@@ -33,10 +36,11 @@ from reportlab.lib.units import inch, mm
 from reportlab.lib.pagesizes import letter
 
 # Local
-from members.models import Member, Tag, Tagging, VisitEvent, Membership, DiscoveryMethod
+from members.models import Member, Tag, Tagging, VisitEvent, Membership, DiscoveryMethod, AccessCard
 from members.forms import Desktop_ChooseUserForm
 from members.restapi.serializers import get_MemberSerializer
-from abutils.utils import request_is_from_host
+from members.restapi.permissions import AccessCardReaderPermission
+from abutils.facility import is_from_facility, facility_resolver
 
 logger = getLogger("members")
 
@@ -144,7 +148,7 @@ def api_log_visit_event(request, member_card_str, event_type):
     # facility's network. This will be true for sites hosted on Heroku, etc.
 
     if FACILITY_PUBLIC_IP is not None:
-        if not request_is_from_host(request, FACILITY_PUBLIC_IP):
+        if not is_from_facility(request, FACILITY_PUBLIC_IP):
             msg = "Must be on {} WiFi to check in/out".format(ORG_NAME_POSSESSIVE)
             return JsonResponse({'error': msg})
 
@@ -289,7 +293,7 @@ def inside_facility_only(function):
             # If the public IP is not specified in settings, we can't tell if we should allow this request.
             # So we'll default to NOT allowing it.
             raise PermissionDenied
-        elif request_is_from_host(request, FACILITY_PUBLIC_IP):
+        elif is_from_facility(request, FACILITY_PUBLIC_IP):
             # Respond since the request is coming from INSIDE our facility.
             return function(request, *args, **kwargs)
         else:
@@ -300,6 +304,15 @@ def inside_facility_only(function):
     return wrap
 
 
+@api_view(['GET'])
+@authentication_classes([TokenAuthentication])
+@permission_classes([IsAdminUser])
+def api_facility_ip_metrics(request) -> JsonResponse:
+    """ How resolving the facility's public addresses has gone, for monitoring. """
+    resolver = facility_resolver(FACILITY_PUBLIC_IP)
+    return JsonResponse(resolver.metrics() if resolver is not None else {'spec': None})
+
+
 @inside_facility_only
 def rfid_entry_requested(request, rfid_cardnum):
 
@@ -307,15 +320,15 @@ def rfid_entry_requested(request, rfid_cardnum):
     if member is None:
         json = {'card_registered': False}
     else:
-        try:
-            latest_pm = Membership.objects.filter(member=member).latest('start_date')
+        latest_pm = member.latest_nonfuture_membership
+        if latest_pm is not None:
             json = {
                 'card_registered': True,
                 'membership_current': member.is_currently_paid(),
                 'membership_start_date': latest_pm.start_date,
                 'membership_end_date': latest_pm.end_date,
             }
-        except Membership.DoesNotExist:
+        else:
             json = {
                 'card_registered': True,
                 'membership_current': False,
@@ -347,6 +360,67 @@ def rfid_entry_denied(request, rfid_cardnum):
     return JsonResponse({'success': "Information noted."})
 
 
+@api_view(['GET'])
+@authentication_classes([TokenAuthentication])
+@permission_classes([AccessCardReaderPermission])
+@inside_facility_only
+def rfid_access_snapshot(request):
+    """
+    For readers that decide on their own whether to let a card in, so they keep working when the internet doesn't.
+    Pass ?since=N to get only the changes since version N. See AccessCard.snapshot().
+    Readers authenticate with a token. See AccessCardReaderPermission.
+    """
+    try:
+        since = max(0, int(request.GET.get('since', "0")))
+    except ValueError:
+        since = 0
+    return JsonResponse(AccessCard.snapshot(since))
+
+
+@api_view(['POST'])
+@authentication_classes([TokenAuthentication])
+@permission_classes([AccessCardReaderPermission])
+@inside_facility_only
+def rfid_entries_granted(request):
+    """
+    A batched version of rfid_entry_granted, for readers that were granted entry while offline.
+    The body is {"entries": [{"card_md5": <md5 of the card#>, "when": <ISO date/time>}, ...]}.
+    Readers authenticate with a token. See AccessCardReaderPermission.
+    """
+    try:
+        entries = json.loads(request.body.decode())['entries']
+    except (ValueError, KeyError, TypeError):
+        entries = None
+    if not isinstance(entries, list):
+        return JsonResponse({'error': "Expected a JSON object with a list of entries."}, status=400)
+
+    # Entries that aren't well formed are ignored, like those with unknown cards, so the rest can still be recorded.
+    entries = [entry if isinstance(entry, dict) else {} for entry in entries]
+    card_md5s = {entry.get('card_md5') for entry in entries if isinstance(entry.get('card_md5'), str)}
+    members = dict(Member.objects.filter(membership_card_md5__in=card_md5s).values_list('membership_card_md5', 'id'))
+    visits = []
+    unknown = 0
+    for entry in entries:
+        card_md5, when = entry.get('card_md5'), entry.get('when')
+        member_id = members.get(card_md5) if isinstance(card_md5, str) else None
+        try:
+            when = parse_datetime(when) if isinstance(when, str) else None
+            if when is not None and timezone.is_naive(when):
+                when = timezone.make_aware(when)
+        except ValueError:  # E.g. a date/time that's out of range.
+            when = None
+        if member_id is None or when is None:
+            unknown += 1
+            continue
+        # As in rfid_entry_granted, RFID reads are considered to indicate *presence*.
+        visits.append(VisitEvent(
+            who_id=member_id, when=when, event_type=VisitEvent.EVT_PRESENT, method=VisitEvent.METHOD_RFID))
+    VisitEvent.objects.bulk_create(visits)
+    if unknown > 0:
+        logger.warning("Ignored %d RFID entries with unknown cards, bad times, or bad structure.", unknown)
+    return JsonResponse({'success': "Information noted.", 'recorded': len(visits), 'ignored': unknown})
+
+
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = REPORTS
 
 def zero_to_null(somelist: list) -> list:
@@ -356,44 +430,70 @@ def zero_to_null(somelist: list) -> list:
     return ["null" if x == 0 else x for x in somelist]
 
 
+MEMBER_COUNT_START_DATE = date(2015, 1, 1)
+
+# The rows of member_count_data()'s difference array that each membership type counts toward.
+# Not enough gift card sales to call them out separately. Will include them in "Regular" count.
+MEMBER_COUNT_ROWS = {
+    Membership.MT_REGULAR: 0,
+    Membership.MT_GIFTCARD: 0,
+    Membership.MT_FAMILY: 1,
+    Membership.MT_WORKTRADE: 2,
+    Membership.MT_GROUP: 3,
+    Membership.MT_COMPLIMENTARY: 4,
+}
+MEMBER_COUNT_ANY_ROW = 5  # Memberships of every type, to find the days that are charted.
+
+
+def member_count_data(end_date: date) -> list:
+    """
+    The number of memberships of each type on each day through end_date, for which there's at least one
+    membership of any type.
+    Each membership adds one to its rows of a difference array on its first day and subtracts one the day after its
+    last, so the counts are cumulative sums of the rows.
+    :return: [(js_time, regular, family, worktrade, group, complimentary), ...] with counts as per zero_to_null().
+    """
+    day_count = (end_date - MEMBER_COUNT_START_DATE).days + 1
+    if day_count <= 0:
+        return []
+
+    rows, firsts, afters = [], [], []
+    mships = Membership.objects.values_list('membership_type', 'start_date', 'end_date')
+    for mtype, start_date, mship_end_date in mships:
+        first = (max(start_date, MEMBER_COUNT_START_DATE) - MEMBER_COUNT_START_DATE).days
+        last = (min(mship_end_date, end_date) - MEMBER_COUNT_START_DATE).days
+        if first > last:
+            continue
+        for row in [MEMBER_COUNT_ROWS.get(mtype), MEMBER_COUNT_ANY_ROW]:
+            if row is not None:
+                rows.append(row)
+                firsts.append(first)
+                afters.append(last + 1)
+
+    diffs = np.zeros((MEMBER_COUNT_ANY_ROW + 1, day_count + 1), dtype=int)
+    rows = np.array(rows, dtype=int)
+    np.add.at(diffs, (rows, np.array(firsts, dtype=int)), 1)
+    np.add.at(diffs, (rows, np.array(afters, dtype=int)), -1)
+    counts = np.cumsum(diffs[:, :day_count], axis=1)
+
+    charted = np.flatnonzero(counts[MEMBER_COUNT_ANY_ROW]).tolist()
+    js_times = [int(mktime((MEMBER_COUNT_START_DATE + timedelta(days=i)).timetuple())) * 1000 for i in charted]
+    columns = [zero_to_null(counts[row, charted].tolist()) for row in range(MEMBER_COUNT_ANY_ROW)]
+    return list(zip(js_times, *columns))
+
+
 @login_required()
 def desktop_member_count_vs_date(request):
     if not request.user.member.is_tagged_with("Director"):
         return HttpResponse("This page is for Directors only.")
 
-    end_date = date.today()  # .replace(day=1)  # - relativedelta(days=1)
-    wt_data = Counter()
-    reg_data = Counter()
-    comp_data = Counter()
-    group_data = Counter()
-    fam_data = Counter()
-
-    memberships = Membership.objects.all()
-    for pm in memberships:
-        # Not enough gift card sales to call them out separately. Will include them in "Regular" count.
-        wt_inc = 1 if pm.membership_type == pm.MT_WORKTRADE else 0
-        reg_inc = 1 if pm.membership_type in [pm.MT_REGULAR, pm.MT_GIFTCARD] else 0
-        comp_inc = 1 if pm.membership_type == pm.MT_COMPLIMENTARY else 0
-        group_inc = 1 if pm.membership_type == pm.MT_GROUP else 0
-        fam_inc = 1 if pm.membership_type == pm.MT_FAMILY else 0
-        day = max(pm.start_date, date(2015, 1, 1))
-        while day <= min(pm.end_date, end_date):
-            js_time_milliseconds = int(mktime(day.timetuple())) * 1000
-            wt_data.update({js_time_milliseconds: wt_inc})
-            reg_data.update({js_time_milliseconds: reg_inc})
-            comp_data.update({js_time_milliseconds: comp_inc})
-            group_data.update({js_time_milliseconds: group_inc})
-            fam_data.update({js_time_milliseconds: fam_inc})
-            day += relativedelta(days=1)
-
-    js_times = sorted(reg_data)  # Gets keys
-    reg_counts = zero_to_null([reg_data[k] for k in js_times])
-    wt_counts = zero_to_null([wt_data[k] for k in js_times])
-    comp_counts = zero_to_null([comp_data[k] for k in js_times])
-    group_counts = zero_to_null([group_data[k] for k in js_times])
-    fam_counts = zero_to_null([fam_data[k] for k in js_times])
-
-    data = list(zip(js_times, reg_counts, fam_counts, wt_counts, group_counts, comp_counts))
+    # Today's counts can still change, but this is a long term trend so it's only recomputed once a day.
+    end_date = date.today()
+    data_key = "members.member_count_vs_date.{}".format(end_date.isoformat())
+    data = cache.get(data_key)
+    if data is None:
+        data = member_count_data(end_date)
+        cache.set(data_key, data, timeout=24*60*60)
     return render(request, 'members/desktop-member-count-vs-date.html', {'data': data})
 
 